@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for each stage of the pipeline.
+
+Times the cclib parse, broadening (the original loop and the vectorized
+version), activity_to_intensity, findPeaks, the JCAMP parser, the workbook
+export, reading .out files (the original line loop and gausssum_file) and
+starting the scripts in a new interpreter, on the files in test/
+and on synthetic inputs scaled in the number of modes, grid points and
+molecules. Results are written as JSON and can be
+compared against an earlier result to catch regressions:
+
+    python benchmark.py --output baseline.json
+    ... change something ...
+    python benchmark.py --baseline baseline.json
+
+@author: aiden
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+import numpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEST_DIR = os.path.join(ROOT, "test")
+sys.path.append(os.path.join(ROOT, "IRSpectra"))
+sys.path.append(os.path.join(ROOT, "RamanSpectra"))
+sys.path.append(os.path.join(ROOT, "JCAMPFileConversion"))
+
+import ir_spectra
+import raman_spectra
+import peak_finding
+import workbook
+import batch_broadening
+import spectral_similarity
+import jcamp_parser
+from mode_table import ModeTable
+
+import reference
+import startup
+
+
+LOG_FILE = os.path.join(TEST_DIR, "1-butylnaptho[2-3-g]isoquinoline.log")
+OUT_FILE = os.path.join(TEST_DIR, "isoquinoline1.out")
+JCAMP_FILE = os.path.join(TEST_DIR, "naphthalene.jdx")
+THEORETICAL_FILE = os.path.join(TEST_DIR, "IRSpectrum_propene.txt")
+
+START = 8
+END = 4000
+FWHM = 10
+
+# synthetic scaling, each size is benchmarked on its own
+MODE_COUNTS = [30, 300, 3000]
+GRID_POINTS = [500, 5000]
+MOLECULE_COUNTS = [1, 10]
+SIMILARITY_COUNTS = [100, 2000]   # spectra clustered by similarity
+OUT_POINTS = [5000, 200000]       # lines of the synthetic .out files read
+QUICK_MODE_COUNTS = [30, 300]
+QUICK_GRID_POINTS = [500]
+QUICK_MOLECULE_COUNTS = [1]
+QUICK_SIMILARITY_COUNTS = [100]
+QUICK_OUT_POINTS = [5000]
+
+# the original broadening loop is O(modes x points) python calls, so it is
+# skipped beyond this size rather than running for minutes
+LOOP_LIMIT = 300 * 5000
+
+
+def syntheticModes(nmodes, seed=0):
+    """Random (freqs, activities) for nmodes modes between START and END"""
+    rng = numpy.random.default_rng(seed)
+    return rng.uniform(START, END, nmodes), rng.exponential(50., nmodes)
+
+
+def syntheticMolecule(nmodes, numpts, seed=0):
+    """moleculeData entry for the workbook export, as main.py builds it"""
+    freqs, acts = syntheticModes(nmodes, seed)
+    xvalues, spectrum = ir_spectra.broadenChannels(START, END, numpts, freqs, acts, FWHM)
+    freqData = xvalues.tolist()
+    irData = spectrum.tolist()
+    modes = ModeTable.fromColumns(["A"] * nmodes, freqs, acts)
+    peaks = peak_finding.findPeaks([10000 / x for x in freqData], irData, 25, 20, .5, 9, 9, "", False)
+    return {"freqs": freqData, "irData": irData, "modes": modes, "peaks": peaks}
+
+
+def timeIt(function, repeat, setup=None):
+    """Runs function repeat times (calling setup untimed before each) and returns the times in seconds"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        begin = timer()
+        function()
+        times.append(timer() - begin)
+    return times
+
+
+def benchmarks(quick=False):
+    """
+    Yields (name, params, function, setup) for every benchmark. Inputs are
+    built here, outside the timed functions
+    """
+    modeCounts = QUICK_MODE_COUNTS if quick else MODE_COUNTS
+    gridPoints = QUICK_GRID_POINTS if quick else GRID_POINTS
+    moleculeCounts = QUICK_MOLECULE_COUNTS if quick else MOLECULE_COUNTS
+    similarityCounts = QUICK_SIMILARITY_COUNTS if quick else SIMILARITY_COUNTS
+    outPoints = QUICK_OUT_POINTS if quick else OUT_POINTS
+
+    # fixtures
+    def clearParseCache():
+        ir_spectra._parseCache.clear()
+    def parseLog():
+        with contextlib.redirect_stdout(io.StringIO()):
+            ir_spectra.parseLog(LOG_FILE)
+    yield "parse.cclib", {"file": os.path.basename(LOG_FILE)}, parseLog, clearParseCache
+    yield "parse.jcamp", {"file": os.path.basename(JCAMP_FILE)}, lambda: jcamp_parser.parseJcamp(JCAMP_FILE), None
+    yield "parse.out", {"file": os.path.basename(OUT_FILE)}, lambda: workbook.readOutputFile(OUT_FILE), None
+    yield ("parse.out", {"file": os.path.basename(THEORETICAL_FILE)},
+           lambda: workbook.readOutputFile(THEORETICAL_FILE), None)
+    yield ("parse.out", {"file": os.path.basename(OUT_FILE), "mmap": True},
+           lambda: workbook.readOutputFile(OUT_FILE, mmap=True), None)
+
+    freqData, irData, _ = workbook.readOutputFile(OUT_FILE)
+    wavData = [10000 / x for x in freqData]
+    yield ("findPeaks.fixture", {"file": os.path.basename(OUT_FILE), "points": len(irData)},
+           lambda: peak_finding.findPeaks(wavData, irData, 25, 20, .5, 9, 9, "", False, [(6.0, 6.4), (12, 13)]), None)
+
+    # synthetic scaling
+    for nmodes in modeCounts:
+        freqs, acts = syntheticModes(nmodes)
+        yield ("activity_to_intensity", {"modes": nmodes},
+               lambda acts=acts, freqs=freqs: raman_spectra.activity_to_intensity(acts, freqs, 785, 293.15), None)
+
+        for numpts in gridPoints:
+            params = {"modes": nmodes, "points": numpts}
+            peaks = list(zip(freqs, acts))
+            if nmodes * numpts <= LOOP_LIMIT:
+                yield ("broadenSpectrum.loop", params,
+                       lambda numpts=numpts, peaks=peaks:
+                           ir_spectra.broadenSpectrum(START, END, numpts, peaks, FWHM, ir_spectra.lorentzian), None)
+            yield ("broadenSpectrum.vectorized", params,
+                   lambda numpts=numpts, freqs=freqs, acts=acts:
+                       ir_spectra.broadenChannels(START, END, numpts, freqs, acts, FWHM), None)
+
+    for numpts in gridPoints:
+        _, spectrum = ir_spectra.broadenChannels(START, END, numpts, *syntheticModes(300), FWHM)
+        xvalues = numpy.linspace(START, END, numpts)
+        wav = (10000 / xvalues).tolist()
+        irs = spectrum.tolist()
+        yield ("findPeaks.synthetic", {"points": numpts},
+               lambda wav=wav, irs=irs: peak_finding.findPeaks(wav, irs, 25, 20, .5, 9, 9, "", False), None)
+
+    for nmolecules in moleculeCounts:
+        for numpts in gridPoints:
+            moleculeData = {f"molecule{i}": syntheticMolecule(120, numpts, seed=i) for i in range(nmolecules)}
+            def export(moleculeData=moleculeData):
+                wb = workbook.buildWorkbook(moleculeData, 100)
+                wb.save(io.BytesIO())
+            yield "export.workbook", {"molecules": nmolecules, "points": numpts, "modes": 120}, export, None
+
+    for nspectra in similarityCounts:
+        # a tenth as many distinct spectra, each repeated with its modes moved slightly
+        rng = numpy.random.default_rng(0)
+        bases = [syntheticModes(120, seed) for seed in range(max(1, nspectra // 10))]
+        sticks = [(freqs + rng.normal(0, 2, len(freqs)), acts) for freqs, acts in bases for _ in range(10)]
+        positions, heights, offsets = batch_broadening.packSpectra(sticks)
+        matrix = batch_broadening.broadenBatch(numpy.linspace(START, END, GRID_POINTS[0]), positions, heights,
+                                               offsets, FWHM)
+        yield ("cluster.similarity", {"spectra": len(matrix), "points": GRID_POINTS[0]},
+               lambda matrix=matrix: spectral_similarity.clusterSpectra(matrix, .98), None)
+
+    # .out files as irSpectra writes them, read by the original line loop and by gausssum_file
+    with tempfile.TemporaryDirectory() as outDir:
+        for numpts in outPoints:
+            outFile = os.path.join(outDir, f"synthetic{numpts}.out")
+            freqs, acts = syntheticModes(300)
+            xvalues, spectrum = ir_spectra.broadenChannels(START, END, numpts, freqs, acts, FWHM)
+            with contextlib.redirect_stdout(io.StringIO()):
+                ir_spectra.writeSpectrum(outFile, xvalues, spectrum, ["A"] * len(freqs), freqs, acts,
+                                         [1.] * len(freqs), freqs)
+            params = {"points": numpts, "modes": len(freqs)}
+            yield "parse.out.loop", params, lambda outFile=outFile: reference.readOutputFile(outFile), None
+            yield "parse.out.synthetic", params, lambda outFile=outFile: workbook.readOutputFile(outFile), None
+
+    # a fresh interpreter for each run, see startup.py
+    with tempfile.TemporaryDirectory() as workDir:
+        for name, body, setup in startup.cases():
+            if setup is not None:
+                startup.runChild(setup, workDir)
+            yield "startup." + name, {}, lambda body=body: startup.runChild(body, workDir), None
+
+
+def benchmarkKey(name, params):
+    """Unique name of a benchmark and its parameters, e.g. broadenSpectrum.loop[modes=30,points=500]"""
+    return name + "[" + ",".join(f"{k}={v}" for k, v in sorted(params.items())) + "]"
+
+
+def runBenchmarks(repeat=5, quick=False, pattern=None):
+    """Runs the benchmarks whose key contains pattern, returns {key: result}"""
+    results = {}
+    for name, params, function, setup in benchmarks(quick):
+        key = benchmarkKey(name, params)
+        if pattern is not None and pattern not in key:
+            continue
+        # slow benchmarks are run fewer times
+        first = timeIt(function, 1, setup)
+        times = first + timeIt(function, repeat - 1 if first[0] < 1. else min(repeat - 1, 2), setup)
+        results[key] = {
+            "stage": name,
+            "params": params,
+            "repeats": len(times),
+            "min": min(times),
+            "median": statistics.median(times),
+            "max": max(times),
+        }
+        print(f"{key:60s} {results[key]['min'] * 1e3:10.3f} ms")
+    return results
+
+
+def environment():
+    """Where the benchmarks were run, saved with the results"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the ratio of each result to the baseline (using the minimum time,
+    the least noisy) and returns the keys that are slower than threshold times
+    the baseline
+    """
+    regressions = []
+    print()
+    print(f"{'benchmark':60s} {'baseline ms':>12s} {'now ms':>12s} {'ratio':>8s}")
+    for key, result in results.items():
+        if key not in baseline["results"]:
+            print(f"{key:60s} {'-':>12s} {result['min'] * 1e3:12.3f} {'new':>8s}")
+            continue
+        before = baseline["results"][key]["min"]
+        ratio = result["min"] / before
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "  SLOWER"
+        print(f"{key:60s} {before * 1e3:12.3f} {result['min'] * 1e3:12.3f} {ratio:8.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times each stage of the pipeline")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results written earlier with --output")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="report benchmarks slower than this times the baseline (default 1.25)")
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each benchmark (default 5)")
+    parser.add_argument("--quick", action="store_true", help="only the smaller synthetic sizes")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.repeat, args.quick, args.filter)
+    report = {"environment": environment(), "repeat": args.repeat, "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks are more than {args.threshold}x slower than {args.baseline}")
+            sys.exit(1)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the production routines against the frozen reference loops.
+
+Every comparison runs the same input through reference.py and the version
+used by the scripts, checks they agree within the tolerance stated for that
+routine and reports the speedup. Inputs are the files in test/ plus
+randomized spectra and JCAMP files:
+
+    python equivalence.py                # exits with 1 if anything disagrees
+    python equivalence.py --seeds 50 --output equivalence.json
+
+@author: aiden
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+import numpy
+
+import reference
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEST_DIR = os.path.join(ROOT, "test")
+sys.path.append(os.path.join(ROOT, "IRSpectra"))
+sys.path.append(os.path.join(ROOT, "RamanSpectra"))
+sys.path.append(os.path.join(ROOT, "JCAMPFileConversion"))
+
+import ir_spectra
+import raman_spectra
+import peak_finding
+import workbook
+import gausssum_file
+import jcamp_parser
+
+
+OUT_FILE = os.path.join(TEST_DIR, "isoquinoline1.out")
+JCAMP_FILE = os.path.join(TEST_DIR, "naphthalene.jdx")
+THEORETICAL_FILE = os.path.join(TEST_DIR, "IRSpectrum_propene.txt")
+
+# tolerances, relative to the largest reference value
+SPECTRUM_RTOL = 1e-12      # broadening sums the same terms in a different order
+INTENSITY_RTOL = 1e-12     # elementwise, the same formula
+JCAMP_X_RTOL = 1e-12       # start + k * DELTAX rather than repeated addition
+JCAMP_Y_RTOL = 0.          # the same multiplication, must be exact
+GAUSSSUM_RTOL = 0.         # the same decimal conversion, must be exact
+# peak indices must be identical
+
+PEAK_SETTINGS = (25, 20, .5, 9, 9)  # max_x, windowSize, nsigma, coalesceWindow, highPass as in main.py
+INCLUDE_RANGES = [(6.0, 6.4), (12, 13)]
+
+
+def timed(function, *args):
+    """Returns (result, seconds), best of a few runs for quick functions"""
+    best = None
+    result = None
+    for _ in range(3):
+        begin = timer()
+        result = function(*args)
+        elapsed = timer() - begin
+        best = elapsed if best is None else min(best, elapsed)
+        if elapsed > .5:
+            break
+    return result, best
+
+
+def maxRelativeError(expected, actual):
+    expected = numpy.asarray(expected, dtype="d")
+    actual = numpy.asarray(actual, dtype="d")
+    if expected.shape != actual.shape:
+        return numpy.inf
+    scale = numpy.abs(expected).max() if expected.size else 1.
+    return float(numpy.abs(expected - actual).max() / scale) if expected.size and scale > 0 else 0.
+
+
+def compareArrays(name, case, referenceRun, fastRun, rtol):
+    (expected, referenceTime), (actual, fastTime) = referenceRun, fastRun
+    error = maxRelativeError(expected, actual)
+    return {"routine": name, "case": case, "error": error, "tolerance": rtol, "passed": error <= rtol,
+            "referenceTime": referenceTime, "fastTime": fastTime}
+
+
+def randomSticks(rng):
+    nmodes = int(rng.integers(1, 200))
+    return rng.uniform(0, 4200, nmodes), rng.exponential(50., nmodes)
+
+
+def broadeningCases(rng, seeds):
+    """(case, start, end, numpts, freqs, acts, width)"""
+    freqData, _, modes = workbook.readOutputFile(OUT_FILE)
+    yield "fixture", 8, 4000, 500, modes.freq, modes.act, 10
+    for seed in range(seeds):
+        freqs, acts = randomSticks(rng)
+        start = float(rng.uniform(0, 500))
+        end = float(rng.uniform(1000, 4000))
+        yield f"random{seed}", start, end, int(rng.integers(2, 2000)), freqs, acts, float(rng.uniform(1, 40))
+
+
+def checkBroadening(rng, seeds):
+    for case, start, end, numpts, freqs, acts, width in broadeningCases(rng, seeds):
+        peaks = list(zip(freqs, acts))
+        referenceRun = timed(reference.broadenSpectrum, start, end, numpts, peaks, width, reference.lorentzian)
+        fastRun = timed(ir_spectra.broadenChannels, start, end, numpts, freqs, acts, width)
+        xResult = compareArrays("broadenSpectrum x", case, (referenceRun[0][0], 0), (fastRun[0][0], 0), 0.)
+        result = compareArrays("broadenSpectrum", case, (referenceRun[0][1], referenceRun[1]),
+                               (fastRun[0][1], fastRun[1]), SPECTRUM_RTOL)
+        result["passed"] = result["passed"] and xResult["passed"]
+        yield result
+
+
+def checkIntensity(rng, seeds):
+    for seed in range(seeds):
+        freqs, acts = randomSticks(rng)
+        freqs = freqs + 1.  # the formula divides by the frequency
+        excitation = float(rng.choice([532, 633, 785, 1064]))
+        temperature = float(rng.uniform(77, 400))
+        referenceRun = timed(lambda: [reference.activity_to_intensity(a, f, excitation, temperature)
+                                      for a, f in zip(acts, freqs)])
+        fastRun = timed(raman_spectra.activity_to_intensity, acts, freqs, excitation, temperature)
+        yield compareArrays("activity_to_intensity", f"random{seed}", referenceRun, fastRun, INTENSITY_RTOL)
+
+
+def comparePeaks(case, dataX, dataY):
+    expected, referenceTime = timed(reference.findPeaks, dataX, dataY, *PEAK_SETTINGS, INCLUDE_RANGES)
+    actual, fastTime = timed(peak_finding.findPeaks, dataX, dataY, *PEAK_SETTINGS, case, False, INCLUDE_RANGES)
+    return {"routine": "findPeaks", "case": case, "error": 0. if expected == actual else numpy.inf,
+            "tolerance": 0., "passed": expected == actual, "referenceTime": referenceTime, "fastTime": fastTime}
+
+
+def checkPeaks(rng, seeds):
+    freqData, irData, _ = workbook.readOutputFile(OUT_FILE)
+    yield comparePeaks("fixture", [10000 / x for x in freqData], irData)
+    for seed in range(seeds):
+        freqs, acts = randomSticks(rng)
+        numpts = int(rng.integers(50, 3000))
+        xvalues, spectrum = ir_spectra.broadenChannels(8, 4000, numpts, freqs, acts, float(rng.uniform(2, 30)))
+        yield comparePeaks(f"random{seed}", (10000 / xvalues).tolist(), spectrum.tolist())
+
+
+def writeRandomJcamp(fileName, rng):
+    """
+    Random X++(Y..Y) file. DELTAX is a power of two so that the reference
+    parser's repeated addition reproduces LASTX exactly, as its check needs
+    """
+    deltaX = float(rng.choice([0.5, 1., 2., 4.]))
+    firstX = float(rng.integers(0, 1000))
+    perLine = int(rng.integers(1, 16))
+    nPoints = int(rng.integers(1, 3000))
+    yFactor = float(rng.uniform(1e-6, 1e-2))
+    ys = rng.integers(1, 30000, nPoints)
+    lastX = firstX + (nPoints - 1) * deltaX
+    with open(fileName, "w") as f:
+        f.write("##TITLE=random\n##JCAMP-DX=4.24\n##XUNITS=1/CM\n##YUNITS=ABSORBANCE\n")
+        f.write(f"##XFACTOR=1.0\n##YFACTOR={yFactor!r}\n##DELTAX={deltaX}\n##FIRSTX={firstX}\n")
+        f.write(f"##LASTX={lastX}\n##FIRSTY={float(ys[0] * yFactor)!r}\n##NPOINTS={nPoints}\n")
+        f.write("##XYDATA=(X++(Y..Y))\n")
+        for i in range(0, nPoints, perLine):
+            f.write(f"{firstX + i * deltaX} " + " ".join(str(y) for y in ys[i:i + perLine]) + "\n")
+        f.write("##END=\n")
+
+
+def compareJcamp(case, fileName):
+    (expectedX, expectedY), referenceTime = timed(reference.parseJcamp, fileName)
+    (actualX, actualY, _), fastTime = timed(jcamp_parser.parseJcamp, fileName)
+    xResult = compareArrays("parseJcamp x", case, (expectedX, 0), (actualX, 0), JCAMP_X_RTOL)
+    result = compareArrays("parseJcamp", case, (expectedY, referenceTime), (actualY, fastTime), JCAMP_Y_RTOL)
+    result["error"] = max(result["error"], xResult["error"])
+    result["passed"] = result["passed"] and xResult["passed"]
+    result["tolerance"] = max(JCAMP_X_RTOL, JCAMP_Y_RTOL)
+    return result
+
+
+def checkJcamp(rng, seeds):
+    yield compareJcamp("fixture", JCAMP_FILE)
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(seeds):
+            fileName = os.path.join(directory, f"random{seed}.jdx")
+            writeRandomJcamp(fileName, rng)
+            yield compareJcamp(f"random{seed}", fileName)
+
+
+def writeRandomOut(fileName, rng):
+    """Random .out file with every column of the mode table, written by irSpectra's writer"""
+    numpts = int(rng.integers(1, 5000))
+    nmodes = int(rng.integers(0, numpts + 1))
+    xvalues = numpy.linspace(float(rng.uniform(0, 500)), float(rng.uniform(1000, 4000)), numpts)
+    freq = rng.uniform(0, 4000, nmodes)
+    scale = rng.choice([1., .979, .961], nmodes)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ir_spectra.writeSpectrum(fileName, xvalues, rng.exponential(1., numpts), rng.choice(["A", "B1", "A'"], nmodes),
+                                 freq, rng.exponential(50., nmodes), scale, freq / scale)
+
+
+def compareGaussSum(case, fileName):
+    """The .out reader on fileName, and the converter's reader too for the spectrum columns"""
+    expected, referenceTime = timed(reference.readOutputFile, fileName)
+    (xvalues, spectrum, modes), fastTime = timed(gausssum_file.readGaussSum, fileName)
+    columns = [(expected[0], xvalues), (expected[1], spectrum), (expected[2], modes.mode),
+               (expected[4], modes.freq), (expected[5], modes.act), (expected[6], modes.scale),
+               (expected[7], modes.unscaled)]
+    result = compareArrays("readGaussSum", case, (expected[0], referenceTime), (xvalues, fastTime), GAUSSSUM_RTOL)
+    result["error"] = max(maxRelativeError(e, a) for e, a in columns)
+    result["passed"] = result["error"] <= GAUSSSUM_RTOL and expected[3] == modes.label.tolist()
+    return result
+
+
+def checkGaussSum(rng, seeds):
+    yield compareGaussSum("fixture", OUT_FILE)
+    expected, referenceTime = timed(reference.parseTheoretical, THEORETICAL_FILE)
+    (xvalues, spectrum, _), fastTime = timed(gausssum_file.readGaussSum, THEORETICAL_FILE)
+    xResult = compareArrays("parseTheoretical x", "fixture", (expected[0], 0), (xvalues, 0), GAUSSSUM_RTOL)
+    result = compareArrays("parseTheoretical", "fixture", (expected[1], referenceTime), (spectrum, fastTime),
+                           GAUSSSUM_RTOL)
+    result["passed"] = result["passed"] and xResult["passed"]
+    yield result
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(seeds):
+            fileName = os.path.join(directory, f"random{seed}.out")
+            writeRandomOut(fileName, rng)
+            yield compareGaussSum(f"random{seed}", fileName)
+
+        # more modes than points, which the original reader could not read back, against what was written
+        fileName = os.path.join(directory, "shortGrid.out")
+        xvalues = numpy.linspace(8, 4000, 50)
+        spectrum = rng.exponential(1., len(xvalues))
+        freq = rng.uniform(0, 4000, 120)
+        labels = rng.choice(["A", "B1", "A'"], len(freq))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ir_spectra.writeSpectrum(fileName, xvalues, spectrum.copy(), labels, freq, freq / 10, numpy.ones(len(freq)),
+                                     freq)
+        read, _ = timed(gausssum_file.readGaussSum, fileName)
+        columns = [(xvalues, read[0]), (spectrum, read[1]), (freq, read[2].freq), (freq / 10, read[2].act),
+                   (numpy.arange(1, len(freq) + 1), read[2].mode)]
+        result = compareArrays("readGaussSum", "shortGrid", (xvalues, 0), (read[0], 0), GAUSSSUM_RTOL)
+        result["error"] = max(maxRelativeError(e, a) for e, a in columns)
+        result["passed"] = result["error"] <= GAUSSSUM_RTOL and labels.tolist() == read[2].label.tolist()
+        yield result
+
+
+CHECKS = [checkBroadening, checkIntensity, checkPeaks, checkJcamp, checkGaussSum]
+
+
+def runChecks(seeds=10, seed=0):
+    rng = numpy.random.default_rng(seed)
+    results = []
+    for check in CHECKS:
+        for result in check(rng, seeds):
+            result["speedup"] = result["referenceTime"] / result["fastTime"] if result["fastTime"] > 0 else None
+            results.append(result)
+            speedup = f"{result['speedup']:8.1f}x" if result["speedup"] is not None else "       -"
+            print(f"{result['routine']:22s} {result['case']:10s} error {result['error']:9.2e} "
+                  f"(tolerance {result['tolerance']:7.1e}) {'ok  ' if result['passed'] else 'FAIL'} {speedup}")
+    return results
+
+
+def summarize(results):
+    """Per routine pass count and median speedup"""
+    summary = {}
+    for routine in dict.fromkeys(r["routine"] for r in results):
+        rows = [r for r in results if r["routine"] == routine]
+        speedups = [r["speedup"] for r in rows if r["speedup"] is not None]
+        summary[routine] = {
+            "cases": len(rows),
+            "passed": sum(r["passed"] for r in rows),
+            "maxError": max(r["error"] for r in rows),
+            "medianSpeedup": float(numpy.median(speedups)) if speedups else None,
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the production routines with the frozen reference loops")
+    parser.add_argument("--seeds", type=int, default=10, help="random cases per routine (default 10)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random cases")
+    parser.add_argument("--output", help="write every comparison to this JSON file")
+    args = parser.parse_args()
+
+    results = runChecks(args.seeds, args.seed)
+    summary = summarize(results)
+
+    print()
+    for routine, s in summary.items():
+        speedup = f"{s['medianSpeedup']:.1f}x" if s["medianSpeedup"] is not None else "-"
+        print(f"{routine:22s} {s['passed']}/{s['cases']} passed, max error {s['maxError']:.2e}, "
+              f"median speedup {speedup}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"seed": args.seed, "summary": summary, "results": results}, f, indent=1)
+
+    if any(not r["passed"] for r in results):
+        sys.exit(1)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the work queue with real workers.
+
+A manifest of copies of the test log is queued in a temporary directory and
+
+    exactlyOnce     two worker processes run against the one queue directory,
+                    every molecule must be claimed, computed and recorded
+                    done exactly once, with nothing left queued or failed
+    staleClaim      a claim is taken by a worker that never heartbeats; it
+                    must be left alone before --stale seconds and then be
+                    reclaimed and computed by a live worker
+
+after each of which merge must find an up to date output for every molecule.
+The script exits with 1 if a check fails:
+
+    python queue_check.py
+    python queue_check.py --molecules 100 --stale 5
+
+@author: aiden
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+IR_DIR = os.path.join(ROOT, "IRSpectra")
+LOG_FILE = os.path.join(ROOT, "test", "1-butylnaptho[2-3-g]isoquinoline.log")
+sys.path.append(IR_DIR)
+
+import ir_spectra
+import work_queue
+
+
+STALE_AFTER = 2.  # seconds, short so the check does not wait long for a claim to go stale
+HEARTBEAT = .2
+WORKER_TIMEOUT = 120.  # seconds before a worker that has not finished is killed and the check fails
+
+
+def writeManifest(directory, nmolecules):
+    """A manifest of nmolecules copies of the test log, returns its file name"""
+    os.makedirs(directory, exist_ok=True)
+    manifestFile = os.path.join(directory, "project.json")
+    with open(manifestFile, "w") as f:
+        json.dump({"output": "project.xlsx", "workDir": "out", "parseCacheDir": "parse_cache",
+                   "molecules": {f"molecule{i:03d}": {"input": LOG_FILE} for i in range(nmolecules)}}, f, indent=1)
+    # parsed once here so the workers do not all parse the log at the same time
+    ir_spectra.parseLog(LOG_FILE, os.path.join(directory, "parse_cache"))
+    return manifestFile
+
+
+def claimCounts(paths):
+    """{molecule: claims} from the attempts directory, which gets one file per claim"""
+    counts = {}
+    for fileName in os.listdir(paths["attempts"]):
+        molecule = fileName.rsplit("@", 1)[0]
+        counts[molecule] = counts.get(molecule, 0) + 1
+    return counts
+
+
+def queueProblems(manifestFile, molecules, expectedClaims):
+    """What is wrong with a queue that should have finished, expectedClaims is {molecule: claims}"""
+    queueDir = work_queue.queueDirectory(manifestFile)
+    paths = work_queue.queuePaths(queueDir)
+    status = work_queue.queueStatus(manifestFile)
+    problems = [f"{len(status[name])} {name}" for name in ["tasks", "claimed", "failed"] if status[name]]
+    if status["done"] != sorted(molecules):
+        problems.append(f"done {len(status['done'])} of {len(molecules)} molecules")
+    claims = claimCounts(paths)
+    wrong = sorted(molecule for molecule in molecules if claims.get(molecule, 0) != expectedClaims.get(molecule, 1))
+    if wrong:
+        problems.append("unexpected claim counts for " + ", ".join(f"{m} ({claims.get(m, 0)})" for m in wrong))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            work_queue.mergeQueue(manifestFile, buildWorkbook=False)
+    except ValueError as e:
+        problems.append(f"merge: {e}")
+    return problems
+
+
+def runWorkers(manifestFile, workerIds, staleAfter, timeout):
+    """
+    Runs a work_queue worker process for each of workerIds on the manifest's
+    queue, returns (problems, {worker: molecules it computed}, {worker: output})
+    """
+    command = [sys.executable, os.path.join(IR_DIR, "work_queue.py"), "worker", manifestFile,
+               "--heartbeat", str(HEARTBEAT), "--stale", str(staleAfter)]
+    processes = {workerId: subprocess.Popen(command + ["--id", workerId], cwd=os.path.dirname(manifestFile),
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                 for workerId in workerIds}
+    problems, outputs = [], {}
+    for workerId, process in processes.items():
+        try:
+            outputs[workerId] = process.communicate(timeout=timeout)[0]
+        except subprocess.TimeoutExpired:
+            process.kill()
+            outputs[workerId] = process.communicate()[0]
+            problems.append(f"{workerId} still running after {timeout} seconds")
+            continue
+        if process.returncode != 0:
+            problems.append(f"{workerId} exited with {process.returncode}:\n{outputs[workerId]}")
+    computed = {workerId: [line.split(" processing ", 1)[1] for line in output.splitlines()
+                           if line.startswith(f"{workerId} processing ")]
+                for workerId, output in outputs.items()}
+    return problems, computed, outputs
+
+
+def checkExactlyOnce(directory, nmolecules, workers=2, timeout=WORKER_TIMEOUT):
+    """Runs workers worker processes on one queue, returns (problems, {worker: molecules computed})"""
+    manifestFile = writeManifest(directory, nmolecules)
+    molecules = work_queue.initQueue(manifestFile, force=True, reset=True)
+    problems, computed, _ = runWorkers(manifestFile, [f"worker{i}" for i in range(workers)], 60., timeout)
+    everything = sorted(molecule for names in computed.values() for molecule in names)
+    if everything != sorted(molecules):
+        problems.append(f"workers computed {len(everything)} molecules ({len(set(everything))} different) "
+                        f"for {len(molecules)} queued")
+    return problems + queueProblems(manifestFile, molecules, {}), computed
+
+
+def checkStaleClaim(directory, nmolecules, staleAfter=STALE_AFTER, timeout=WORKER_TIMEOUT):
+    """Leaves one claim without a heartbeat and runs a live worker, returns (problems, seconds until it finished)"""
+    manifestFile = writeManifest(directory, nmolecules)
+    molecules = work_queue.initQueue(manifestFile, force=True, reset=True)
+    queueDir = work_queue.queueDirectory(manifestFile)
+    paths = work_queue.queuePaths(queueDir)
+    begin = timer()
+    deadClaim = work_queue.claimTask(paths, "deadWorker")
+    deadMolecule, _ = work_queue.claimName(os.path.basename(deadClaim))
+    with open(os.path.join(paths["attempts"], f"{deadMolecule}@deadWorker-{time.time_ns()}"), "w"):
+        pass  # recorded as runWorker does when it claims
+
+    problems = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if work_queue.reclaimStale(queueDir, paths, "checker", staleAfter):
+            problems.append("a fresh claim was reclaimed before it went stale")
+    workerProblems, computed, outputs = runWorkers(manifestFile, ["liveWorker"], staleAfter, staleAfter + timeout)
+    elapsed = timer() - begin
+    problems += workerProblems
+
+    if f"Reclaimed {deadMolecule} from deadWorker" not in outputs["liveWorker"]:
+        problems.append(f"{deadMolecule} was not reclaimed from deadWorker")
+    if elapsed < staleAfter:
+        problems.append(f"finished after {elapsed:.2f} seconds, before the claim could go stale")
+    if sorted(computed["liveWorker"]) != sorted(molecules):
+        problems.append(f"the live worker computed {len(computed['liveWorker'])} of {len(molecules)} molecules")
+    if os.path.exists(deadClaim):
+        problems.append("the dead worker's claim is still there")
+    doneFile = os.path.join(paths["done"], deadMolecule + ".json")
+    if os.path.exists(doneFile) and work_queue.readJson(doneFile).get("worker") != "liveWorker":
+        problems.append(f"{deadMolecule} is recorded done by {work_queue.readJson(doneFile).get('worker')}")
+    # claimed once by the dead worker and once by the live one
+    return problems + queueProblems(manifestFile, molecules, {deadMolecule: 2}), elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs workers against a work queue and checks every molecule is "
+                                                 "computed exactly once")
+    parser.add_argument("--molecules", type=int, default=40, help="molecules queued (default 40)")
+    parser.add_argument("--stale", type=float, default=STALE_AFTER,
+                        help=f"seconds without a heartbeat before a claim is taken back (default {STALE_AFTER})")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        problems, computed = checkExactlyOnce(os.path.join(directory, "exactlyOnce"), args.molecules)
+        split = ", ".join(f"{worker} {len(names)}" for worker, names in computed.items())
+        print(f"{'exactlyOnce':12s} {'; '.join(problems) if problems else 'ok'}  ({split})")
+        failed = failed or bool(problems)
+
+        problems, elapsed = checkStaleClaim(os.path.join(directory, "staleClaim"), args.molecules, args.stale)
+        print(f"{'staleClaim':12s} {'; '.join(problems) if problems else 'ok'}  (finished after {elapsed:.2f} s, "
+              f"stale after {args.stale} s)")
+        failed = failed or bool(problems)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frozen reference implementations.
+
+These are the original pure python loops, kept exactly as they were so that
+faster versions can be checked against them (see equivalence.py). Do not
+optimise or otherwise change them, that is the point.
+
+@author: aiden
+"""
+
+import math
+
+import numpy
+
+
+# IRSpectra/ir_spectra.py and RamanSpectra/raman_spectra.py
+def broadenSpectrum(start, end, numpts, peaks, width, formula):
+    """
+    Broadens spectrum data. Creates a distribution function around
+    each peak (pos, height) and adds up the contributions from each
+    distribution over numpts from start to end to create a spectrum
+    that looks closer to one obtained by experiment
+
+
+    formula is a function such as gaussianpeak or delta
+    """
+    spectrum = numpy.zeros(numpts,"d")
+    xvalues = numpy.linspace(start, end, numpts)
+    for i in range(numpts):
+        x = xvalues[i]
+        for pos, height in peaks:
+            spectrum[i] = spectrum[i] + formula(x, pos, height, width)
+
+    return xvalues, spectrum
+
+
+def lorentzian(x, peak, height, width):
+    """The lorentzian curve.
+
+    f(x) = a/(1+a)
+
+    where a is FWHM**2/4
+    """
+    a = width**2./4.
+    return float(height)*a/( (peak-x)**2 + a )
+
+
+# RamanSpectra/raman_spectra.py
+def activity_to_intensity(activity, frequency, excitation, temperature):
+    """Convert Raman acitivity to Raman intensity according to
+    Krishnakumar et al, J. Mol. Struct., 2004, 702, 9."""
+
+    excitecm = 1 / (1e-7 * excitation)
+    f = 1e-13
+    above = f * (excitecm - frequency)**4 * activity
+    exponential = -6.626068e-34 * 299792458 * frequency / (1.3806503e-23 * temperature)
+    below = frequency * (1 - math.exp(exponential))
+    return above / below
+
+
+# IRSpectra/main.py, with INCLUDE_ALL_LOCAL_MAX_RANGES passed in and the plot removed
+def mean(data):
+    return sum(data) / len(data)
+
+def stdev(data):
+    m = mean(data)
+    s = 0
+    for d in data:
+        s += (d - m)**2
+
+    return math.sqrt(s / len(data))
+
+def getWindow(data, center, sideLength):
+    if center + sideLength < len(data) and center - sideLength > 0:
+        return data[center - sideLength : center + sideLength + 1]
+    elif center + sideLength >= len(data):
+        return data[len(data) - 1 - sideLength * 2:]
+    else:
+        return data[0:sideLength * 2 + 1]
+
+def isLocalMax(data, i):
+    if i > 0 and i < len(data) - 1:
+        return (data[i] > data[i + 1] and data[i] > data[i - 1])
+    else:
+        return False
+
+def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass, INCLUDE_ALL_LOCAL_MAX_RANGES):
+    peaks = []
+    lastPeakIndex = -1
+    for i in range(len(dataY)):
+        if dataX[i] > max_x:  # data from highest to lowest and reversing
+                               # will mess up indexing, so just skip it
+            continue
+
+
+        # peak was not added, so check to see if is in one of the include-all-local-max
+        # regions
+        xVal = dataX[i]
+        if any([xVal > r[0] and xVal < r[1] for r in INCLUDE_ALL_LOCAL_MAX_RANGES]):
+            if isLocalMax(dataY, i):
+                peaks.append(i)
+                lastPeakIndex = -1  # reset to negative number so no coalesce
+                continue
+
+
+        window = getWindow(dataY, i, windowSize)
+        m = mean(window)
+        s = stdev(window)
+
+        # potential peak, so make sure it is not too close to another peak
+        if dataY[i] - m > nsigma * s and dataY[i] > highPass:
+            if lastPeakIndex > 0:  # there is a previous peak
+                if i - lastPeakIndex < coalesceWindow:  # choose maximum if within window
+                    if dataY[i] > dataY[lastPeakIndex]:
+                        peaks[-1] = i
+                        lastPeakIndex = i
+                    # no changes made otherwise
+                else:
+                    peaks.append(i)
+                    lastPeakIndex = i
+            else:
+                peaks.append(i)
+                lastPeakIndex = i
+
+    return peaks
+
+
+# JCAMPFileConversion/jcamp_file_converter.py, the inline parser as a function
+def parseJcamp(JCAMP_FILE):
+    x_data_expr = []
+    y_data_expr = []
+
+    delta_x = -1
+    x_factor = -1
+    y_factor = -1
+    n_points = -1  # sanity checks to make sure everything was read correctly
+    last_x = -1
+    first_y = -1
+
+
+    with open(JCAMP_FILE, "r") as f:
+        for line in f.readlines():
+            if line.startswith("##"):  # reading a comment or some other meta data. try to find the important stuff
+                if "XFACTOR" in line:
+                    x_factor = float(line.split("=")[-1])
+                elif "YFACTOR" in line:
+                    y_factor = float(line.split("=")[-1])
+                elif "DELTAX" in line:
+                    delta_x = float(line.split("=")[-1])
+                elif "NPOINTS" in line:
+                    n_points = int(line.split("=")[-1])
+                elif "LASTX" in line:
+                    last_x = float(line.split("=")[-1])
+                elif "FIRSTY" in line:
+                    first_y = float(line.split("=")[-1])
+
+            elif line[0].isnumeric():  # make sure reading a number
+                data = [float(i) for i in line.strip().split(" ")]
+                x = data[0]
+                for y in data[1:]:
+                    x_data_expr.append(x)
+                    y_data_expr.append(y)
+                    x += delta_x
+
+
+    # error checking, make sure file was parsed correctly
+
+    if any(item == -1 for item in [delta_x, x_factor, y_factor, n_points, last_x, first_y]):
+        raise ValueError("Could not read metadata correctly")
+    if n_points != len(x_data_expr):
+        raise ValueError("Did not parse correct number of data points")
+
+    x_data_expr = [i * x_factor for i in x_data_expr]
+    y_data_expr = [i * y_factor for i in y_data_expr]
+
+    if last_x != x_data_expr[-1]:
+        raise ValueError("Last x value does not match expected from file")
+
+    tolerance = 0.01  # y value must match within 1% (tolerance due to floating point representation)
+    if first_y > y_data_expr[0] * (1 + tolerance) or first_y < y_data_expr[0] * (1 - tolerance):
+        raise ValueError("First y value does not match expected from file")
+
+    return x_data_expr, y_data_expr
+
+
+# IRSpectra/main.py, the inline .out reader as a function
+def readOutputFile(fileName):
+    freqData = []
+    irData = []
+    modes = []
+    labels = []
+    modeFreqs = []
+    modeIR = []
+    scalingFactors = []
+    unscaledFreq = []
+
+    with open(fileName, "r") as f:
+        for line in f.readlines()[2:]:
+            data = line.split("\t")
+            freqData.append(float(data[0]))
+            irData.append(float(data[1]))
+            if len(data) > 3:
+                modes.append(int(data[3]))
+                labels.append(data[4])
+                modeFreqs.append(float(data[5]))
+                modeIR.append(float(data[6]))
+                scalingFactors.append(float(data[7]))
+                unscaledFreq.append(float(data[8]))
+
+    return freqData, irData, modes, labels, modeFreqs, modeIR, scalingFactors, unscaledFreq
+
+
+# JCAMPFileConversion/jcamp_file_converter.py, the inline theoretical data parser as a function
+def parseTheoretical(THEORETICAL_DATA_FILE):
+    x_data_theor = []
+    y_data_theor = []
+
+    with open(THEORETICAL_DATA_FILE, "r") as f:
+        for line in f.readlines():
+            # define first line as the first one that is numeric, this is brittle and sketchy but seems to 
+            # be a valid assumption.
+            if line[0].isnumeric():
+                data = line.split("\t")
+                x_data_theor.append(float(data[0]))
+                y_data_theor.append(float(data[1]))
+
+    return x_data_theor, y_data_theor
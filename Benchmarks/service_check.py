@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the spectra service and its JSON API.
+
+A SpectraService watches a temporary directory and its API is served on a
+free localhost port. The test log is copied in, along with a log that
+cannot be parsed, and the checks go through the API:
+
+    process     the log is left alone until it has stopped changing for a
+                poll, then its .out, .npz and .peaks.json are written and
+                /status lists it, with the broken log under its errors
+    molecule    /molecules/<name> matches the .peaks.json written
+    spectrum    GET /spectrum with no overrides matches the .npz written,
+                with overrides (and POST /spectrum with the same in its
+                body) is the spectrum broadened with those parameters
+    errors      unknown molecules and paths give 404, unknown parameters
+                and bodies that are not JSON give 400
+    changed     touching the log processes it again on the next polls
+    deleted     a request for a deleted log gets a JSON 500 rather than a
+                dropped connection, and after the next poll the molecule is
+                no longer listed (404)
+
+The script exits with 1 if a check fails:
+
+    python service_check.py
+
+@author: aiden
+"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+
+import numpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LOG_FILE = os.path.join(ROOT, "test", "1-butylnaptho[2-3-g]isoquinoline.log")
+sys.path.append(os.path.join(ROOT, "IRSpectra"))
+
+import batch_runner
+import ir_spectra
+import spectra_service
+
+
+MOLECULE = "isoquinoline"
+OVERRIDES = {"fwhm": 4, "numpts": 2000}
+
+
+def request(url, body=None, data=None):
+    """(status, decoded JSON) of a GET, or of a POST of body as JSON (or of the raw bytes data)"""
+    if body is not None:
+        data = json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data), timeout=60) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def expectedSpectrum(inputFile, parameters, parseCacheDir):
+    """(xvalues, spectrum) of inputFile broadened with the batch_runner parameters, outside the service"""
+    p = {**batch_runner.DEFAULT_PARAMETERS, **parameters}
+    modes = ir_spectra.scaledModes(ir_spectra.parseLog(inputFile, parseCacheDir),
+                                   batch_runner.scaleTableFunction(p["scaleFactors"]))
+    return ir_spectra.broadenSticks(*modes.sticks(), p["start"], p["end"], p["numpts"], p["fwhm"], p["gridTolerance"],
+                                    p["autoTolerance"])
+
+
+def sameSpectrum(answer, xvalues, spectrum):
+    return (len(answer["x"]) == len(xvalues) and numpy.allclose(answer["x"], xvalues, rtol=1e-12, atol=0)
+            and numpy.allclose(answer["y"], spectrum, rtol=1e-12, atol=0))
+
+
+def runChecks(directory):
+    """Returns [(check, [problems])]"""
+    watchDir = os.path.join(directory, "logs")
+    outputDir = os.path.join(directory, "spectra")
+    parseCacheDir = os.path.join(directory, "parse_cache")
+    os.makedirs(watchDir)
+    service = spectra_service.SpectraService(watchDir, outputDir, parseCacheDir=parseCacheDir)
+    server = spectra_service.serve(service, port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    results = []
+    try:
+        inputFile = os.path.join(watchDir, MOLECULE + ".log")
+        shutil.copy(LOG_FILE, inputFile)
+        with open(os.path.join(watchDir, "broken.log"), "w") as f:
+            f.write("not a Gaussian or ORCA log\n")
+
+        problems = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            first = service.poll()
+            second = service.poll()
+        if first:
+            problems.append(f"processed {', '.join(first)} before they had stopped changing")
+        if second != [MOLECULE]:
+            problems.append(f"the second poll processed {second}, not {[MOLECULE]}")
+        base = os.path.join(outputDir, MOLECULE)
+        problems += [f"no {base + ending}" for ending in [".out", ".npz", ".peaks.json"]
+                     if not os.path.exists(base + ending)]
+        status, answer = request(url + "/status")
+        if status != 200 or list(answer.get("molecules", {})) != [MOLECULE] or answer.get("pending"):
+            problems.append(f"/status gave {status} with molecules {list(answer.get('molecules', {}))} and pending "
+                            f"{answer.get('pending')}")
+        if list(answer.get("errors", {})) != [os.path.join(service.watchDir, "broken.log")]:
+            problems.append(f"/status errors are {answer.get('errors')}")
+        results.append(("process", problems))
+
+        problems = []
+        status, answer = request(f"{url}/molecules/{MOLECULE}")
+        with open(base + ".peaks.json", "r") as f:
+            written = json.load(f)
+        if status != 200 or answer.get("peaks") != [peak["wavenumber"] for peak in written["peaks"]]:
+            problems.append(f"/molecules/{MOLECULE} gave {status} with peaks {answer.get('peaks')}")
+        if status == 200 and answer["outputs"]["npz"] != base + ".npz":
+            problems.append(f"/molecules/{MOLECULE} lists {answer['outputs']['npz']} as its .npz")
+        results.append(("molecule", problems))
+
+        problems = []
+        saved = numpy.load(base + ".npz")
+        status, answer = request(f"{url}/spectrum?molecule={MOLECULE}")
+        if status != 200 or not sameSpectrum(answer, saved["xvalues"], saved["spectrum"]):
+            problems.append(f"GET /spectrum gave {status}, not the spectrum written to {base}.npz")
+        elif [peak["wavenumber"] for peak in answer["peaks"]] != [peak["wavenumber"] for peak in written["peaks"]]:
+            problems.append("GET /spectrum gave other peaks than those written")
+        xvalues, spectrum = expectedSpectrum(inputFile, OVERRIDES, parseCacheDir)
+        query = "&".join(f"{key}={value}" for key, value in OVERRIDES.items())
+        status, answer = request(f"{url}/spectrum?molecule={MOLECULE}&{query}")
+        if status != 200 or not sameSpectrum(answer, xvalues, spectrum):
+            problems.append(f"GET /spectrum with {OVERRIDES} gave {status}, not the spectrum with those parameters")
+        status, posted = request(url + "/spectrum", {"molecule": MOLECULE, "parameters": OVERRIDES})
+        if status != 200 or not sameSpectrum(posted, xvalues, spectrum) or posted["peaks"] != answer.get("peaks"):
+            problems.append(f"POST /spectrum with {OVERRIDES} gave {status}, not the same as GET")
+        results.append(("spectrum", problems))
+
+        problems = []
+        for path, body, data, expected in [("/molecules/unknown", None, None, 404),
+                                           ("/spectrum?molecule=unknown", None, None, 404),
+                                           ("/nowhere", None, None, 404),
+                                           (f"/spectrum?molecule={MOLECULE}&bogus=1", None, None, 400),
+                                           ("/spectrum", {"molecule": MOLECULE, "parameters": {"bogus": 1}}, None,
+                                            400),
+                                           ("/spectrum", None, b"{not json", 400)]:
+            status, answer = request(url + path, body, data)
+            if status != expected or "error" not in answer:
+                problems.append(f"{'POST' if body or data else 'GET'} {path} gave {status}, not {expected}")
+        results.append(("errors", problems))
+
+        problems = []
+        before = service.molecule(MOLECULE)["updated"]
+        stat = os.stat(inputFile)
+        os.utime(inputFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with contextlib.redirect_stdout(io.StringIO()):
+            processed = service.poll() + service.poll()
+        status, answer = request(f"{url}/molecules/{MOLECULE}")
+        if processed != [MOLECULE] or status != 200 or answer["updated"] <= before:
+            problems.append(f"the polls after touching the log processed {processed}")
+        results.append(("changed", problems))
+
+        problems = []
+        os.remove(inputFile)
+        ir_spectra.forgetParse(inputFile)  # as if the service had restarted, so the log has to be read
+        with contextlib.redirect_stdout(io.StringIO()):
+            # until the next poll the molecule is still listed but its log cannot be read
+            status, answer = request(f"{url}/spectrum?molecule={MOLECULE}")
+            if status != 500 or "error" not in answer:
+                problems.append(f"GET /spectrum for a deleted log gave {status} before the poll, not 500")
+            service.poll()
+        status, answer = request(f"{url}/spectrum?molecule={MOLECULE}")
+        if status != 404:
+            problems.append(f"GET /spectrum for a deleted log gave {status} after the poll, not 404")
+        status, answer = request(url + "/status")
+        if status != 200 or answer.get("molecules"):
+            problems.append(f"/status still lists {list(answer.get('molecules', {}))} after the log was deleted")
+        results.append(("deleted", problems))
+    finally:
+        server.shutdown()
+        service.close()
+    return results
+
+
+if __name__ == "__main__":
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for check, problems in runChecks(directory):
+            print(f"{check:10s} {'; '.join(problems) if problems else 'ok'}")
+            failed = failed or bool(problems)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup time of the IR and Raman scripts.
+
+Each case runs in a fresh interpreter, the way the drivers are run, and is
+timed from launch to exit:
+
+    import          importing the modules main.py imports
+    cachedRun       a run that hits the parse and spectrum caches and only
+                    writes the .out file and finds its peaks (main.py with
+                    OUTPUT_EXCEL_FILE = None)
+    ramanImport     the Raman main.py up to where it starts processing, its
+                    imports and settings
+    ramanCachedRun  the GaussSum stage of the Raman main.py on an activity
+                    file, hitting the spectrum cache and writing the .out file
+
+matplotlib, cclib, openpyxl and scipy are only imported by the stages that
+need them, so no case should load any of them (the Raman main.py always
+writes a workbook, which loads openpyxl after these stages). The script exits with 1
+if one does or a case takes longer than --limit seconds:
+
+    python startup.py
+    python startup.py --repeat 10 --limit 0.5
+
+@author: aiden
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+IR_DIR = os.path.join(ROOT, "IRSpectra")
+RAMAN_DIR = os.path.join(ROOT, "RamanSpectra")
+LOG_FILE = os.path.join(ROOT, "test", "1-butylnaptho[2-3-g]isoquinoline.log")
+
+HEAVY_MODULES = ["matplotlib", "cclib", "openpyxl", "scipy"]
+STARTUP_LIMIT = 1.  # seconds
+
+IMPORTS = "import ir_spectra, ensemble, spectrum_store, spectrum_cache, peak_finding, workbook, previews, instrumentation"
+
+CACHED_RUN = IMPORTS + """
+cache = spectrum_cache.SpectrumCache("spectrum_cache")
+ir_spectra.irSpectra(LOG_FILE, "molecule.out", 8, 4000, 500, 10, lambda f: .97, "parse_cache", spectrumCache=cache)
+freqData, irData, modes = workbook.readOutputFile("molecule.out")
+peak_finding.findPeaks([10000 / x for x in freqData], irData, 25, 20, .5, 9, 9, "molecule", False)
+"""
+
+# the imports and settings of the Raman main.py, everything before it starts processing
+RAMAN_IMPORTS = """
+import os
+sys.path.insert(0, RAMAN_DIR)
+with open(os.path.join(RAMAN_DIR, "main.py"), "r") as f:
+    exec(f.read().split("# anything below this line")[0])
+"""
+
+RAMAN_CACHED_RUN = RAMAN_IMPORTS + """
+cache = spectrum_cache.SpectrumCache("spectrum_cache")
+raman_spectra.ramanSpectra("raman.dat", "raman.out", 8, 4000, 500, 10, lambda f: .97, 785, 293.15, "parse_cache",
+                           spectrumCache=cache)
+"""
+
+# an activity file of 120 modes for the Raman cached run to read
+RAMAN_SETUP = """
+with open("raman.dat", "w") as f:
+    f.write("Mode\\tFreq\\tActivity\\n")
+    for i in range(1, 121):
+        f.write(f"{i}\\t{30 * i}\\t{i % 7 + 1}\\n")
+""" + RAMAN_CACHED_RUN
+
+# appended to every case, reports which heavy modules were loaded
+REPORT = """
+import json, sys
+print(json.dumps([m for m in HEAVY_MODULES if m in sys.modules]))
+"""
+
+
+def childCode(body):
+    return (f"import sys\nsys.path.insert(0, {IR_DIR!r})\nRAMAN_DIR = {RAMAN_DIR!r}\nLOG_FILE = {LOG_FILE!r}\n"
+            f"HEAVY_MODULES = {HEAVY_MODULES!r}\n" + body + REPORT)
+
+
+def runChild(body, workDir):
+    """Runs body in a new interpreter in workDir, returns (seconds, heavy modules it loaded)"""
+    begin = timer()
+    result = subprocess.run([sys.executable, "-c", childCode(body)], cwd=workDir, capture_output=True, text=True)
+    elapsed = timer() - begin
+    if result.returncode != 0:
+        raise RuntimeError(f"startup case failed:\n{result.stderr}")
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def cases():
+    """(name, body, setup body run once untimed to fill the caches)"""
+    return [("import", IMPORTS, None), ("cachedRun", CACHED_RUN, CACHED_RUN),
+            ("ramanImport", RAMAN_IMPORTS, None), ("ramanCachedRun", RAMAN_CACHED_RUN, RAMAN_SETUP)]
+
+
+def measure(repeat=5):
+    """Returns {case: {"min", "median", "max", "loaded"}} with times in seconds"""
+    results = {}
+    with tempfile.TemporaryDirectory() as workDir:
+        for name, body, setup in cases():
+            if setup is not None:
+                runChild(setup, workDir)
+            times = []
+            loaded = set()
+            for _ in range(repeat):
+                elapsed, heavy = runChild(body, workDir)
+                times.append(elapsed)
+                loaded.update(heavy)
+            results[name] = {"min": min(times), "median": statistics.median(times), "max": max(times),
+                             "loaded": sorted(loaded)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times starting the IR and Raman scripts in a fresh interpreter")
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each case (default 5)")
+    parser.add_argument("--limit", type=float, default=STARTUP_LIMIT,
+                        help=f"fail if a case takes longer than this many seconds (default {STARTUP_LIMIT})")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    # python itself, for comparison
+    with tempfile.TemporaryDirectory() as directory:
+        interpreter = min(runChild("", directory)[0] for _ in range(args.repeat))
+    print(f"{'interpreter':15s} {interpreter * 1e3:8.1f} ms")
+
+    results = measure(args.repeat)
+    failed = False
+    for name, result in results.items():
+        problems = []
+        if result["median"] > args.limit:
+            problems.append(f"slower than {args.limit} s")
+        if result["loaded"]:
+            problems.append("loaded " + ", ".join(result["loaded"]))
+        failed = failed or bool(problems)
+        print(f"{name:15s} {result['median'] * 1e3:8.1f} ms  {'; '.join(problems) if problems else 'ok'}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"interpreter": interpreter, "limit": args.limit, "results": results}, f, indent=1)
+
+    if failed:
+        sys.exit(1)
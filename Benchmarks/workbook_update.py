@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cost of updating a workbook against rebuilding it.
+
+A workbook of synthetic molecules is built and saved with its chart series
+(workbook.saveWorkbook), then one molecule is changed and another removed
+and the two ways of getting the new workbook are timed:
+
+    rebuild     buildWorkbook and saveWorkbook with every molecule
+    update      updateWorkbook with only the changed molecule, on a fresh
+                copy of the saved workbook each run
+
+The updated workbook is checked against the rebuilt one part by part (only
+the creation time in docProps/core.xml may differ). The script exits with 1
+if they differ or an update takes longer than --ratio times a rebuild:
+
+    python workbook_update.py
+    python workbook_update.py --molecules 200 --ratio .5
+
+@author: aiden
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import zipfile
+
+import benchmark
+import workbook
+
+
+UPDATE_RATIO = 1.  # an update must cost less than this fraction of a rebuild
+# parts allowed to differ between an updated and a rebuilt workbook
+VOLATILE_PARTS = {"docProps/core.xml"}
+
+
+def moleculeData(nmolecules, numpts):
+    return {f"molecule{i}": benchmark.syntheticMolecule(120, numpts, seed=i) for i in range(nmolecules)}
+
+
+def saveCopy(source, target):
+    """Copies a workbook and its series, keeping the times the series are checked against"""
+    shutil.copy2(source, target)
+    shutil.copy2(workbook.seriesFileName(source), workbook.seriesFileName(target))
+
+
+def differentParts(fileName, otherFileName):
+    """Parts of two xlsx files that are missing from one or differ, apart from VOLATILE_PARTS"""
+    with zipfile.ZipFile(fileName) as first, zipfile.ZipFile(otherFileName) as second:
+        names = set(first.namelist()) | set(second.namelist())
+        return sorted(name for name in names - VOLATILE_PARTS
+                      if name not in first.namelist() or name not in second.namelist()
+                      or first.read(name) != second.read(name))
+
+
+def measure(nmolecules=60, numpts=500, repeat=3):
+    """Returns {"rebuild", "update": {"min", "median", "max"}, "differences": [parts]} with times in seconds"""
+    data = moleculeData(nmolecules, numpts)
+    changed = {"molecule1": benchmark.syntheticMolecule(120, numpts, seed=nmolecules)}
+    removed = ["molecule0"]
+    final = {name: changed.get(name, molecule) for name, molecule in data.items() if name not in removed}
+
+    with tempfile.TemporaryDirectory() as directory:
+        original = os.path.join(directory, "original.xlsx")
+        rebuilt = os.path.join(directory, "rebuilt.xlsx")
+        updated = os.path.join(directory, "updated.xlsx")
+        workbook.saveWorkbook(workbook.buildWorkbook(data, 100), original, workbook.moleculeSeries(data))
+
+        def rebuild():
+            workbook.saveWorkbook(workbook.buildWorkbook(final, 100), rebuilt, workbook.moleculeSeries(final))
+
+        def update():
+            workbook.updateWorkbook(updated, changed, removed)
+
+        rebuildTimes = benchmark.timeIt(rebuild, repeat)
+        updateTimes = benchmark.timeIt(update, repeat, lambda: saveCopy(original, updated))
+        differences = differentParts(updated, rebuilt)
+
+    def summary(times):
+        return {"min": min(times), "median": statistics.median(times), "max": max(times)}
+    return {"rebuild": summary(rebuildTimes), "update": summary(updateTimes), "differences": differences}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times updating one molecule of a workbook against rebuilding it")
+    parser.add_argument("--molecules", type=int, default=60, help="molecules in the workbook (default 60)")
+    parser.add_argument("--points", type=int, default=500, help="spectrum points per molecule (default 500)")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each case (default 3)")
+    parser.add_argument("--ratio", type=float, default=UPDATE_RATIO,
+                        help=f"fail if an update takes longer than this times a rebuild (default {UPDATE_RATIO})")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = measure(args.molecules, args.points, args.repeat)
+    rebuildTime = results["rebuild"]["median"]
+    updateTime = results["update"]["median"]
+    print(f"{'rebuild':8s} {rebuildTime:8.2f} s")
+    print(f"{'update':8s} {updateTime:8.2f} s  {updateTime / rebuildTime:.2f}x of a rebuild")
+
+    failed = False
+    if updateTime > args.ratio * rebuildTime:
+        print(f"update slower than {args.ratio} x rebuild")
+        failed = True
+    if results["differences"]:
+        print("updated workbook differs from the rebuilt one in " + ", ".join(results["differences"]))
+        failed = True
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"molecules": args.molecules, "points": args.points, "ratio": args.ratio, **results}, f,
+                      indent=1)
+
+    if failed:
+        sys.exit(1)
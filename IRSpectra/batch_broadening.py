@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Broadens many stick spectra onto the same grid at once.
+
+The sticks of every spectrum are stored concatenated (positions, heights)
+with offsets marking where each spectrum starts, the same layout as a CSR
+sparse matrix: the sticks of spectrum i are positions[offsets[i]:offsets[i + 1]]
+
+@author: aiden
+"""
+
+import numpy
+from numpy.lib.format import open_memmap
+
+
+MEMORY_BUDGET = 2**20      # bytes of temporary kernel memory per chunk, kept
+                           # small so the kernel stays in cache
+
+
+def packSpectra(spectra):
+    """
+    Packs a list of (freqs, heights) pairs into the concatenated layout.
+    Returns (positions, heights, offsets)
+    """
+    counts = [len(freqs) for freqs, _ in spectra]
+    offsets = numpy.zeros(len(spectra) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(counts)
+    if not spectra:
+        return numpy.zeros(0), numpy.zeros(0), offsets
+
+    positions = numpy.concatenate([numpy.asarray(freqs, dtype="d") for freqs, _ in spectra])
+    heights = numpy.concatenate([numpy.asarray(h, dtype="d") for _, h in spectra])
+    return positions, heights, offsets
+
+
+def createOutput(fileName, nspectra, numpts, dtype="d"):
+    """
+    Creates a (nspectra x numpts) memory mapped .npy file to broaden into,
+    so batches larger than memory can be written straight to disk
+    """
+    return open_memmap(fileName, mode="w+", dtype=dtype, shape=(nspectra, numpts))
+
+
+def _spectrumChunks(offsets, numpts, memoryBudget):
+    """
+    Yields (first, last) spectrum ranges whose kernels fit in memoryBudget.
+    A spectrum with more sticks than fit on its own gets a chunk to itself
+    and its grid is split up later instead
+    """
+    maxSticks = max(1, memoryBudget // (8 * numpts))
+    first = 0
+    nspectra = len(offsets) - 1
+    while first < nspectra:
+        last = numpy.searchsorted(offsets, offsets[first] + maxSticks, side="right") - 1
+        last = min(max(last, first + 1), nspectra)
+        yield first, last
+        first = last
+
+
+def _weightedKernel(xvalues, positions, heights, width):
+    """
+    (sticks x points) matrix of lorentzians scaled by their heights, built in
+    place to avoid temporaries
+    """
+    a = width**2./4.
+    kernel = numpy.subtract.outer(positions, xvalues)
+    numpy.multiply(kernel, kernel, out=kernel)
+    kernel += a
+    numpy.divide((a * heights)[:, None], kernel, out=kernel)
+    return kernel
+
+
+def broadenBatch(xvalues, positions, heights, offsets, width, out=None, memoryBudget=MEMORY_BUDGET):
+    """
+    Broadens every spectrum in the concatenated layout with a lorentzian of
+    FWHM width onto xvalues. Returns a (spectra x len(xvalues)) array.
+
+    out can be a preallocated array or memory map (see createOutput) of that
+    shape and any float dtype. Work is done in chunks of spectra so that the
+    temporary kernel stays within memoryBudget bytes
+    """
+    xvalues = numpy.asarray(xvalues, dtype="d")
+    positions = numpy.asarray(positions, dtype="d")
+    heights = numpy.asarray(heights, dtype="d")
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    nspectra = len(offsets) - 1
+    numpts = len(xvalues)
+
+    if out is None:
+        out = numpy.zeros((nspectra, numpts))
+    elif out.shape != (nspectra, numpts):
+        raise ValueError(f"out has shape {out.shape}, expected {(nspectra, numpts)}")
+
+    for first, last in _spectrumChunks(offsets, numpts, memoryBudget):
+        lo, hi = offsets[first], offsets[last]
+        counts = numpy.diff(offsets[first:last + 1])
+        nonEmpty = counts > 0
+        if not nonEmpty.any():
+            out[first:last] = 0.
+            continue
+
+        # reduceat sums the kernel rows of each spectrum; empty spectra would
+        # pick up their neighbour's row so they are left out and zeroed
+        starts = (offsets[first:last] - lo)[nonEmpty]
+        gridChunk = max(1, memoryBudget // (8 * max(1, hi - lo)))
+        result = numpy.zeros((last - first, numpts))
+        for g in range(0, numpts, gridChunk):
+            kernel = _weightedKernel(xvalues[g:g + gridChunk], positions[lo:hi], heights[lo:hi], width)
+            result[nonEmpty, g:g + gridChunk] = numpy.add.reduceat(kernel, starts, axis=0)
+        out[first:last] = result
+
+    if isinstance(out, numpy.memmap):
+        out.flush()
+    return out
+
+
+def randomSticks(nspectra, modesPerSpectrum, start, end, seed=0):
+    """Random stick spectra in the concatenated layout, for measuring throughput"""
+    rng = numpy.random.default_rng(seed)
+    counts = rng.integers(modesPerSpectrum // 2, modesPerSpectrum * 3 // 2 + 1, nspectra)
+    offsets = numpy.zeros(nspectra + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(counts)
+    positions = rng.uniform(start, end, offsets[-1])
+    heights = rng.exponential(50., offsets[-1])
+    return positions, heights, offsets
+
+
+def measureThroughput(nspectra, modesPerSpectrum, start, end, numpts, width, memoryBudget=MEMORY_BUDGET):
+    """
+    Broadens nspectra random spectra and returns the throughput in spectra
+    per second
+    """
+    from timeit import default_timer as timer
+
+    positions, heights, offsets = randomSticks(nspectra, modesPerSpectrum, start, end)
+    xvalues = numpy.linspace(start, end, numpts)
+    begin = timer()
+    broadenBatch(xvalues, positions, heights, offsets, width, memoryBudget=memoryBudget)
+    return nspectra / (timer() - begin)
+
+
+if __name__ == "__main__":
+    start = 8
+    end = 4000
+    numpts = 500
+    FWHM = 10
+
+    for nspectra in [100, 1000, 5000]:
+        rate = measureThroughput(nspectra, 120, start, end, numpts, FWHM)
+        print(f"{nspectra} spectra of ~120 modes on {numpts} points: {rate:.0f} spectra/s")
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifest driven batch runs.
+
+A JSON manifest lists the molecules, their input files and the broadening
+parameters, so large projects do not need main.py edited for each run:
+
+    {
+        "output": "project.xlsx",
+        "workDir": "out",
+        "parameters": {"start": 8, "end": 4000, "numpts": 500, "fwhm": 10},
+        "parameterSets": {"fine": {"numpts": 4000, "fwhm": 4}},
+        "molecules": {
+            "isoquinoline1": {"input": "../test/1-butylnaptho[2-3-g]isoquinoline.log"},
+            "conformers": {"conformers": ["confA.log", "confB.log"], "parameterSet": "fine"}
+        }
+    }
+
+Relative paths are relative to the manifest. Each molecule's fingerprint is a
+hash of its input files and parameters, and is saved in a state file as soon
+as the molecule is done. Later runs (or a run resumed after an interruption)
+only recompute the molecules whose fingerprint changed, and only their sheets
+of the workbook are rewritten.
+
+@author: aiden
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+from timeit import default_timer as timer
+
+import ensemble
+import ir_spectra
+import peak_assignment
+import peak_finding
+import spectrum_cache
+import workbook
+
+
+STATE_VERSION = 1  # bump to recompute everything after a change to the output format
+
+DEFAULT_PARAMETERS = {
+    "start": 8,
+    "end": 4000,
+    "numpts": 500,
+    "fwhm": 10,
+    "gridTolerance": None,
+    "autoTolerance": 0.01,
+    "temperature": 293.15,
+    # [upper bound, factor] pairs, the first with freq < upper bound applies, null has no bound. A third
+    # element true makes the bound inclusive (freq <= upper bound), as main.py's SCALE_FUNCTION is at 2500
+    "scaleFactors": [[1111.11, 0.979], [2500, 0.973, True], [None, 0.961]],
+}
+
+DEFAULT_WORKBOOK = {
+    "dOffset": 100,
+    "windowSize": 20,
+    "nSigma": .5,
+    "coalesceWindow": 9,
+    "highPass": 9,
+    "wavXMin": 2.5,
+    "wavXMax": 25,
+    "freqXMin": 0,
+    "freqXMax": 4000,
+    "axisTitleFontSize": 16,
+    "axisFontSize": 14,
+    "labelFontSize": 14,
+    "includeAllLocalMaxRanges": [[6.0, 6.4], [12, 13]],
+    "assignPeaks": True,  # write the normal modes that produce each peak, see peak_assignment
+    "minModeContribution": 0.05,
+    "peakLabelModes": 2,
+    "shardMaxMolecules": None,  # either of these splits the workbook into shards, see workbook.writeShardedWorkbooks
+    "shardMaxCells": None,
+    "processes": 1,
+}
+
+
+def scaleTableFunction(table):
+    """Scale function for a list of [upper bound, factor(, inclusive)] entries (see DEFAULT_PARAMETERS)"""
+    def scaleFunction(freq):
+        for bound, factor, *inclusive in table:
+            if bound is None or freq < bound or (inclusive and inclusive[0] and freq == bound):
+                return factor
+        return 1.
+    return scaleFunction
+
+
+def loadManifest(manifestFile):
+    """Reads the manifest, resolving relative paths against its directory"""
+    with open(manifestFile, "r") as f:
+        manifest = json.load(f)
+
+    baseDir = os.path.dirname(os.path.abspath(manifestFile))
+    def resolve(path):
+        return None if path is None else os.path.normpath(os.path.join(baseDir, path))
+
+    manifest["output"] = resolve(manifest.get("output", "output.xlsx"))
+    manifest["workDir"] = resolve(manifest.get("workDir", "."))
+    manifest["parseCacheDir"] = resolve(manifest.get("parseCacheDir", "parse_cache"))
+    manifest["spectrumCacheDir"] = resolve(manifest.get("spectrumCacheDir"))
+    manifest["parameters"] = {**DEFAULT_PARAMETERS, **manifest.get("parameters", {})}
+    manifest.setdefault("parameterSets", {})
+    manifest["workbook"] = {**DEFAULT_WORKBOOK, **manifest.get("workbook", {})}
+
+    for name, entry in manifest["molecules"].items():
+        if ("input" in entry) == ("conformers" in entry):
+            raise ValueError(f"Molecule {name} needs exactly one of input or conformers")
+        if "input" in entry:
+            entry["input"] = resolve(entry["input"])
+        else:
+            entry["conformers"] = [resolve(path) for path in entry["conformers"]]
+        if "parameterSet" in entry and entry["parameterSet"] not in manifest["parameterSets"]:
+            raise ValueError(f"Molecule {name} uses unknown parameter set {entry['parameterSet']}")
+
+    return manifest
+
+
+def moleculeParameters(manifest, entry):
+    """The manifest parameters, overridden by the molecule's parameter set and then its own parameters"""
+    parameters = copy.deepcopy(manifest["parameters"])
+    parameters.update(manifest["parameterSets"].get(entry.get("parameterSet"), {}))
+    parameters.update(entry.get("parameters", {}))
+    return parameters
+
+
+def loadState(stateFile):
+    if os.path.exists(stateFile):
+        with open(stateFile, "r") as f:
+            state = json.load(f)
+        if state.get("version") == STATE_VERSION:
+            return state
+    return {"version": STATE_VERSION, "molecules": {}, "files": {}}
+
+
+def saveState(stateFile, state):
+    with open(stateFile + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(stateFile + ".tmp", stateFile)
+
+
+def fileHash(path, knownFiles):
+    """
+    sha256 of a file's contents. knownFiles caches the hash by path, size and
+    modification time so unchanged files are not read again
+    """
+    stat = os.stat(path)
+    known = knownFiles.get(path)
+    if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["sha256"]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    knownFiles[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": h.hexdigest()}
+    return h.hexdigest()
+
+
+def fingerprint(entry, parameters, knownFiles):
+    """Hash of everything a molecule's .out file depends on"""
+    inputs = [entry["input"]] if "input" in entry else entry["conformers"]
+    h = hashlib.sha256()
+    h.update(str(STATE_VERSION).encode())
+    h.update(("conformers" if "conformers" in entry else "input").encode())
+    for path in inputs:
+        h.update(fileHash(path, knownFiles).encode())
+    h.update(json.dumps(parameters, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def computeMolecule(manifest, entry, parameters, outputFile, spectrumCache):
+    """Broadens one molecule and writes its .out file"""
+    scaleFunction = scaleTableFunction(parameters["scaleFactors"])
+    if "input" in entry:
+        ir_spectra.irSpectra(entry["input"], outputFile, parameters["start"], parameters["end"],
+                             parameters["numpts"], parameters["fwhm"], scaleFunction, manifest["parseCacheDir"],
+                             parameters["gridTolerance"], parameters["autoTolerance"], spectrumCache=spectrumCache)
+    else:
+        ensemble.irEnsembleSpectra(entry["conformers"], outputFile, parameters["start"], parameters["end"],
+                                   parameters["numpts"], parameters["fwhm"], scaleFunction,
+                                   parameters["temperature"], manifest["parseCacheDir"], parameters["autoTolerance"],
+                                   parameters["gridTolerance"], spectrumCache)
+
+
+def buildProjectWorkbook(manifest, state):
+    """
+    Writes the workbook for every molecule in the manifest from the .out
+    files. If the workbook exists and was written with the same settings only
+    the sheets of molecules that changed since are rewritten
+    """
+    settings = manifest["workbook"]
+    # the number of processes writing shards does not change what is written
+    settingsHash = hashlib.sha256(json.dumps({key: value for key, value in settings.items() if key != "processes"},
+                                             sort_keys=True).encode()).hexdigest()
+    written = state.get("workbook", {})
+    sharded = settings["shardMaxMolecules"] is not None or settings["shardMaxCells"] is not None
+    # shards are always written in full
+    update = not sharded and os.path.exists(manifest["output"]) and written.get("settings") == settingsHash
+    writtenMolecules = written.get("molecules", {}) if update else {}
+
+    def findPeaks(moleculeName, freqData, irData):
+        return peak_finding.findPeaks([10000 / x for x in freqData], irData, settings["wavXMax"],
+            settings["windowSize"], settings["nSigma"], settings["coalesceWindow"], settings["highPass"],
+            moleculeName, False, settings["includeAllLocalMaxRanges"])
+
+    moleculeData = {}
+    for moleculeName in manifest["molecules"]:
+        if writtenMolecules.get(moleculeName) == state["molecules"][moleculeName]["fingerprint"]:
+            continue
+        freqData, irData, modes = workbook.readOutputFile(os.path.join(manifest["workDir"], moleculeName + ".out"))
+        moleculeData[moleculeName] = {
+            "freqs": freqData,
+            "irData": irData,
+            "modes": modes,
+            "peaks": findPeaks(moleculeName, freqData, irData),
+        }
+        if settings["assignPeaks"]:
+            fwhm = moleculeParameters(manifest, manifest["molecules"][moleculeName])["fwhm"]
+            moleculeData[moleculeName]["assignments"] = peak_assignment.assignPeaks(
+                freqData, irData, moleculeData[moleculeName]["peaks"], modes, fwhm, settings["minModeContribution"])
+
+    chartOptions = ((settings["freqXMin"], settings["freqXMax"]), (settings["wavXMin"], settings["wavXMax"]),
+                    settings["axisFontSize"], settings["axisTitleFontSize"], settings["labelFontSize"])
+    if sharded:
+        workbook.writeShardedWorkbooks(manifest["output"], moleculeData, settings["dOffset"],
+                                       settings["shardMaxMolecules"], settings["shardMaxCells"],
+                                       settings["processes"], *chartOptions, settings["peakLabelModes"])
+    elif update:
+        removed = [name for name in writtenMolecules if name not in manifest["molecules"]]
+        if moleculeData or removed:
+            workbook.updateWorkbook(manifest["output"], moleculeData, removed, findPeaks, settings["dOffset"],
+                                    *chartOptions, settings["peakLabelModes"])
+    else:
+        wb = workbook.buildWorkbook(moleculeData, settings["dOffset"], *chartOptions,
+                                    labelModes=settings["peakLabelModes"])
+        workbook.saveWorkbook(wb, manifest["output"], workbook.moleculeSeries(moleculeData, settings["peakLabelModes"]))
+
+    state["workbook"] = {
+        "settings": settingsHash,
+        "molecules": {name: state["molecules"][name]["fingerprint"] for name in manifest["molecules"]},
+    }
+    return list(moleculeData)
+
+
+def runManifest(manifestFile, stateFile=None, force=False, buildWorkbook=True):
+    """
+    Brings every molecule in the manifest up to date, then rebuilds the
+    workbook. stateFile defaults to the manifest name with .state.json
+    appended, force recomputes every molecule. Returns {"computed": [names],
+    "skipped": [names], "sheets": [names of the rewritten workbook sheets]}
+    """
+    manifest = loadManifest(manifestFile)
+    if stateFile is None:
+        stateFile = manifestFile + ".state.json"
+    state = loadState(stateFile)
+    os.makedirs(manifest["workDir"], exist_ok=True)
+
+    spectrumCache = None
+    if manifest["spectrumCacheDir"] is not None:
+        spectrumCache = spectrum_cache.SpectrumCache(manifest["spectrumCacheDir"])
+
+    summary = {"computed": [], "skipped": []}
+    for moleculeName, entry in manifest["molecules"].items():
+        parameters = moleculeParameters(manifest, entry)
+        outputFile = os.path.join(manifest["workDir"], moleculeName + ".out")
+        moleculeFingerprint = fingerprint(entry, parameters, state["files"])
+
+        previous = state["molecules"].get(moleculeName)
+        if (not force and previous is not None and previous["fingerprint"] == moleculeFingerprint
+                and os.path.exists(outputFile)):
+            summary["skipped"].append(moleculeName)
+            continue
+
+        print("Processing", moleculeName)
+        computeMolecule(manifest, entry, parameters, outputFile, spectrumCache)
+        # saved straight away so an interrupted run resumes from here
+        state["molecules"][moleculeName] = {"fingerprint": moleculeFingerprint, "output": outputFile}
+        saveState(stateFile, state)
+        summary["computed"].append(moleculeName)
+
+    # forget molecules and files no longer in the manifest
+    state["molecules"] = {name: state["molecules"][name] for name in manifest["molecules"]}
+    inputs = set()
+    for entry in manifest["molecules"].values():
+        inputs.update([entry["input"]] if "input" in entry else entry["conformers"])
+    state["files"] = {path: known for path, known in state["files"].items() if path in inputs}
+    saveState(stateFile, state)
+
+    if buildWorkbook:
+        print("Writing", manifest["output"])
+        summary["sheets"] = buildProjectWorkbook(manifest, state)
+        saveState(stateFile, state)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadens the molecules in a manifest and builds the workbook, "
+                                                 "recomputing only molecules whose inputs or parameters changed")
+    parser.add_argument("manifest", help="JSON manifest of molecules and parameters")
+    parser.add_argument("--state", help="state file, default is the manifest name with .state.json appended")
+    parser.add_argument("--force", action="store_true", help="recompute every molecule")
+    parser.add_argument("--no-workbook", action="store_true", help="only update the .out files")
+    args = parser.parse_args()
+
+    begin = timer()
+    summary = runManifest(args.manifest, args.state, args.force, not args.no_workbook)
+    print(f"Computed {len(summary['computed'])} and skipped {len(summary['skipped'])} molecules "
+          f"in {timer() - begin:.2f} seconds")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Boltzmann weighted spectra of conformer ensembles.
+
+The sticks of every conformer are concatenated and broadened together, so an
+ensemble costs a single broadening no matter how many conformers it has.
+
+@author: aiden
+"""
+
+import os
+
+import numpy
+
+import instrumentation
+import ir_spectra
+from mode_table import ModeTable
+
+
+HARTREE_TO_EV = 27.211386245988
+BOLTZMANN_EV = 8.617333262e-5  # eV / K
+
+
+def conformerEnergies(ccDatas, useFreeEnergy=True):
+    """
+    Returns the energy of every conformer in eV from parsed data (the
+    dictionaries returned by ir_spectra.parseLog). Free energies are used when
+    useFreeEnergy is set and every conformer has one, otherwise the last SCF
+    energy is used. Mixing the two would make the weights meaningless
+    """
+    if useFreeEnergy and all("freeenergy" in data for data in ccDatas):
+        return numpy.array([float(data["freeenergy"]) for data in ccDatas]) * HARTREE_TO_EV  # cclib gives hartree
+
+    if not all("scfenergies" in data for data in ccDatas):
+        raise ValueError("Every conformer needs an SCF or free energy to be Boltzmann weighted")
+    return numpy.array([data["scfenergies"][-1] for data in ccDatas])  # cclib gives eV
+
+
+def boltzmannWeights(energies, temperature):
+    """Normalized Boltzmann populations for energies (eV) at temperature (K)"""
+    energies = numpy.asarray(energies, dtype="d")
+    factors = numpy.exp(-(energies - energies.min()) / (BOLTZMANN_EV * temperature))
+    return factors / factors.sum()
+
+
+def concatenateSticks(inputFiles, scaleFunction, intensityKey="vibirs", cacheDir=None):
+    """
+    Parses every conformer and concatenates their scaled sticks.
+
+    Returns (freq, height, owner, scale, unscaledFreq, vibsyms, ccDatas) where
+    owner is the index of the conformer each stick came from
+    """
+    ccDatas = [ir_spectra.parseLog(inputFile, cacheDir) for inputFile in inputFiles]
+    for inputFile, data in zip(inputFiles, ccDatas):
+        if intensityKey not in data:
+            raise ValueError(f"{inputFile} does not contain {intensityKey}")
+
+    unscaledFreq = numpy.concatenate([data["vibfreqs"] for data in ccDatas])
+    height = numpy.concatenate([data[intensityKey] for data in ccDatas])
+    owner = numpy.repeat(numpy.arange(len(ccDatas)), [len(data["vibfreqs"]) for data in ccDatas])
+    vibsyms = numpy.concatenate([data.get("vibsyms", numpy.full(len(data["vibfreqs"]), "A")) for data in ccDatas])
+    scale = numpy.array([scaleFunction(f) for f in unscaledFreq])
+
+    return unscaledFreq * scale, height, owner, scale, unscaledFreq, vibsyms, ccDatas
+
+
+def conformerSpectra(xvalues, freq, weighted, owner, conformers, FWHM):
+    """
+    (conformers x len(xvalues)) array of the spectrum of each conformer's
+    sticks. Each conformer is broadened from its own modes only, so the cost
+    is that of broadening all the sticks once however many conformers there are
+    """
+    spectra = numpy.zeros((conformers, len(xvalues)))
+    order = numpy.argsort(owner, kind="stable")
+    bounds = numpy.searchsorted(owner[order], numpy.arange(conformers + 1))
+    for conformer in range(conformers):
+        block = order[bounds[conformer]:bounds[conformer + 1]]
+        if len(block):
+            spectra[conformer] = ir_spectra.broadenOnGrid(xvalues, freq[block], weighted[block], FWHM)
+    return spectra
+
+
+def broadenEnsemble(freq, height, owner, weights, start, end, numpts, FWHM, contributions=True):
+    """
+    Broadens concatenated sticks with heights weighted by the weight of the
+    conformer that owns them. Returns (xvalues, spectrum, conformerSpectra),
+    see ensembleSpectrum
+    """
+    weighted = height * weights[owner]
+    if not contributions:
+        xvalues, spectrum = ir_spectra.broadenChannels(start, end, numpts, freq, weighted, FWHM)
+        return xvalues, spectrum, None
+
+    xvalues = numpy.linspace(start, end, numpts)
+    spectra = conformerSpectra(xvalues, freq, weighted, owner, len(weights), FWHM)
+    return xvalues, spectra.sum(axis=0), spectra
+
+
+def ensembleSpectrum(inputFiles, start, end, numpts, FWHM, scaleFunction, temperature,
+                     intensityKey="vibirs", useFreeEnergy=True, contributions=True, cacheDir=None):
+    """
+    Boltzmann weighted spectrum of the conformers in inputFiles at
+    temperature (K). intensityKey selects the stick heights, vibirs for IR or
+    vibramans for Raman activities.
+
+    Returns (xvalues, spectrum, conformerSpectra, weights). When contributions
+    is set, conformerSpectra is a (conformers x numpts) array of the weighted
+    spectrum of each conformer, which are summed for spectrum. Otherwise it is
+    None
+    """
+    freq, height, owner, _, _, _, ccDatas = concatenateSticks(inputFiles, scaleFunction, intensityKey, cacheDir)
+    weights = boltzmannWeights(conformerEnergies(ccDatas, useFreeEnergy), temperature)
+    xvalues, spectrum, conformerSpectra = broadenEnsemble(freq, height, owner, weights, start, end, numpts, FWHM, contributions)
+    return xvalues, spectrum, conformerSpectra, weights
+
+
+def irEnsembleSpectra(inputFiles, outputFileName, start, end, numpts, FWHM, scaleFunction, temperature, cacheDir=None,
+                      autoTolerance=0.01, gridTolerance=None, spectrumCache=None):
+    """
+    Writes the Boltzmann weighted IR spectrum of the conformers in inputFiles
+    in the same format as ir_spectra.irSpectra, on the grid it would use for
+    numpts, gridTolerance and autoTolerance (numpts can be "auto", or is
+    ignored for an adaptive grid when gridTolerance is given). The normal mode
+    table lists the sticks of every conformer with their weighted activities.
+    If spectrumCache (a spectrum_cache.SpectrumCache) is given, an ensemble
+    broadened earlier from the same conformers, in any order, and settings is
+    reused.
+
+    Returns (xvalues, spectrum, modes, conformerSpectra, weights)
+    """
+    print("Building ensemble of", len(inputFiles), "conformers")
+    freq, height, owner, scale, unscaledFreq, vibsyms, ccDatas = concatenateSticks(inputFiles, scaleFunction, "vibirs", cacheDir)
+    weights = boltzmannWeights(conformerEnergies(ccDatas), temperature)
+    for inputFile, weight in zip(inputFiles, weights):
+        print("   ", inputFile, "weight", weight)
+
+    weighted = height * weights[owner]
+    instrumentation.count("modes", len(freq))
+    if spectrumCache is not None:
+        # keyed on the conformers in path order so listing them differently still hits
+        order = sorted(range(len(inputFiles)), key=lambda i: os.path.abspath(inputFiles[i]))
+        sticks = numpy.concatenate([numpy.flatnonzero(owner == i) for i in order])
+        key = spectrumCache.key(lineshape="lorentzian", conformers=[os.path.abspath(inputFiles[i]) for i in order],
+                                freq=freq[sticks], act=weighted[sticks], scale=scale[sticks], temperature=temperature,
+                                start=start, end=end, numpts=numpts, FWHM=FWHM, gridTolerance=gridTolerance,
+                                autoTolerance=autoTolerance)
+        cached = spectrumCache.get(key)
+        if cached is not None:
+            print("Using cached spectrum")
+            instrumentation.count("spectrumCacheHits")
+            xvalues, spectrum = cached["xvalues"], cached["spectrum"]
+            spectra = numpy.empty_like(cached["conformerSpectra"])
+            spectra[order] = cached["conformerSpectra"]
+            ir_spectra.writeSpectrum(outputFileName, xvalues, spectrum, vibsyms, freq, weighted, scale, unscaledFreq)
+            return xvalues, spectrum, ModeTable.fromColumns(vibsyms, freq, weighted, scale, unscaledFreq), spectra, weights
+
+        instrumentation.count("spectrumCacheMisses")
+
+    xvalues = ir_spectra.stickGrid(freq, weighted, start, end, numpts, FWHM, gridTolerance, autoTolerance)
+
+    print("Broadening spectrum")
+    with instrumentation.stage("broaden"):
+        spectra = conformerSpectra(xvalues, freq, weighted, owner, len(weights), FWHM)
+        spectrum = spectra.sum(axis=0)
+    instrumentation.count("gridPoints", len(xvalues))
+
+    if spectrumCache is not None:
+        spectrumCache.put(key, xvalues=xvalues, spectrum=spectrum, conformerSpectra=spectra[order])
+    ir_spectra.writeSpectrum(outputFileName, xvalues, spectrum, vibsyms, freq, weighted, scale, unscaledFreq)
+    modes = ModeTable.fromColumns(vibsyms, freq, weighted, scale, unscaledFreq)
+    return xvalues, spectrum, modes, spectra, weights
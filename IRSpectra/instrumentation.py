@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per stage timing and memory instrumentation.
+
+Stages are marked with
+
+    with instrumentation.stage("broaden", molecule=name):
+        ...
+
+and counters with instrumentation.count("gridPoints", 500). Nothing is
+recorded until enable() is called, so the calls cost next to nothing in
+normal runs. Each stage records its wall time, CPU time and peak traced
+memory (tracemalloc), nested stages inherit their molecule from the stage
+around them, and report() / writeReport() summarize the run per stage and
+per molecule, optionally with a cProfile dump.
+
+Stages can be opened from several threads, each thread nesting its own
+stages. tracemalloc only keeps one peak for the whole process, which a stage
+has to reset when it begins, so peak memory is only recorded for the stages
+of the main thread and is None for stages run in other threads (such as the
+pipeline workers). While other threads are running, the main thread's peaks
+include what they allocate too.
+
+@author: aiden
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from timeit import default_timer as timer
+
+
+_run = None  # the active _Run, or None when disabled
+
+
+class _Run:
+    def __init__(self, traceMemory, profile):
+        self.traceMemory = traceMemory
+        self.stages = []    # finished stages, in the order they finished
+        self.counters = {}  # {name: total}
+        self.moleculeCounters = {}  # {molecule: {name: total}}
+        self.local = threading.local()  # .stack, the stages open in each thread
+        self.lock = threading.Lock()
+        self.began = timer()
+        self.beganCpu = time.process_time()
+        self.profiler = cProfile.Profile() if profile else None
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    @property
+    def stack(self):
+        """Stages open in the calling thread"""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+
+def enable(traceMemory=True, profile=False):
+    """
+    Starts recording. traceMemory records peak memory per stage with
+    tracemalloc (which slows python code down noticeably), profile runs
+    cProfile for the whole run
+    """
+    global _run
+    _run = _Run(traceMemory, profile)
+
+
+def enabled():
+    return _run is not None
+
+
+def disable():
+    """Stops recording and discards what was recorded"""
+    global _run
+    if _run is not None:
+        if _run.profiler is not None:
+            _run.profiler.disable()
+        if _run.traceMemory:
+            tracemalloc.stop()
+    _run = None
+
+
+@contextlib.contextmanager
+def _recordStage(name, molecule):
+    run = _run
+    if molecule is None and run.stack:
+        molecule = run.stack[-1]["molecule"]
+    record = {"stage": name, "molecule": molecule, "parent": run.stack[-1]["stage"] if run.stack else None,
+              "depth": len(run.stack), "peakMemory": 0}
+
+    traceMemory = run.traceMemory and threading.current_thread() is threading.main_thread()
+    if not traceMemory:
+        record["peakMemory"] = None
+    else:
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is about to be reset, so hand what has been seen so far to the open stages
+        for outer in run.stack:
+            outer["peakMemory"] = max(outer["peakMemory"], peak - outer["baseMemory"])
+        record["baseMemory"] = current
+        tracemalloc.reset_peak()
+
+    run.stack.append(record)
+    beginCpu = time.thread_time()  # CPU time of this thread only, other threads may be running stages too
+    begin = timer()
+    try:
+        yield record
+    finally:
+        record["wall"] = timer() - begin
+        record["cpu"] = time.thread_time() - beginCpu
+        run.stack.pop()
+        if traceMemory:
+            _, peak = tracemalloc.get_traced_memory()
+            record["peakMemory"] = max(record["peakMemory"], peak - record["baseMemory"])
+            for outer in run.stack:
+                outer["peakMemory"] = max(outer["peakMemory"], peak - outer["baseMemory"])
+            del record["baseMemory"]
+        with run.lock:
+            run.stages.append(record)
+
+
+def stage(name, molecule=None):
+    """Context manager timing a stage, a no-op unless enabled"""
+    if _run is None:
+        return contextlib.nullcontext()
+    return _recordStage(name, molecule)
+
+
+def count(name, amount=1, molecule=None):
+    """Adds amount to a counter, attributed to molecule or the molecule of the open stage"""
+    run = _run
+    if run is None:
+        return
+    if molecule is None and run.stack:
+        molecule = run.stack[-1]["molecule"]
+    with run.lock:
+        run.counters[name] = run.counters.get(name, 0) + amount
+        if molecule is not None:
+            counters = run.moleculeCounters.setdefault(molecule, {})
+            counters[name] = counters.get(name, 0) + amount
+
+
+def _totals(stages):
+    """
+    Sums wall and cpu time and takes the largest peak memory of each stage
+    name, None if no call of the stage had its peak memory recorded
+    """
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record["stage"], {"calls": 0, "wall": 0., "cpu": 0., "peakMemory": None})
+        total["calls"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        if record["peakMemory"] is not None:
+            total["peakMemory"] = max(total["peakMemory"] or 0, record["peakMemory"])
+    return totals
+
+
+def report():
+    """Summary of the run so far as a JSON serializable dictionary"""
+    if _run is None:
+        return None
+
+    molecules = {}
+    for molecule in dict.fromkeys(r["molecule"] for r in _run.stages if r["molecule"] is not None):
+        molecules[molecule] = {
+            "stages": _totals([r for r in _run.stages if r["molecule"] == molecule]),
+            "counters": _run.moleculeCounters.get(molecule, {}),
+        }
+
+    return {
+        "wall": timer() - _run.began,
+        "cpu": time.process_time() - _run.beganCpu,
+        "peakMemory": tracemalloc.get_traced_memory()[1] if _run.traceMemory else None,
+        "python": platform.python_version(),
+        "argv": sys.argv,
+        "stages": _totals(_run.stages),
+        "molecules": molecules,
+        "counters": _run.counters,
+        "timeline": _run.stages,
+    }
+
+
+def writeReport(fileName):
+    """
+    Writes report() to fileName as JSON. When profiling, the cProfile
+    statistics are written next to it with .prof appended (open them with
+    pstats or snakeviz)
+    """
+    if _run is None:
+        return
+    with open(fileName, "w") as f:
+        json.dump(report(), f, indent=1)
+    if _run.profiler is not None:
+        _run.profiler.disable()
+        _run.profiler.dump_stats(fileName + ".prof")
+        _run.profiler.enable()
+    print("Run report written to", os.path.abspath(fileName))
+
+
+def printSummary():
+    """Prints the time spent in each top level and nested stage"""
+    if _run is None:
+        return
+    totals = _totals(_run.stages)
+    print(f"{'stage':24s} {'calls':>6s} {'wall s':>9s} {'cpu s':>9s} {'peak MB':>9s}")
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]["wall"]):
+        peak = "-" if total["peakMemory"] is None else f"{total['peakMemory'] / 2**20:.2f}"
+        print(f"{name:24s} {total['calls']:6d} {total['wall']:9.3f} {total['cpu']:9.3f} {peak:>9s}")
@@ -11,8 +11,81 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
 # General Public License for more details.
 
+import hashlib
+import os
+import tempfile
+
 import numpy
-from cclib.parser import ccopen
+
+import instrumentation
+from mode_table import ModeTable
+
+
+# attributes kept from a cclib parse, the rest of the parsed data is not used
+PARSED_ATTRIBUTES = ["vibfreqs", "vibirs", "vibsyms", "vibramans", "scfenergies", "freeenergy"]
+
+_parseCache = {}  # {(path, size, mtime): {attribute: array}}
+
+
+def parseLog(inputFileName, cacheDir=None):
+    """
+    Parses a Gaussian/ORCA output file with cclib and returns a dictionary of
+    numpy arrays for each of PARSED_ATTRIBUTES the file contains.
+
+    Results are cached in memory for the life of the process, keyed by the
+    absolute file path, size and modification time. If cacheDir is given they
+    are also saved there as .npz files, named by the same key, so later runs
+    can skip the cclib parse.
+    The returned arrays are shared with the cache and must not be modified
+    """
+    stat = os.stat(inputFileName)
+    key = (os.path.abspath(inputFileName), stat.st_size, stat.st_mtime_ns)
+    if key in _parseCache:
+        instrumentation.count("parseCacheHits")
+        return _parseCache[key]
+
+    cacheFile = None
+    if cacheDir is not None:
+        name = os.path.splitext(os.path.basename(inputFileName))[0]
+        # files of the same name in different directories can share a size and mtime (copied conformer folders)
+        pathHash = hashlib.sha256(key[0].encode()).hexdigest()[:16]
+        cacheFile = os.path.join(cacheDir, f"{name}-{pathHash}-{stat.st_size}-{stat.st_mtime_ns}.npz")
+        if os.path.exists(cacheFile):
+            with instrumentation.stage("parseCacheLoad"):
+                with numpy.load(cacheFile) as cached:
+                    data = {attr: cached[attr] for attr in cached.files}
+            instrumentation.count("parseCacheHits")
+            _parseCache[key] = data
+            return data
+
+    print("Parsing file with cclib")
+    instrumentation.count("parseCacheMisses")
+    instrumentation.count("bytesParsed", stat.st_size)
+    with instrumentation.stage("parse"):
+        from cclib.parser import ccopen  # slow to import, so only loaded when a file has to be parsed
+        ccData = ccopen(inputFileName).parse()
+    data = {}
+    for attr in PARSED_ATTRIBUTES:
+        if hasattr(ccData, attr):
+            data[attr] = numpy.asarray(getattr(ccData, attr))
+
+    if cacheFile is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        # written under a unique name and moved into place, the cache may be shared by several processes
+        fd, tmpFile = tempfile.mkstemp(suffix=".tmp", dir=cacheDir)
+        with os.fdopen(fd, "wb") as f:
+            numpy.savez(f, **data)
+        os.replace(tmpFile, cacheFile)
+
+    _parseCache[key] = data
+    return data
+
+
+def forgetParse(inputFileName):
+    """Drops every in-memory parse of inputFileName, for long running processes whose files change"""
+    path = os.path.abspath(inputFileName)
+    for key in [key for key in _parseCache if key[0] == path]:
+        del _parseCache[key]
 
 
 def broadenSpectrum(start, end, numpts, peaks, width, formula):
@@ -36,6 +109,52 @@ def broadenSpectrum(start, end, numpts, peaks, width, formula):
 
 
 
+# maximum number of (point, mode) kernel elements evaluated at once by
+# broadenOnGrid, bounds the memory used when there are many modes
+KERNEL_CHUNK_ELEMENTS = 2**22
+
+
+def lorentzianKernel(xvalues, freqs, width):
+    """
+    Returns the (len(xvalues), len(freqs)) matrix of unit height lorentzians
+    centred on each frequency, i.e. lorentzian(x, freq, 1, width) for every
+    pair
+    """
+    a = width**2./4.
+    d = numpy.subtract.outer(xvalues, freqs)
+    return a / (d * d + a)
+
+
+def broadenOnGrid(xvalues, freqs, heights, width):
+    """
+    Vectorized lorentzian broadening onto an arbitrary grid. heights is
+    either a 1D array with one height per mode, or a (channels x modes)
+    matrix in which case every channel is broadened from the same kernel
+    evaluation and a (channels x len(xvalues)) array is returned
+    """
+    xvalues = numpy.asarray(xvalues, dtype="d")
+    freqs = numpy.asarray(freqs, dtype="d")
+    heights = numpy.asarray(heights, dtype="d")
+    channels = heights.reshape(-1, len(freqs))
+
+    spectra = numpy.zeros((len(channels), len(xvalues)))
+    chunk = max(1, KERNEL_CHUNK_ELEMENTS // max(1, len(freqs)))
+    for lo in range(0, len(xvalues), chunk):
+        hi = lo + chunk
+        spectra[:, lo:hi] = channels @ lorentzianKernel(xvalues[lo:hi], freqs, width).T
+
+    return spectra if heights.ndim > 1 else spectra[0]
+
+
+def broadenChannels(start, end, numpts, freqs, heights, width):
+    """
+    Same as broadenSpectrum with a lorentzian, but vectorized and accepting
+    a (channels x modes) matrix of heights. Returns (xvalues, spectra)
+    """
+    xvalues = numpy.linspace(start, end, numpts)
+    return xvalues, broadenOnGrid(xvalues, freqs, heights, width)
+
+
 def lorentzian(x, peak, height, width):
     """The lorentzian curve.
 
@@ -47,37 +166,104 @@ def lorentzian(x, peak, height, width):
     return float(height)*a/( (peak-x)**2 + a )
 
     
-def irSpectra(inputFileName, outputFileName, start, end, numpts, FWHM, scaleFunction):
-    print("Parsing file with cclib")
-    ccData = ccopen(inputFileName).parse()
+def scaledModes(ccData, scaleFunction):
+    """ModeTable of a parse from parseLog with the frequencies scaled by scaleFunction(freq)"""
+    unscaledFreq = ccData["vibfreqs"]
+    scale = numpy.array([scaleFunction(f) for f in unscaledFreq])
+    return ModeTable.fromColumns(ccData["vibsyms"], unscaledFreq * scale, ccData["vibirs"], scale, unscaledFreq)
+
+
+def stickGrid(freq, act, start, end, numpts, FWHM, gridTolerance=None, autoTolerance=0.01):
+    """The grid irSpectra broadens the sticks (freq, act) on for numpts, gridTolerance and autoTolerance"""
+    if gridTolerance is not None:
+        import spectral_grid
+        with instrumentation.stage("adaptiveGrid"):
+            return spectral_grid.adaptiveGrid(start, end, freq, act, FWHM, relTolerance=gridTolerance)
+
+    if numpts == "auto":
+        import spectral_grid
+        with instrumentation.stage("chooseNumPoints"):
+            numpts, report = spectral_grid.chooseNumPoints(start, end, freq, act, FWHM, autoTolerance)
+        print(f"Using {numpts} points (step {report['step']:.4g} cm-1), estimated peak height error "
+              f"{report['heightError']:.2%} and position error {report['positionError']:.3g} cm-1")
+    return numpy.linspace(start, end, numpts)
+
+
+def broadenSticks(freq, act, start, end, numpts, FWHM, gridTolerance=None, autoTolerance=0.01):
+    """
+    Broadens the sticks (freq, act) on the grid irSpectra describes for
+    numpts, gridTolerance and autoTolerance. Returns (xvalues, spectrum)
+    """
+    xvalues = stickGrid(freq, act, start, end, numpts, FWHM, gridTolerance, autoTolerance)
+    with instrumentation.stage("broaden"):
+        spectrum = broadenOnGrid(xvalues, freq, act, FWHM)
+    instrumentation.count("gridPoints", len(xvalues))
+    return xvalues, spectrum
+
+
+def irSpectra(inputFileName, outputFileName, start, end, numpts, FWHM, scaleFunction, cacheDir=None, gridTolerance=None,
+              autoTolerance=0.01, spectrumCache=None):
+    """
+    Parses inputFileName, scales and broadens the IR spectrum and writes it to
+    outputFileName. If gridTolerance is given numpts is ignored and the
+    spectrum is computed on an adaptive grid (see spectral_grid.adaptiveGrid)
+    with gridTolerance as the interpolation error relative to the tallest
+    mode. If numpts is "auto" the smallest number of evenly spaced points that
+    samples every peak height within autoTolerance is used (see
+    spectral_grid.chooseNumPoints). If spectrumCache (a
+    spectrum_cache.SpectrumCache) is given, a spectrum broadened earlier from
+    the same modes and settings is reused. Returns (xvalues, spectrum, modes)
+    """
+    modes = scaledModes(parseLog(inputFileName, cacheDir), scaleFunction)
+    instrumentation.count("modes", len(modes))
+
+    freq, act = modes.sticks()
+    if spectrumCache is not None:
+        key = spectrumCache.key(lineshape="lorentzian", freq=freq, act=act, scale=modes.scale, start=start, end=end,
+                                numpts=numpts, FWHM=FWHM, gridTolerance=gridTolerance, autoTolerance=autoTolerance)
+        cached = spectrumCache.get(key)
+        if cached is not None:
+            print("Using cached spectrum")
+            instrumentation.count("spectrumCacheHits")
+            xvalues, spectrum = cached["xvalues"], cached["spectrum"]
+            writeSpectrum(outputFileName, xvalues, spectrum, modes.label, freq, act, modes.scale, modes.unscaled)
+            return xvalues, spectrum, modes
+
+        instrumentation.count("spectrumCacheMisses")
 
-    freq = ccData.vibfreqs
-    unscaledFreq = freq.copy()
-    act = ccData.vibirs
-    vibsyms = ccData.vibsyms
-    scale = []
-    
-    for i in range(len(freq)):
-        scalingFactor = scaleFunction(freq[i])
-        freq[i] *= scalingFactor
-        scale.append(scalingFactor)
-    
     print("Broadening spectrum")
-    xvalues, spectrum = broadenSpectrum(start, end, numpts, list(zip(freq, act)), FWHM, lorentzian)
-    
-    print("Writing scaled spectrum to", outputFileName) 
-    with open(outputFileName, "w") as outputFile:
+    xvalues, spectrum = broadenSticks(freq, act, start, end, numpts, FWHM, gridTolerance, autoTolerance)
+
+    if spectrumCache is not None:
+        spectrumCache.put(key, xvalues=xvalues, spectrum=spectrum)
+    writeSpectrum(outputFileName, xvalues, spectrum, modes.label, freq, act, modes.scale, modes.unscaled)
+    return xvalues, spectrum, modes
+
+
+def writeSpectrum(outputFileName, xvalues, spectrum, vibsyms, freq, act, scale, unscaledFreq):
+    """
+    Writes the broadened spectrum and the normal mode table as tab separated
+    text. When there are more modes than points (a short "auto" or adaptive
+    grid) the remaining modes are written after the spectrum with its
+    columns left empty
+    """
+    numpts = len(xvalues)
+    print("Writing scaled spectrum to", outputFileName)
+    with instrumentation.stage("writeSpectrum"), open(outputFileName, "w") as outputFile:
         outputFile.write("Spectrum\t\t\tNormal Modes\n")
         outputFile.write("Freq (cm-1)\tIR act\t\tMode\tLabel\tFreq (cm-1)\tIR act\t")
         outputFile.write("Scaling factors\tUnscaled freq\n")
         
-        for i in range(numpts):
-            if spectrum[i] < 1e-20:
-                spectrum[i] = 0.
+        for i in range(max(numpts, len(freq))):
+            if i < numpts:  # write the spectrum data
+                if spectrum[i] < 1e-20:
+                    spectrum[i] = 0.
 
-            outputFile.write(str(xvalues[i]) + "\t" + str(spectrum[i]))
+                outputFile.write(str(xvalues[i]) + "\t" + str(spectrum[i]))
+            else:
+                outputFile.write("\t")
 
-            if i < len(freq): # Write the activities (assumes more pts to plot than freqs - fix this)
+            if i < len(freq): # Write the activities
                 outputFile.write("\t\t"+str(i+1)+"\t"+vibsyms[i]+"\t"+str(freq[i])+"\t"+str(act[i]))
                 outputFile.write("\t"+str(scale[i])+"\t" + str(unscaledFreq[i]))
                 
@@ -6,15 +6,21 @@ Created on Wed Jun 28 17:54:34 2023
 @author: aiden
 """
 import ir_spectra
-from openpyxl import Workbook
-from openpyxl.chart import ScatterChart, Reference, Series
-from openpyxl.chart.label import DataLabel, DataLabelList
-import matplotlib.pyplot as plt
+import ensemble
+import spectrum_store
+import spectrum_cache
+import peak_finding
+import peak_assignment
+import spectral_similarity
+import workbook
+import previews
+import instrumentation
+import pipeline
 from timeit import default_timer as timer
-from openpyxl.drawing.text import Paragraph, ParagraphProperties, CharacterProperties
-from openpyxl.chart.text import RichText
 
-import math
+import numpy
+
+from mode_table import ModeTable
 
 
 # make sure to use:
@@ -25,13 +31,19 @@ INPUT_FILES = {  # dictionary containing molecule names and where the input file
     "isoquinoline1":"../test/1-butylnaptho[2-3-g]isoquinoline.log"
 }
 
-OUTPUT_EXCEL_FILE = "test.xlsx"
+ENSEMBLE_FILES = {  # molecule name: list of conformer input files, the spectra are Boltzmann weighted at TEMP
+}
+
+OUTPUT_EXCEL_FILE = "test.xlsx"  # set to None to only write the .out files
 
 # GaussSum Parameters
 START = 8   # note: endpoints are included so step may not be intuitive to calculate: step = (end - start) / (npoints - 1)
 END = 4000
-NUM_PTS = 500
+NUM_PTS = 500       # or "auto" to use the fewest points that sample the peak heights to within AUTO_NUM_PTS_TOLERANCE
+AUTO_NUM_PTS_TOLERANCE = 0.01
 FWHM = 10
+ADAPTIVE_GRID_TOLERANCE = None  # set to e.g. 1e-3 to ignore NUM_PTS and place points densely around peaks and
+                                # sparsely elsewhere, keeping the error relative to the tallest mode below this
 def SCALE_FUNCTION(freq):
     if freq < 1111.11:
         scalingFactor = 0.979
@@ -41,12 +53,32 @@ def SCALE_FUNCTION(freq):
         scalingFactor = 0.973    
     return scalingFactor
     
+PARSE_CACHE_DIR = "./parse_cache"  # cclib results are saved here so files are only parsed once,
+                                   # set to None to always reparse
+SPECTRUM_CACHE_DIR = "./spectrum_cache"  # broadened spectra are saved here and reused while the modes and
+                                         # broadening settings are unchanged, set to None to always rebroaden
+SPECTRUM_CACHE_MAX_BYTES = 512 * 2**20   # least recently used spectra are removed beyond this size
+
+SPECTRUM_STORE_DIR = None  # set to a directory to keep spectra in a memory mapped store rather than
+                           # re-reading the .out files, needed for batches too large for memory
+SPECTRUM_STORE_DTYPE = "float64"  # float32 halves the size of the store
+
 EXCITATION = 785
 TEMP = 293.15
 
 
 # Excel Parameters
 DOFFSET = 100  # the amount of offset to add to each molecule
+UPDATE_EXCEL_FILE = False  # set true to only replace the sheets of the molecules above in an existing
+                           # OUTPUT_EXCEL_FILE, keeping the sheets of any other molecules already in it
+REMOVE_MOLECULES = []      # molecule sheets to delete from OUTPUT_EXCEL_FILE when updating it
+SHARD_MAX_MOLECULES = None  # set either of these to split the molecules over several workbooks named after
+SHARD_MAX_CELLS = None      # OUTPUT_EXCEL_FILE, which becomes an index linking to them
+SHARD_PROCESSES = 1         # number of shard workbooks to write at once
+SIMILARITY_THRESHOLD = None  # set to e.g. 0.98 to cluster molecules whose spectra have at least this cosine
+                             # similarity and write one sheet per cluster instead of one per molecule
+SIMILARITY_MERGE = "representative"  # keep the first molecule of each cluster, or "boltzmann" to write the
+                                     # Boltzmann weighted mean of its members at TEMP (INPUT_FILES only)
 
 
 ##########################
@@ -80,6 +112,10 @@ INCLUDE_ALL_LOCAL_MAX_RANGES = [
     (12, 13)
 ]
 
+ASSIGN_PEAKS = True           # write the normal modes that produce each peak to its sheet
+MIN_MODE_CONTRIBUTION = 0.05  # smallest fraction of a peak's intensity a mode is listed for
+PEAK_LABEL_MODES = 2          # modes shown after the wavelength in each peak's chart label, 0 for none
+
 
 ##########################
 #
@@ -88,13 +124,27 @@ INCLUDE_ALL_LOCAL_MAX_RANGES = [
 ##########################
 MPL_PLOT = False  # set true if you would like to view which peaks were chosen
                   # before having to open excel
+PREVIEW_DIR = None    # set to a directory to save a plot of each molecule's chosen peaks there instead,
+                      # with index.html showing them all. Needs no display and does not pause
+PREVIEW_FORMAT = "png"  # or "svg"
+PREVIEW_PROCESSES = 1   # more than 1 renders the previews in the background while the workbook is written
+INSTRUMENTATION_REPORT = None   # set to a .json file to record the time and memory of each stage per molecule
+INSTRUMENTATION_MEMORY = True   # trace peak memory per stage (slower)
+INSTRUMENTATION_PROFILE = False  # also write a cProfile dump next to the report
+PIPELINE = False         # set true to parse, broaden and write the sheets of different molecules at the same
+                         # time, in threads connected by queues, instead of one phase after another
+PIPELINE_QUEUE_SIZE = 2  # most molecules waiting between two stages of the pipeline
+PIPELINE_THREADS = 1     # threads broadening and finding peaks in the pipeline
 
 
 
 # anything below this line is not to be modified by typical users
 
 start = timer()
+if INSTRUMENTATION_REPORT is not None:
+    instrumentation.enable(INSTRUMENTATION_MEMORY, INSTRUMENTATION_PROFILE)
 workingDir = "./"
+moleculeNames = list(INPUT_FILES.keys()) + list(ENSEMBLE_FILES.keys())
 
 
 
@@ -104,98 +154,43 @@ workingDir = "./"
 #
 ###############################################################################
 
-for moleculeName, inputFile in INPUT_FILES.items():
-    outputFile = workingDir + moleculeName + ".out"
-    ir_spectra.irSpectra(inputFile, outputFile, START, END, NUM_PTS, FWHM, SCALE_FUNCTION)
-
-
-###############################################################################
-#
-#                         Peak Finding
-#
-###############################################################################
-
-def mean(data):
-    return sum(data) / len(data)
-
-def stdev(data):
-    m = mean(data)
-    s = 0
-    for d in data:
-        s += (d - m)**2
-
-    return math.sqrt(s / len(data))
-
-def getWindow(data, center, sideLength):
-    if center + sideLength < len(data) and center - sideLength > 0:
-        return data[center - sideLength : center + sideLength + 1]
-    elif center + sideLength >= len(data):
-        return data[len(data) - 1 - sideLength * 2:]
-    else:
-        return data[0:sideLength * 2 + 1]
-
-def isLocalMax(data, i):
-    if i > 0 and i < len(data) - 1:
-        return (data[i] > data[i + 1] and data[i] > data[i - 1])
-    else:
-        return False
-
-# peak algorithm based upon this research paper:
-# https://www.researchgate.net/publication/228853276_Simple_Algorithms_for_Peak_Detection_in_Time-Series
-# An example of its operation is shown here:
-# https://observablehq.com/@yurivish/peak-detection
-# Method assumes an evenly spaced time series, this is approximately true for
-# the usable range of the data we are looking at
-def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass, molName, plot):
-    peaks = []
-    lastPeakIndex = -1
-    for i in range(len(dataY)):
-        if dataX[i] > max_x:  # data from highest to lowest and reversing
-                               # will mess up indexing, so just skip it
-            continue
-
-
-        # peak was not added, so check to see if is in one of the include-all-local-max
-        # regions
-        xVal = dataX[i]
-        if any([xVal > r[0] and xVal < r[1] for r in INCLUDE_ALL_LOCAL_MAX_RANGES]):
-            if isLocalMax(dataY, i):
-                peaks.append(i)
-                lastPeakIndex = -1  # reset to negative number so no coalesce
-                continue
-            
-            
-        window = getWindow(dataY, i, windowSize)
-        m = mean(window)
-        s = stdev(window)
-
-        # potential peak, so make sure it is not too close to another peak
-        if dataY[i] - m > nsigma * s and dataY[i] > highPass:
-            if lastPeakIndex > 0:  # there is a previous peak
-                if i - lastPeakIndex < coalesceWindow:  # choose maximum if within window
-                    if dataY[i] > dataY[lastPeakIndex]:
-                        peaks[-1] = i
-                        lastPeakIndex = i
-                    # no changes made otherwise
-                else:
-                    peaks.append(i)
-                    lastPeakIndex = i
-            else:
-                peaks.append(i)
-                lastPeakIndex = i
-                
-    if plot:
-        print([dataX[i] for i in peaks])
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        ax.plot(dataX, dataY)
-        ax.scatter([dataX[i] for i in peaks], [dataY[i] for i in peaks], color="green")
-        ax.set_xlim(0, max_x)
-        fig.suptitle(molName)
-        plt.pause(5)
+spectrumCache = None
+if SPECTRUM_CACHE_DIR is not None:
+    spectrumCache = spectrum_cache.SpectrumCache(SPECTRUM_CACHE_DIR, SPECTRUM_CACHE_MAX_BYTES)
 
-    return peaks
+store = None
+if SPECTRUM_STORE_DIR is not None:
+    if ADAPTIVE_GRID_TOLERANCE is not None or NUM_PTS == "auto":
+        raise ValueError("The spectrum store needs a shared grid, set NUM_PTS and do not use ADAPTIVE_GRID_TOLERANCE")
+    store = spectrum_store.SpectrumStore(SPECTRUM_STORE_DIR, numpy.linspace(START, END, NUM_PTS), SPECTRUM_STORE_DTYPE,
+                                         capacity=len(moleculeNames))
 
+def gausssum(moleculeName):
+    """Parses and broadens a molecule and writes its .out file, returns (xvalues, spectrum, modeTable)"""
+    outputFile = workingDir + moleculeName + ".out"
+    with instrumentation.stage("gausssum", molecule=moleculeName):
+        if moleculeName in INPUT_FILES:
+            return ir_spectra.irSpectra(INPUT_FILES[moleculeName], outputFile, START, END, NUM_PTS, FWHM,
+                                        SCALE_FUNCTION, PARSE_CACHE_DIR, ADAPTIVE_GRID_TOLERANCE,
+                                        AUTO_NUM_PTS_TOLERANCE, spectrumCache=spectrumCache)
+        xvalues, spectrum, modeTable, _, _ = ensemble.irEnsembleSpectra(ENSEMBLE_FILES[moleculeName], outputFile, START,
+                                                                        END, NUM_PTS, FWHM, SCALE_FUNCTION, TEMP,
+                                                                        PARSE_CACHE_DIR, AUTO_NUM_PTS_TOLERANCE,
+                                                                        ADAPTIVE_GRID_TOLERANCE, spectrumCache)
+        return xvalues, spectrum, modeTable
+
+if PIPELINE:
+    if store is not None or MPL_PLOT:
+        raise ValueError("The pipeline cannot use the spectrum store or MPL_PLOT, set SPECTRUM_STORE_DIR to None "
+                         "and MPL_PLOT to False")
+else:
+    for moleculeName in moleculeNames:
+        xvalues, spectrum, modeTable = gausssum(moleculeName)
+        if store is not None:
+            store.addMolecule(moleculeName, spectrum, modeTable)
+
+if store is not None:
+    store.flush()
 
 
 ###############################################################################
@@ -203,191 +198,151 @@ def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass,
 #                         Excel Data Dump
 #
 ###############################################################################
-wb = Workbook()
-wb.remove(wb.active)
 
-wb.create_sheet("config")
+previewRenderer = None
+if PREVIEW_DIR is not None:
+    previewRenderer = previews.PreviewRenderer(PREVIEW_DIR, PREVIEW_FORMAT, PREVIEW_PROCESSES)
+
+def exportData(moleculeName, freqData, irData, modes):
+    """Finds the peaks of a molecule, returns its entry of moleculeData"""
+    with instrumentation.stage("findPeaks", molecule=moleculeName):
+        peaks = peak_finding.findPeaks([10000 / x for x in freqData], irData, WAV_X_MAX,
+            WINDOW_SIZE, N_SIGMA, COALESCE_WINDOW, HIGH_PASS, moleculeName, MPL_PLOT,
+            INCLUDE_ALL_LOCAL_MAX_RANGES)
+    instrumentation.count("peaks", len(peaks), molecule=moleculeName)
+    data = {
+        "freqs":freqData,
+        "irData":irData,
+        "modes":modes,
+        "peaks":peaks
+    }
+    if ASSIGN_PEAKS:
+        with instrumentation.stage("assignPeaks", molecule=moleculeName):
+            data["assignments"] = peak_assignment.assignPeaks(freqData, irData, peaks, modes, FWHM,
+                                                              MIN_MODE_CONTRIBUTION)
+    return data
+
+def prefetch(moleculeName):
+    """Pipeline stage reading and parsing the input files ahead of the broadening"""
+    with instrumentation.stage("prefetch", molecule=moleculeName):
+        for inputFile in ENSEMBLE_FILES.get(moleculeName, [INPUT_FILES.get(moleculeName)]):
+            ir_spectra.parseLog(inputFile, PARSE_CACHE_DIR)
+    return moleculeName
+
+def broaden(moleculeName):
+    """Pipeline stage broadening and finding the peaks, the spectrum is used as is rather than read back"""
+    xvalues, spectrum, modeTable = gausssum(moleculeName)
+    return moleculeName, exportData(moleculeName, xvalues.tolist(), spectrum.tolist(), modeTable)
+
+builder = None
+if PIPELINE and OUTPUT_EXCEL_FILE is not None and not UPDATE_EXCEL_FILE and \
+        SHARD_MAX_MOLECULES is None and SHARD_MAX_CELLS is None and SIMILARITY_THRESHOLD is None:
+    # sheets are written as molecules come out of the pipeline
+    builder = workbook.WorkbookBuilder(DOFFSET, (FREQ_X_MIN, FREQ_X_MAX), (WAV_X_MIN, WAV_X_MAX),
+                                       AXIS_FONT_SIZE, AXIS_TITLE_FONT_SIZE, LABEL_FONT_SIZE,
+                                       labelModes=PEAK_LABEL_MODES)
 
-configRow = 1
-currentOffset = 0
 moleculeData = {}  # {molecule name: {dataLabel: [data]}}
-for moleculeName, inputFile in INPUT_FILES.items():
-    # read data from file
-    freqData = []
-    irData = []
-    modes = []
-    labels = []
-    modeFreqs = []
-    modeIR = []
-    scalingFactors = []
-    unscaledFreq = []
-
-    with open(workingDir + moleculeName + ".out", "r") as f:
-        for line in f.readlines()[2:]:
-            data = line.split("\t")
-            freqData.append(float(data[0]))
-            irData.append(float(data[1]))
-            if len(data) > 3:
-                modes.append(int(data[3]))
-                labels.append(data[4])
-                modeFreqs.append(float(data[5]))
-                modeIR.append(float(data[6]))
-                scalingFactors.append(float(data[7]))
-                unscaledFreq.append(float(data[8]))
-
-
-    moleculeData.update({
-        moleculeName:{
-            "freqs":freqData,
-            "irData":irData,
-            "modes":modes,
-            "labels":labels,
-            "modeFreqs":modeFreqs,
-            "modeIR":modeIR,
-            "scalingFactors":scalingFactors,
-            "unscaledFreqs":unscaledFreq,
-            "peaks":findPeaks([10000 / x for x in freqData], irData, WAV_X_MAX,
-                WINDOW_SIZE, N_SIGMA, COALESCE_WINDOW, HIGH_PASS, moleculeName, MPL_PLOT)
-        }
-    })
-
-
-    # write to config file with some offset
-    sheet = wb["config"]
-    sheet["A" + str(configRow)] = moleculeName + " offset"
-    sheet["B" + str(configRow)] = currentOffset
-    configRow = configRow + 1  # increment current row
-    currentOffset += DOFFSET   # increment offset
-
-    # write to data sheet
-    wb.create_sheet(moleculeName)
-    sheet = wb[moleculeName]
-
-    # Spectrum Data
-    sheet["A1"] = "Spectrum"      # write headers
-    sheet["A2"] = "Freq (cm^-1)"
-    sheet["B2"] = "Wavelength (um)"
-    sheet["C2"] = "IR Act"
-    sheet["D2"] = "IR Act adj"
-
-    dataRow = 3
-    for freq, ir in zip(freqData, irData):
-        sheet["A" + str(dataRow)] = freq
-        sheet["B" + str(dataRow)] = "=10000/A" + str(dataRow)
-        sheet["C" + str(dataRow)] = ir
-        sheet["D" + str(dataRow)] = "=C" + str(dataRow) + " + config!B" + str(configRow - 1)  # subtract one to go back
-
-        dataRow += 1
-
-    # Normal Modes
-    sheet["F1"] = "Normal Modes"      # write headers
-    sheet["F2"] = "Mode"
-    sheet["G2"] = "Label"
-    sheet["H2"] = "Freq (cm^-1)"
-    sheet["I2"] = "IR Act"
-    sheet["J2"] = "Scaling Factor"
-    sheet["K2"] = "Unscaled freq"
-
-    dataRow = 3
-    for mode, label, freq, ir, scale, unscaled in zip(modes, labels, modeFreqs, modeIR, scalingFactors, unscaledFreq):
-        sheet["F" + str(dataRow)] = mode
-        sheet["G" + str(dataRow)] = label
-        sheet["H" + str(dataRow)] = freq
-        sheet["I" + str(dataRow)] = ir
-        sheet["J" + str(dataRow)] = scale
-        sheet["K" + str(dataRow)] = unscaled
-
-        dataRow += 1
-
-    sheet.merge_cells("A1:D1")
-    sheet.merge_cells("F1:K1")
-
-    # update sizes
-    dims = {}
-    for row in sheet.rows:
-        for cell in row:
-            if cell.value:
-                dims[cell.column_letter] = max((dims.get(cell.column_letter, 0), len(str(cell.value))))
-    for col, value in dims.items():
-        sheet.column_dimensions[col].width = value
-
-
-
-###############################################################################
-#
-#                         Plots
-#
-###############################################################################
-
-# label styling
-axisFont = CharacterProperties(sz=AXIS_FONT_SIZE * 100)       # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
-axisTitleFont = CharacterProperties(sz=AXIS_TITLE_FONT_SIZE * 100)  # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
-labelFont = CharacterProperties(sz=LABEL_FONT_SIZE * 100)     # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
-pp = ParagraphProperties(defRPr=axisTitleFont)
-
-
-freqChart = ScatterChart()
-freqChart.y_axis.title = "IR Activity"
-freqChart.x_axis.title = "Frequency (cm^-1)"
-freqChart.x_axis.delete = False
-freqChart.y_axis.delete = False
-freqChart.x_axis.scaling.max = FREQ_X_MAX
-freqChart.x_axis.scaling.min = FREQ_X_MIN
-# tick marks
-freqChart.x_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
-freqChart.y_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
-# axis titles
-freqChart.x_axis.title.tx.rich.p[0].pPr = pp
-freqChart.y_axis.title.tx.rich.p[0].pPr = pp
-
-
-wavChart = ScatterChart()
-wavChart.y_axis.title = "IR Activity"
-wavChart.x_axis.title = "Wavelength (µm)"
-wavChart.x_axis.delete = False
-wavChart.y_axis.delete = False
-wavChart.x_axis.scaling.max = WAV_X_MAX
-wavChart.x_axis.scaling.min = WAV_X_MIN
-# tick marks
-wavChart.x_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
-wavChart.y_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
-# axis titles
-wavChart.x_axis.title.tx.rich.p[0].pPr = pp
-wavChart.y_axis.title.tx.rich.p[0].pPr = pp
-
-
-for moleculeName, inputFile in INPUT_FILES.items():
-    sheet = wb[moleculeName]
-    npoints = len(moleculeData[moleculeName]["freqs"])
-    freqXData = Reference(sheet, min_col=1, max_col=1, min_row=3, max_row=2 + npoints)
-    wavXData = Reference(sheet, min_col=2, max_col=2, min_row=3, max_row=2 + npoints)
-
-    yData = Reference(sheet, min_col=4, max_col=4, min_row=3, max_row=2 + npoints)
-
-    freqSeries = Series(yData, freqXData, title_from_data=False, title=moleculeName)
-    wavSeries = Series(yData, wavXData, title_from_data=False, title=moleculeName)
-
-    # add data labels for peaks
-    labels = []
-    peaks = moleculeData[moleculeName]["peaks"]
-    for i in range(len(wavXData)):
-        if i in peaks:
-            labels.append(DataLabel(i, showVal=False, showCatName=True, showLeaderLines=True, numFmt="[<0.01]0.E+00;0.00", dLblPos="t"))
+if PIPELINE:
+    stages = [("prefetch", prefetch, 1), ("broaden", broaden, PIPELINE_THREADS)]
+    for moleculeName, data in pipeline.pipeline(moleculeNames, stages, PIPELINE_QUEUE_SIZE):
+        moleculeData[moleculeName] = data
+        if builder is not None:
+            with instrumentation.stage("writeSheet", molecule=moleculeName):
+                builder.add(moleculeName, data)
+        if previewRenderer is not None:
+            previewRenderer.submit(moleculeName, [10000 / x for x in data["freqs"]], data["irData"], data["peaks"],
+                                   WAV_X_MAX)
+else:
+    for moleculeName in moleculeNames:
+        if store is not None:
+            # read slices from the store rather than building lists
+            freqData = store.grid
+            irData = store.spectrum(moleculeName)
+            modes = store.modes(moleculeName)
         else:
-            labels.append(DataLabel(i, showVal=False, showCatName=False, showLeaderLines=True, numFmt="[<0.01]0.E+00;0.00"))
-
-
-    wavSeries.dLbls = DataLabelList(labels)
-    wavSeries.dLbls.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=labelFont), endParaRPr=labelFont)])
-
-    
-    freqChart.series.append(freqSeries)
-    wavChart.series.append(wavSeries)
-
-
-sheet = wb["config"]
-sheet.add_chart(freqChart)
-sheet.add_chart(wavChart)
+            with instrumentation.stage("readOutput", molecule=moleculeName):
+                freqData, irData, modes = workbook.readOutputFile(workingDir + moleculeName + ".out")
+
+        moleculeData[moleculeName] = exportData(moleculeName, freqData, irData, modes)
+        if previewRenderer is not None:
+            wavData = [10000 / x for x in freqData]
+            previewRenderer.submit(moleculeName, wavData, irData, moleculeData[moleculeName]["peaks"], WAV_X_MAX)
+
+def mergeCluster(moleculeName, memberNames):
+    """Entry of moleculeData for the Boltzmann weighted mean of the members of a cluster, on the grid of the first"""
+    if any(name not in INPUT_FILES for name in memberNames):
+        raise ValueError("Only molecules in INPUT_FILES have an energy to be Boltzmann weighted by, set "
+                         "SIMILARITY_MERGE to \"representative\" to cluster ensembles")
+    members = [moleculeData[name] for name in memberNames]
+    energies = ensemble.conformerEnergies([ir_spectra.parseLog(INPUT_FILES[name], PARSE_CACHE_DIR)
+                                           for name in memberNames])
+    weights = ensemble.boltzmannWeights(energies, TEMP)
+    print("   ", moleculeName, "merged with weights",
+          ", ".join(f"{name} {weight:.3f}" for name, weight in zip(memberNames, weights)))
+
+    freqData = members[0]["freqs"]
+    irData = sum(w * numpy.interp(freqData, data["freqs"], data["irData"]) for w, data in zip(weights, members))
+    modes, offsets = ModeTable.merge([data["modes"] for data in members])
+    act = modes.act * numpy.repeat(weights, numpy.diff(offsets))
+    modes = ModeTable.fromColumns(modes.label, modes.freq, act, modes.scale, modes.unscaled)
+    return exportData(moleculeName, freqData, irData.tolist(), modes)
+
+def clusterMolecules(moleculeData):
+    """
+    Clusters the molecules by the similarity of their spectra and keeps one
+    entry per cluster, see SIMILARITY_THRESHOLD. Returns (moleculeData of the
+    clusters, names of the molecules left out)
+    """
+    names = list(moleculeData)
+    with instrumentation.stage("cluster"):
+        _, matrix = spectral_similarity.spectrumMatrix([moleculeData[name]["freqs"] for name in names],
+                                                       [moleculeData[name]["irData"] for name in names])
+        representative, similarity = spectral_similarity.clusterSpectra(matrix, SIMILARITY_THRESHOLD)
+
+    clustered = {}
+    for rep, members in spectral_similarity.clusters(representative).items():
+        if len(members) > 1:
+            print(names[rep], "represents", ", ".join(f"{names[m]} ({similarity[m]:.3f})" for m in members[1:]))
+        if SIMILARITY_MERGE == "boltzmann" and len(members) > 1:
+            clustered[names[rep]] = mergeCluster(names[rep], [names[m] for m in members])
+        else:
+            clustered[names[rep]] = moleculeData[names[rep]]
+    instrumentation.count("clusters", len(clustered))
+    return clustered, [name for name in names if name not in clustered]
+
+prunedMolecules = []
+if SIMILARITY_THRESHOLD is not None:
+    moleculeData, prunedMolecules = clusterMolecules(moleculeData)
+
+def sheetPeaks(moleculeName, freqData, irData):
+    """Peaks of a molecule kept from an earlier run, for its chart labels"""
+    return peak_finding.findPeaks([10000 / x for x in freqData], irData, WAV_X_MAX, WINDOW_SIZE, N_SIGMA,
+                                  COALESCE_WINDOW, HIGH_PASS, moleculeName, False, INCLUDE_ALL_LOCAL_MAX_RANGES)
+
+if OUTPUT_EXCEL_FILE is not None:
+    with instrumentation.stage("workbook"):
+        if SHARD_MAX_MOLECULES is not None or SHARD_MAX_CELLS is not None:
+            if UPDATE_EXCEL_FILE:
+                raise ValueError("Sharded workbooks are always written in full, set UPDATE_EXCEL_FILE to False")
+            workbook.writeShardedWorkbooks(OUTPUT_EXCEL_FILE, moleculeData, DOFFSET, SHARD_MAX_MOLECULES,
+                                           SHARD_MAX_CELLS, SHARD_PROCESSES, (FREQ_X_MIN, FREQ_X_MAX),
+                                           (WAV_X_MIN, WAV_X_MAX), AXIS_FONT_SIZE, AXIS_TITLE_FONT_SIZE,
+                                           LABEL_FONT_SIZE, PEAK_LABEL_MODES)
+        elif UPDATE_EXCEL_FILE:
+            workbook.updateWorkbook(OUTPUT_EXCEL_FILE, moleculeData, REMOVE_MOLECULES + prunedMolecules, sheetPeaks,
+                                    DOFFSET, (FREQ_X_MIN, FREQ_X_MAX), (WAV_X_MIN, WAV_X_MAX),
+                                    AXIS_FONT_SIZE, AXIS_TITLE_FONT_SIZE, LABEL_FONT_SIZE, PEAK_LABEL_MODES)
+        else:
+            if builder is not None:
+                wb = builder.finish()
+            else:
+                wb = workbook.buildWorkbook(moleculeData, DOFFSET, (FREQ_X_MIN, FREQ_X_MAX), (WAV_X_MIN, WAV_X_MAX),
+                                            AXIS_FONT_SIZE, AXIS_TITLE_FONT_SIZE, LABEL_FONT_SIZE,
+                                            labelModes=PEAK_LABEL_MODES)
+            with instrumentation.stage("save"):
+                # the chart series are saved with it so a later UPDATE_EXCEL_FILE run need not read the sheets back
+                workbook.saveWorkbook(wb, OUTPUT_EXCEL_FILE, workbook.moleculeSeries(moleculeData, PEAK_LABEL_MODES))
 
 
 
@@ -397,11 +352,23 @@ sheet.add_chart(wavChart)
 #
 ###############################################################################
 
-wb.save(filename=OUTPUT_EXCEL_FILE)
+if previewRenderer is not None:
+    with instrumentation.stage("previews"):
+        print("Peak previews in", previewRenderer.close())
 
 end = timer()
 
+if spectrumCache is not None:
+    stats = spectrumCache.stats()
+    print(f"Spectrum cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries "
+          f"({stats['bytes'] / 2**20:.1f} MB)")
+
 print()
 print()
-print(f"Finished processing {len(INPUT_FILES.keys())} files in {end - start} seconds")
+print(f"Finished processing {len(moleculeNames)} files in {end - start} seconds")
+
+if INSTRUMENTATION_REPORT is not None:
+    print()
+    instrumentation.printSummary()
+    instrumentation.writeReport(INSTRUMENTATION_REPORT)
 
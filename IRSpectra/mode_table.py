@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Normal mode tables.
+
+ModeTable keeps the mode, label, freq, act, scale and unscaled columns in one
+numpy structured array so they do not have to travel as parallel lists.
+NormalMode is a light record for the odd single mode.
+
+@author: aiden
+"""
+
+import numpy
+
+
+# one row per mode
+MODE_DTYPE = numpy.dtype([
+    ("mode", "i4"),
+    ("label", "U8"),
+    ("freq", "f8"),      # scaled frequency
+    ("act", "f8"),
+    ("scale", "f8"),
+    ("unscaled", "f8"),
+])
+
+
+class NormalMode:
+    __slots__ = MODE_DTYPE.names
+
+    def __init__(self, mode, label, freq, act, scale=1., unscaled=None):
+        self.mode = mode
+        self.label = label
+        self.freq = freq
+        self.act = act
+        self.scale = scale
+        self.unscaled = freq if unscaled is None else unscaled
+
+    def __repr__(self):
+        return f"NormalMode({self.mode}, {self.label!r}, {self.freq}, {self.act}, {self.scale}, {self.unscaled})"
+
+    def astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class ModeTable:
+    def __init__(self, data=None):
+        """Wraps a structured array with MODE_DTYPE (an empty table if data is None)"""
+        if data is None:
+            data = numpy.zeros(0, dtype=MODE_DTYPE)
+        self.data = numpy.asarray(data, dtype=MODE_DTYPE)
+
+    @classmethod
+    def fromColumns(cls, labels, freq, act, scale=1., unscaled=None, mode=None):
+        """
+        Builds a table from column arrays. Modes are numbered from 1 unless
+        mode is given, unscaled defaults to freq
+        """
+        data = numpy.zeros(len(freq), dtype=MODE_DTYPE)
+        data["mode"] = numpy.arange(1, len(freq) + 1) if mode is None else mode
+        data["label"] = labels
+        data["freq"] = freq
+        data["act"] = act
+        data["scale"] = scale
+        data["unscaled"] = freq if unscaled is None else unscaled
+        return cls(data)
+
+    @classmethod
+    def fromRecords(cls, records):
+        """Builds a table from a list of NormalMode"""
+        return cls(numpy.array([r.astuple() for r in records], dtype=MODE_DTYPE))
+
+    @staticmethod
+    def merge(tables):
+        """
+        Concatenates the tables of several molecules. Returns (table, offsets)
+        where the modes of tables[i] are rows offsets[i]:offsets[i + 1]
+        """
+        offsets = numpy.zeros(len(tables) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(t) for t in tables])
+        if not tables:
+            return ModeTable(), offsets
+        return ModeTable(numpy.concatenate([t.data for t in tables])), offsets
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or numpy.dtype(dtype) == self.data.dtype:
+            return self.data.copy() if copy else self.data
+        return self.data.astype(dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for row in self.data:
+            yield NormalMode(*row.item())
+
+    def __getitem__(self, index):
+        """An int gives a NormalMode, slices and masks give a ModeTable view"""
+        if isinstance(index, (int, numpy.integer)):
+            return NormalMode(*self.data[index].item())
+        return ModeTable(self.data[index])
+
+    def __repr__(self):
+        return f"ModeTable({len(self)} modes)"
+
+    # column views, these do not copy
+    @property
+    def mode(self):
+        return self.data["mode"]
+
+    @property
+    def label(self):
+        return self.data["label"]
+
+    @property
+    def freq(self):
+        return self.data["freq"]
+
+    @property
+    def act(self):
+        return self.data["act"]
+
+    @property
+    def scale(self):
+        return self.data["scale"]
+
+    @property
+    def unscaled(self):
+        return self.data["unscaled"]
+
+    def sticks(self):
+        """(freq, act) views to hand to the broadening routines"""
+        return self.data["freq"], self.data["act"]
+
+    def window(self, low, high):
+        """Modes with low <= freq <= high"""
+        return self[(self.freq >= low) & (self.freq <= high)]
+
+    def threshold(self, minAct):
+        """Modes with act >= minAct"""
+        return self[self.act >= minAct]
+
+    def imaginary(self):
+        """Imaginary modes, which cclib reports as negative frequencies"""
+        return self[self.unscaled < 0]
+
+    def real(self):
+        """Modes with real (non negative) frequencies"""
+        return self[self.unscaled >= 0]
+
+    def sortBy(self, field="freq", descending=False):
+        order = numpy.argsort(self.data[field], kind="stable")
+        return ModeTable(self.data[order[::-1] if descending else order])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Assignment of peaks to the normal modes that produce them.
+
+The broadened spectrum at a peak is the sum of one lorentzian per mode, so
+each mode's share of the intensity there is its lorentzian at the peak over
+the spectrum. A lorentzian falls to 1 / (1 + 4 n^2) of its height n FWHM
+from its centre, so only the modes within a few FWHM of a peak are
+evaluated: the modes are sorted once, the window of each peak is found by
+bisection and the (peak, mode) pairs in the windows are evaluated together
+as one flat array, in the compressed sparse row layout. The cost grows with
+the number of pairs in the windows rather than peaks x modes.
+
+@author: aiden
+"""
+
+import numpy
+
+
+WINDOW_FWHM = 5       # modes further than this many FWHM from a peak are not evaluated
+MIN_CONTRIBUTION = 0.05  # smallest fraction of a peak's intensity a mode is assigned it for
+
+
+def modeContributions(positions, freq, act, FWHM, totals=None, windowFWHM=WINDOW_FWHM):
+    """
+    Contribution of every mode within windowFWHM * FWHM of each of
+    positions to the lorentzian broadened spectrum there, as a fraction of
+    totals (the spectrum at each position). When totals is None the
+    fractions are of the sum over the modes in the window instead.
+
+    Returns (offsets, modeIndex, fraction) where the contributions to
+    positions[p] are modeIndex[offsets[p]:offsets[p + 1]] (indices into freq)
+    and the matching slice of fraction, largest first
+    """
+    positions = numpy.asarray(positions, dtype="d")
+    freq = numpy.asarray(freq, dtype="d")
+    act = numpy.asarray(act, dtype="d")
+
+    order = numpy.argsort(freq, kind="stable")
+    sortedFreq = freq[order]
+    halfWidth = windowFWHM * FWHM
+    lo = numpy.searchsorted(sortedFreq, positions - halfWidth, "left")
+    hi = numpy.searchsorted(sortedFreq, positions + halfWidth, "right")
+
+    counts = hi - lo
+    offsets = numpy.zeros(len(positions) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+
+    # one element per (position, mode in its window) pair
+    owner = numpy.repeat(numpy.arange(len(positions)), counts)
+    modeIndex = order[numpy.arange(offsets[-1]) - offsets[owner] + lo[owner]]
+
+    a = FWHM**2. / 4.
+    d = positions[owner] - freq[modeIndex]
+    intensity = act[modeIndex] * a / (d * d + a)
+
+    if totals is None:
+        totals = numpy.bincount(owner, intensity, minlength=len(positions))
+    totals = numpy.asarray(totals, dtype="d")[owner]
+    fraction = numpy.divide(intensity, totals, out=numpy.zeros_like(intensity), where=totals > 0)
+
+    # largest first within each position
+    ranked = numpy.lexsort((-fraction, owner))
+    return offsets, modeIndex[ranked], fraction[ranked]
+
+
+def assignPeaks(freqData, irData, peaks, modes, FWHM, minFraction=MIN_CONTRIBUTION, windowFWHM=WINDOW_FWHM):
+    """
+    Assigns each of peaks (indices into freqData) to the modes of the
+    ModeTable modes that give at least minFraction of the spectrum irData
+    there. Returns a list with one [(mode row, fraction)] per peak, largest
+    first
+    """
+    if len(peaks) == 0 or len(modes) == 0:
+        return [[] for _ in peaks]
+
+    freqData = numpy.asarray(freqData, dtype="d")
+    irData = numpy.asarray(irData, dtype="d")
+    peaks = numpy.asarray(peaks, dtype=numpy.int64)
+    offsets, modeIndex, fraction = modeContributions(freqData[peaks], modes.freq, modes.act, FWHM, irData[peaks],
+                                                     windowFWHM)
+
+    assignments = []
+    for begin, end in zip(offsets[:-1], offsets[1:]):
+        kept = fraction[begin:end] >= minFraction
+        assignments.append(list(zip(modeIndex[begin:end][kept].tolist(), fraction[begin:end][kept].tolist())))
+    return assignments
+
+
+def labelText(assignment, modes, maxModes=2):
+    """Short text for a peak's chart label, e.g. "12 64%, 13 21%" for its largest maxModes modes"""
+    return ", ".join(f"{modes.mode[row]} {fraction:.0%}" for row, fraction in assignment[:maxModes])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Peak picking for the chart data labels.
+
+@author: aiden
+"""
+
+import math
+
+
+def mean(data):
+    return sum(data) / len(data)
+
+def stdev(data):
+    m = mean(data)
+    s = 0
+    for d in data:
+        s += (d - m)**2
+
+    return math.sqrt(s / len(data))
+
+def getWindow(data, center, sideLength):
+    if center + sideLength < len(data) and center - sideLength > 0:
+        return data[center - sideLength : center + sideLength + 1]
+    elif center + sideLength >= len(data):
+        return data[len(data) - 1 - sideLength * 2:]
+    else:
+        return data[0:sideLength * 2 + 1]
+
+def isLocalMax(data, i):
+    if i > 0 and i < len(data) - 1:
+        return (data[i] > data[i + 1] and data[i] > data[i - 1])
+    else:
+        return False
+
+# peak algorithm based upon this research paper:
+# https://www.researchgate.net/publication/228853276_Simple_Algorithms_for_Peak_Detection_in_Time-Series
+# An example of its operation is shown here:
+# https://observablehq.com/@yurivish/peak-detection
+# Method assumes an evenly spaced time series, this is approximately true for
+# the usable range of the data we are looking at
+def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass, molName, plot,
+              includeAllLocalMaxRanges=()):
+    """
+    Returns the indices of the peaks in dataY. Every local maximum strictly
+    inside one of includeAllLocalMaxRanges, as (low, high) in dataX units, is
+    a peak
+    """
+    peaks = []
+    lastPeakIndex = -1
+    for i in range(len(dataY)):
+        if dataX[i] > max_x:  # data from highest to lowest and reversing
+                               # will mess up indexing, so just skip it
+            continue
+
+
+        # peak was not added, so check to see if is in one of the include-all-local-max
+        # regions
+        xVal = dataX[i]
+        if any([xVal > r[0] and xVal < r[1] for r in includeAllLocalMaxRanges]):
+            if isLocalMax(dataY, i):
+                peaks.append(i)
+                lastPeakIndex = -1  # reset to negative number so no coalesce
+                continue
+
+
+        window = getWindow(dataY, i, windowSize)
+        m = mean(window)
+        s = stdev(window)
+
+        # potential peak, so make sure it is not too close to another peak
+        if dataY[i] - m > nsigma * s and dataY[i] > highPass:
+            if lastPeakIndex > 0:  # there is a previous peak
+                if i - lastPeakIndex < coalesceWindow:  # choose maximum if within window
+                    if dataY[i] > dataY[lastPeakIndex]:
+                        peaks[-1] = i
+                        lastPeakIndex = i
+                    # no changes made otherwise
+                else:
+                    peaks.append(i)
+                    lastPeakIndex = i
+            else:
+                peaks.append(i)
+                lastPeakIndex = i
+
+    if plot:
+        import matplotlib.pyplot as plt  # only loaded when plotting, it is slow to import
+
+        print([dataX[i] for i in peaks])
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        ax.plot(dataX, dataY)
+        ax.scatter([dataX[i] for i in peaks], [dataY[i] for i in peaks], color="green")
+        ax.set_xlim(0, max_x)
+        fig.suptitle(molName)
+        plt.pause(5)
+
+    return peaks
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming pipeline of concurrent stages.
+
+Each stage runs in its own threads and hands its results to the next stage
+through a bounded queue, so that reading and parsing one molecule, broadening
+another and writing the sheet of a third overlap instead of every molecule
+going through one phase before any starts the next. A stage that gets ahead
+blocks when the queue after it is full (backpressure), so memory is bounded
+by the queue sizes however many molecules there are.
+
+Threads share the GIL: file I/O and numpy's inner loops release it and so
+overlap with other stages, pure python work (the cclib parse, openpyxl)
+does not.
+
+@author: aiden
+"""
+
+import queue
+import threading
+
+
+_END = object()  # follows the last item on a queue
+_POLL = 0.1      # seconds between checks for a failed stage while blocked on a queue
+
+
+def _put(q, item, stop):
+    """Puts item on q, giving up if stop is set while waiting for room"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    """Takes the next item from q, or _END if stop is set while waiting"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def pipeline(items, stages, queueSize=2):
+    """
+    Passes each item through stages, [(name, function, threads)]. The first
+    function is called with the item and each later one with what the stage
+    before it returned. Every stage runs in its own threads (more than one
+    lets a slow stage work on several items at once) and at most queueSize
+    items wait between two stages.
+
+    Yields what the last stage returns, in the order of items. The first
+    exception raised in a stage stops the pipeline and is raised here
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(queueSize) for _ in range(len(stages) + 1)]
+    # each thread stops at the first _END it takes, so a queue gets one per thread reading it
+    readers = [count for _, _, count in stages] + [1]
+
+    def feed():
+        try:
+            for index, item in enumerate(items):
+                if not _put(queues[0], (index, item), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        for _ in range(readers[0]):
+            _put(queues[0], _END, stop)
+
+    def work(stage, function, remaining):
+        inQueue, outQueue = queues[stage], queues[stage + 1]
+        while True:
+            job = _get(inQueue, stop)
+            if job is _END:
+                break
+            index, value = job
+            try:
+                result = function(value)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                break
+            if not _put(outQueue, (index, result), stop):
+                break
+        # the last thread of the stage to finish passes the end on
+        with remaining["lock"]:
+            remaining["threads"] -= 1
+            last = remaining["threads"] == 0
+        if last:
+            for _ in range(readers[stage + 1]):
+                _put(outQueue, _END, stop)
+
+    threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+    for stage, (name, function, count) in enumerate(stages):
+        remaining = {"threads": count, "lock": threading.Lock()}
+        threads += [threading.Thread(target=work, args=(stage, function, remaining), name=f"pipeline-{name}-{i}",
+                                     daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        # threads in a stage can finish out of order, so results wait here until their turn
+        pending = {}
+        nextIndex = 0
+        while True:
+            job = _get(queues[-1], stop)
+            if job is _END:
+                break
+            index, result = job
+            pending[index] = result
+            while nextIndex in pending:
+                yield pending.pop(nextIndex)
+                nextIndex += 1
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()  # also stops the threads when the caller stops early
+        for thread in threads:
+            thread.join()
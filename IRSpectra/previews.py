@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless previews of the chosen peaks.
+
+Renders the same spectrum and peak plot as findPeaks does with MPL_PLOT, but
+to PNG or SVG files with the Agg backend, so no display is needed and nothing
+waits on a window. An HTML contact sheet shows every preview on one page.
+
+@author: aiden
+"""
+
+import html
+import multiprocessing
+import os
+
+
+def renderPreview(fileName, dataX, dataY, peaks, max_x, molName):
+    """Plots dataY against dataX with the peaks marked and saves it to fileName (.png or .svg)"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    # a bare Figure rather than pyplot so no GUI backend is ever touched
+    fig = Figure(figsize=(8, 4.5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(dataX, dataY)
+    ax.scatter([dataX[i] for i in peaks], [dataY[i] for i in peaks], color="green")
+    for i in peaks:
+        if dataX[i] <= max_x:
+            ax.annotate(f"{dataX[i]:.2f}", (dataX[i], dataY[i]), textcoords="offset points", xytext=(0, 4),
+                        ha="center", fontsize=7)
+    ax.set_xlim(0, max_x)
+    fig.suptitle(molName)
+    fig.savefig(fileName, dpi=100)
+    return fileName
+
+
+class PreviewRenderer:
+    def __init__(self, directory, fmt="png", processes=1):
+        """
+        Renders previews into directory as fmt ("png" or "svg"). With more
+        than one process they are rendered by worker processes in the
+        background while the caller carries on
+        """
+        if fmt not in ("png", "svg"):
+            raise ValueError(f"Unknown preview format {fmt}, use png or svg")
+        self.directory = directory
+        self.fmt = fmt
+        self.entries = []  # [(molecule name, file name, peak x values)]
+        self._pending = []
+        self._pool = None
+        os.makedirs(directory, exist_ok=True)
+
+        # the drivers are scripts without a main guard, which spawned workers
+        # would run again, so workers are only used where they can be forked
+        if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self._pool = multiprocessing.get_context("fork").Pool(processes)
+
+    def submit(self, molName, dataX, dataY, peaks, max_x):
+        """Queues the preview of one molecule"""
+        fileName = os.path.join(self.directory, f"{molName}.{self.fmt}")
+        self.entries.append((molName, fileName, [dataX[i] for i in peaks]))
+        args = (fileName, list(dataX), list(dataY), list(peaks), max_x, molName)
+        if self._pool is not None:
+            self._pending.append(self._pool.apply_async(renderPreview, args))
+        else:
+            renderPreview(*args)
+
+    def close(self):
+        """
+        Waits for the previews to finish and writes index.html, the contact
+        sheet, to the preview directory. Returns its file name
+        """
+        if self._pool is not None:
+            for result in self._pending:
+                result.get()  # raises any error from the worker
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._pending = []
+        return writeContactSheet(os.path.join(self.directory, "index.html"), self.entries)
+
+
+def writeContactSheet(fileName, entries):
+    """HTML page showing every preview in entries, [(molecule name, image file, peak x values)]"""
+    directory = os.path.dirname(os.path.abspath(fileName))
+    with open(fileName, "w") as f:
+        f.write("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n<title>Peak previews</title>\n")
+        f.write("<style>\n"
+                "body { font-family: sans-serif; }\n"
+                ".sheet { display: flex; flex-wrap: wrap; gap: 12px; }\n"
+                "figure { margin: 0; width: 400px; }\n"
+                "img { width: 100%; border: 1px solid #ccc; }\n"
+                "figcaption { font-size: 12px; }\n"
+                "</style>\n</head>\n<body>\n")
+        f.write(f"<h1>Peak previews ({len(entries)} molecules)</h1>\n<div class=\"sheet\">\n")
+        for molName, imageFile, peakXs in entries:
+            src = html.escape(os.path.relpath(os.path.abspath(imageFile), directory))
+            peaksText = ", ".join(f"{x:.2f}" for x in peakXs)
+            f.write(f"<figure id=\"{html.escape(molName)}\"><a href=\"{src}\"><img src=\"{src}\" loading=\"lazy\" "
+                    f"alt=\"{html.escape(molName)}\"></a>\n<figcaption><b>{html.escape(molName)}</b> "
+                    f"{len(peakXs)} peaks: {peaksText}</figcaption></figure>\n")
+        f.write("</div>\n</body>\n</html>\n")
+    return fileName
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long running spectra service.
+
+Watches a directory for Gaussian/ORCA logs and writes, for every new or
+changed log, the .out file, a .npz with the spectrum and mode table and a
+.peaks.json with the chosen peaks to the output directory. The process stays
+up, so the imports, the parses and the spectrum cache stay warm between
+files. A log is processed once its size and modification time have stayed
+the same for one poll, so files still being written are left alone.
+
+A small JSON API is served on localhost:
+
+    GET  /status                    the watched molecules, pending files and errors
+    GET  /molecules/<name>          one molecule's outputs and peaks
+    GET  /spectrum?molecule=<name>&fwhm=4&numpts=2000
+    POST /spectrum                  {"molecule": <name>, "parameters": {"fwhm": 4}}
+
+/spectrum re-broadens a watched molecule with any of the batch_runner
+parameters changed and returns the spectrum and its peaks, without writing
+anything. Run with
+
+    python spectra_service.py logs --output spectra --port 8765
+
+@author: aiden
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer as timer
+
+import numpy
+
+import batch_runner
+import ir_spectra
+import peak_assignment
+import peak_finding
+import spectrum_cache
+
+
+DEFAULT_EXTENSIONS = (".log",)
+
+
+class UnknownMolecule(KeyError):
+    """A molecule the service is not watching, answered with a 404"""
+
+
+class SpectraService:
+    def __init__(self, watchDir, outputDir, parameters=None, peakSettings=None, extensions=DEFAULT_EXTENSIONS,
+                 parseCacheDir=None, spectrumCacheDir=None, threads=1):
+        """
+        Watches watchDir for files ending in one of extensions and writes
+        their outputs to outputDir. parameters and peakSettings override
+        batch_runner.DEFAULT_PARAMETERS and DEFAULT_WORKBOOK. threads logs are
+        processed at once when several arrive together
+        """
+        self.watchDir = os.path.abspath(watchDir)
+        self.outputDir = os.path.abspath(outputDir)
+        self.parameters = {**batch_runner.DEFAULT_PARAMETERS, **(parameters or {})}
+        self.peakSettings = {**batch_runner.DEFAULT_WORKBOOK, **(peakSettings or {})}
+        self.extensions = tuple(extensions)
+        self.parseCacheDir = parseCacheDir
+        self.spectrumCache = None
+        if spectrumCacheDir is not None:
+            self.spectrumCache = spectrum_cache.SpectrumCache(spectrumCacheDir)
+        self.began = time.time()
+
+        self.lock = threading.Lock()
+        self.seen = {}       # {path: (size, mtime_ns)} at the last poll
+        self.processed = {}  # {path: (size, mtime_ns)} when its outputs were written
+        self.molecules = {}  # {molecule name: {"input", "outputs", "peaks", "updated", "seconds"}}
+        self.errors = {}     # {path: message} for the current version of a file that failed
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads > 1 else None
+        os.makedirs(self.outputDir, exist_ok=True)
+
+    @staticmethod
+    def moleculeName(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def findPeaks(self, moleculeName, xvalues, spectrum):
+        """Peak indices of a spectrum with the peak settings, as in main.py"""
+        s = self.peakSettings
+        return peak_finding.findPeaks([10000 / x for x in xvalues], list(spectrum), s["wavXMax"], s["windowSize"],
+                                      s["nSigma"], s["coalesceWindow"], s["highPass"], moleculeName, False,
+                                      s["includeAllLocalMaxRanges"])
+
+    def peakList(self, peaks, xvalues, spectrum, modes, FWHM):
+        """The peaks as dictionaries, with the modes that produce each one when the peak settings assign them"""
+        peakList = [{"index": int(i), "wavenumber": float(xvalues[i]), "wavelength": float(10000 / xvalues[i]),
+                     "intensity": float(spectrum[i])} for i in peaks]
+        if self.peakSettings["assignPeaks"]:
+            assignments = peak_assignment.assignPeaks(xvalues, spectrum, peaks, modes, FWHM,
+                                                      self.peakSettings["minModeContribution"])
+            for peak, assignment in zip(peakList, assignments):
+                peak["modes"] = [{"mode": int(modes.mode[row]), "label": str(modes.label[row]), "fraction": fraction}
+                                 for row, fraction in assignment]
+        return peakList
+
+    def process(self, path, stat):
+        """Writes the outputs of one log, recording an error instead if it cannot be read"""
+        moleculeName = self.moleculeName(path)
+        base = os.path.join(self.outputDir, moleculeName)
+        p = self.parameters
+        begin = timer()
+        try:
+            ir_spectra.forgetParse(path)  # a changed file is parsed again, do not keep the old one in memory
+            # written to temporary names and moved into place so readers never see half a file
+            xvalues, spectrum, modes = ir_spectra.irSpectra(path, base + ".tmp.out", p["start"], p["end"],
+                                                            p["numpts"], p["fwhm"],
+                                                            batch_runner.scaleTableFunction(p["scaleFactors"]),
+                                                            self.parseCacheDir, p["gridTolerance"], p["autoTolerance"],
+                                                            spectrumCache=self.spectrumCache)
+            peaks = self.peakList(self.findPeaks(moleculeName, xvalues, spectrum), xvalues, spectrum, modes, p["fwhm"])
+
+            os.replace(base + ".tmp.out", base + ".out")
+            numpy.savez(base + ".tmp.npz", xvalues=xvalues, spectrum=spectrum, modes=numpy.asarray(modes))
+            os.replace(base + ".tmp.npz", base + ".npz")
+            with open(base + ".peaks.json.tmp", "w") as f:
+                json.dump({"molecule": moleculeName, "input": path, "peaks": peaks}, f, indent=1)
+            os.replace(base + ".peaks.json.tmp", base + ".peaks.json")
+        except Exception as e:
+            print(f"Could not process {path}: {e}")
+            with self.lock:
+                self.errors[path] = f"{type(e).__name__}: {e}"
+                self.processed[path] = stat  # not retried until the file changes again
+            return None
+
+        with self.lock:
+            self.errors.pop(path, None)
+            self.processed[path] = stat
+            self.molecules[moleculeName] = {
+                "input": path,
+                "outputs": {"out": base + ".out", "npz": base + ".npz", "peaks": base + ".peaks.json"},
+                "peaks": [peak["wavenumber"] for peak in peaks],
+                "updated": time.time(),
+                "seconds": timer() - begin,
+            }
+        print(f"Processed {moleculeName} in {timer() - begin:.3f} seconds")
+        return moleculeName
+
+    def poll(self):
+        """
+        Looks at the watched directory once and processes the logs that are
+        new or changed and have stopped changing. Returns their molecule names
+        """
+        current = {}
+        for entry in os.scandir(self.watchDir):
+            if entry.is_file() and entry.name.endswith(self.extensions):
+                stat = entry.stat()
+                current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = [(path, stat) for path, stat in current.items()
+                 if self.seen.get(path) == stat and self.processed.get(path) != stat]
+        with self.lock:
+            self.seen = current
+            for path in [path for path in self.processed if path not in current]:
+                del self.processed[path]
+                self.errors.pop(path, None)
+                ir_spectra.forgetParse(path)
+            # deleted logs can no longer be re-broadened, their outputs are left in place
+            for moleculeName in [name for name, molecule in self.molecules.items() if molecule["input"] not in current]:
+                del self.molecules[moleculeName]
+
+        if self.pool is not None:
+            done = list(self.pool.map(lambda job: self.process(*job), ready))
+        else:
+            done = [self.process(path, stat) for path, stat in ready]
+        return [name for name in done if name is not None]
+
+    def spectrum(self, moleculeName, overrides):
+        """
+        Re-broadens a watched molecule with the service parameters updated by
+        overrides, returns the spectrum and its peaks as a JSON serializable
+        dictionary
+        """
+        unknown = set(overrides) - set(self.parameters)
+        if unknown:
+            raise ValueError(f"Unknown parameters {', '.join(sorted(unknown))}")
+        with self.lock:
+            molecule = self.molecules.get(moleculeName)
+        if molecule is None:
+            raise UnknownMolecule(moleculeName)
+
+        begin = timer()
+        p = {**self.parameters, **overrides}
+        modes = ir_spectra.scaledModes(ir_spectra.parseLog(molecule["input"], self.parseCacheDir),
+                                       batch_runner.scaleTableFunction(p["scaleFactors"]))
+        freq, act = modes.sticks()
+        xvalues, spectrum = ir_spectra.broadenSticks(freq, act, p["start"], p["end"], p["numpts"], p["fwhm"],
+                                                     p["gridTolerance"], p["autoTolerance"])
+        peaks = self.findPeaks(moleculeName, xvalues, spectrum)
+        return {
+            "molecule": moleculeName,
+            "parameters": p,
+            "x": xvalues.tolist(),
+            "y": spectrum.tolist(),
+            "peaks": self.peakList(peaks, xvalues, spectrum, modes, p["fwhm"]),
+            "seconds": timer() - begin,
+        }
+
+    def status(self):
+        with self.lock:
+            return {
+                "watchDir": self.watchDir,
+                "outputDir": self.outputDir,
+                "uptime": time.time() - self.began,
+                "parameters": self.parameters,
+                "molecules": {name: {key: value for key, value in molecule.items() if key != "peaks"}
+                              for name, molecule in self.molecules.items()},
+                "pending": sorted(path for path, stat in self.seen.items() if self.processed.get(path) != stat),
+                "errors": dict(self.errors),
+            }
+
+    def molecule(self, moleculeName):
+        with self.lock:
+            if moleculeName not in self.molecules:
+                raise UnknownMolecule(moleculeName)
+            return dict(self.molecules[moleculeName])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON API of the SpectraService in self.server.service"""
+
+    def sendJson(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, function):
+        try:
+            self.sendJson(200, function())
+        except UnknownMolecule as e:
+            self.sendJson(404, {"error": f"Unknown molecule {e.args[0]}"})
+        except (ValueError, TypeError) as e:
+            self.sendJson(400, {"error": str(e)})
+        except Exception as e:
+            # the request still gets an answer, and the service keeps running
+            print(f"Could not answer {self.command} {self.path}: {type(e).__name__}: {e}")
+            self.sendJson(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        service = self.server.service
+        if url.path in ("/", "/status"):
+            self.answer(service.status)
+        elif url.path.startswith("/molecules/"):
+            self.answer(lambda: service.molecule(urllib.parse.unquote(url.path[len("/molecules/"):])))
+        elif url.path == "/spectrum":
+            query = dict(urllib.parse.parse_qsl(url.query))
+            moleculeName = query.pop("molecule", None)
+            # values are JSON, so numbers, null and "auto" all work
+            def parse(value):
+                try:
+                    return json.loads(value)
+                except ValueError:
+                    return value
+            self.answer(lambda: service.spectrum(moleculeName, {key: parse(value) for key, value in query.items()}))
+        else:
+            self.sendJson(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != "/spectrum":
+            self.sendJson(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.sendJson(400, {"error": "The request body is not JSON"})
+            return
+        self.answer(lambda: self.server.service.spectrum(request.get("molecule"), request.get("parameters", {})))
+
+    def log_message(self, format, *args):
+        pass  # the service prints what it processes, request lines would drown that out
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """Starts the JSON API for service in a background thread, returns the server (call shutdown() to stop it)"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="spectra-api", daemon=True).start()
+    return server
+
+
+def run(service, interval=1., host="127.0.0.1", port=8765):
+    """Serves the API and polls the watched directory every interval seconds until interrupted"""
+    server = serve(service, host, port) if port is not None else None
+    if server is not None:
+        print(f"Serving http://{host}:{server.server_address[1]}/status")
+    print(f"Watching {service.watchDir}, writing to {service.outputDir}")
+    try:
+        while True:
+            service.poll()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        if server is not None:
+            server.shutdown()
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watches a directory for logs, writes their spectra and serves a "
+                                                 "JSON API to re-broaden them")
+    parser.add_argument("watchDir", help="directory the logs are written to")
+    parser.add_argument("--output", help="directory for the outputs (default watchDir/spectra)")
+    parser.add_argument("--parameters", help="JSON file of parameters and peak settings, as the parameters and "
+                                             "workbook sections of a batch_runner manifest")
+    parser.add_argument("--extensions", default=",".join(DEFAULT_EXTENSIONS),
+                        help="comma separated file endings to watch (default .log)")
+    parser.add_argument("--interval", type=float, default=1., help="seconds between polls (default 1)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve the API on (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="API port (default 8765), 0 for any free port")
+    parser.add_argument("--no-api", action="store_true", help="only watch the directory")
+    parser.add_argument("--parse-cache", default="parse_cache", help="parse cache directory (default parse_cache)")
+    parser.add_argument("--spectrum-cache", help="spectrum cache directory (default none)")
+    parser.add_argument("--threads", type=int, default=1, help="logs processed at once (default 1)")
+    args = parser.parse_args()
+
+    settings = {}
+    if args.parameters:
+        with open(args.parameters, "r") as f:
+            settings = json.load(f)
+    service = SpectraService(args.watchDir, args.output or os.path.join(args.watchDir, "spectra"),
+                             settings.get("parameters"), settings.get("workbook"), args.extensions.split(","),
+                             args.parse_cache, args.spectrum_cache, args.threads)
+    run(service, args.interval, args.host, None if args.no_api else args.port)
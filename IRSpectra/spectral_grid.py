@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Non-uniform grids for broadened spectra.
+
+Points are placed densely within a few FWHM of each mode and sparsely over
+the empty baseline in between. The spacing is chosen from a bound on the
+second derivative of the broadened spectrum so that linear interpolation
+between grid points (what a scatter chart draws) is never further than the
+requested tolerance from the true spectrum.
+
+@author: aiden
+"""
+
+import numpy
+
+import ir_spectra
+
+
+# |f''| of a lorentzian falls from its central maximum to zero at d^2 = g^2 / 3
+# and rises to a second maximum at d = g before decaying. _SHOULDER is the
+# value of d^2 / g^2 on the central lobe with the same height as that second
+# maximum, the root of t^3 + 3t^2 + 15t - 3 = 0
+_SHOULDER = 0.19214327596664296
+
+
+def curvatureBound(low, high, freqs, heights, width):
+    """
+    Upper bound of |f''(x)| for low <= x <= high, where f is the sum of
+    lorentzians of FWHM width centred on freqs. For one lorentzian of height
+    h and half width g at distance d from its centre
+
+        |f''| = h g^2 |6 d^2 - 2 g^2| / (d^2 + g^2)^3
+
+    The bound for each mode is the largest value of this at or beyond the
+    closest point of the interval to the mode
+    """
+    g2 = (width / 2.)**2
+    distance = numpy.maximum(0., numpy.maximum(low - freqs, freqs - high))
+    d2 = distance**2
+    curvature = numpy.abs(heights) * g2 * numpy.abs(6. * d2 - 2. * g2) / (d2 + g2)**3
+    shoulder = (d2 > _SHOULDER * g2) & (d2 <= g2)
+    curvature[shoulder] = numpy.abs(heights[shoulder]) / (2. * g2)
+    return curvature.sum()
+
+
+def adaptiveGrid(start, end, freqs, heights, width, tolerance=None, relTolerance=1e-3, maxStep=None):
+    """
+    Returns grid points from start to end (both included) such that linearly
+    interpolating the broadened spectrum between them is within tolerance of
+    the exact spectrum everywhere. tolerance is absolute, if it is not given
+    relTolerance times the tallest stick height is used. maxStep caps the
+    spacing over empty regions, by default (end - start) / 100
+
+    Each step h from x is accepted once h^2 / 8 * max|f''| <= tolerance on
+    [x, x + h], the standard linear interpolation error bound
+    """
+    freqs = numpy.asarray(freqs, dtype="d")
+    heights = numpy.asarray(heights, dtype="d")
+    if tolerance is None:
+        tolerance = relTolerance * (numpy.abs(heights).max() if len(heights) else 1.)
+    if maxStep is None:
+        maxStep = (end - start) / 100.
+
+    # modes far outside the range still contribute tails, so all of them are kept
+    points = [start]
+    x = start
+    while x < end:
+        h = min(maxStep, end - x)
+        bound = curvatureBound(x, x + h, freqs, heights, width)
+        if bound > 0:
+            allowed = numpy.sqrt(8. * tolerance / bound)
+            if allowed < h:
+                # the bound only drops on a shorter interval, so this step is safe
+                h = allowed
+        x = min(x + h, end)
+        points.append(x)
+
+    return numpy.array(points)
+
+
+def adaptiveSpectrum(start, end, freqs, heights, width, tolerance=None, relTolerance=1e-3, maxStep=None):
+    """Broadens the sticks onto an adaptive grid, returns (xvalues, spectrum)"""
+    xvalues = adaptiveGrid(start, end, freqs, heights, width, tolerance, relTolerance, maxStep)
+    return xvalues, ir_spectra.broadenOnGrid(xvalues, freqs, heights, width)
+
+
+def resampleUniform(xvalues, spectrum, start, end, numpts):
+    """
+    Linearly interpolates a spectrum on any grid onto numpy.linspace(start,
+    end, numpts), for consumers that need evenly spaced points (charts, FFTs).
+    Works on a single spectrum or a (channels x points) array
+    """
+    uniform = numpy.linspace(start, end, numpts)
+    spectrum = numpy.asarray(spectrum)
+    if spectrum.ndim == 1:
+        return uniform, numpy.interp(uniform, xvalues, spectrum)
+    return uniform, numpy.array([numpy.interp(uniform, xvalues, row) for row in spectrum])
+
+
+def uniformPointsForTolerance(start, end, freqs, heights, width, tolerance=None, relTolerance=1e-3):
+    """
+    Approximate number of evenly spaced points needed for the same
+    interpolation error as adaptiveGrid, for comparison. Uses the curvature
+    at the mode centres, which is where it is largest for all but heavily
+    overlapping bands
+    """
+    freqs = numpy.asarray(freqs, dtype="d")
+    heights = numpy.asarray(heights, dtype="d")
+    if tolerance is None:
+        tolerance = relTolerance * numpy.abs(heights).max()
+    inRange = freqs[(freqs >= start) & (freqs <= end)]
+    bound = max((curvatureBound(f, f, freqs, heights, width) for f in inRange),
+                default=curvatureBound(start, end, freqs, heights, width))
+    step = numpy.sqrt(8. * tolerance / bound)
+    return int(numpy.ceil((end - start) / step)) + 1
+
+
+def _localMaxima(xvalues, spectrum, minHeight):
+    """Positions and heights of the interior local maxima above minHeight, refined with a parabola"""
+    y = spectrum
+    i = numpy.flatnonzero((y[1:-1] > y[:-2]) & (y[1:-1] >= y[2:]) & (y[1:-1] > minHeight)) + 1
+    if len(i) == 0:
+        return numpy.zeros(0), numpy.zeros(0)
+
+    # vertex of the parabola through the three points around each maximum
+    x0, x1, x2 = xvalues[i - 1], xvalues[i], xvalues[i + 1]
+    y0, y1, y2 = y[i - 1], y[i], y[i + 1]
+    denom = (x0 - x1) * (x0 - x2) * (x1 - x2)
+    a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / denom
+    b = (x2**2 * (y0 - y1) + x1**2 * (y2 - y0) + x0**2 * (y1 - y2)) / denom
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        vertex = numpy.where(a < 0, -b / (2. * a), x1)
+    return numpy.clip(vertex, x0, x2), y1
+
+
+def _referencePeaks(start, end, freqs, heights, width, minHeight):
+    """Peak positions and heights of the exact spectrum, found on a very fine grid"""
+    numpts = int(numpy.ceil((end - start) / (width / 100.))) + 1
+    xvalues = numpy.linspace(start, end, numpts)
+    spectrum = ir_spectra.broadenOnGrid(xvalues, freqs, heights, width)
+    positions, _ = _localMaxima(xvalues, spectrum, minHeight)
+    return positions, ir_spectra.broadenOnGrid(positions, freqs, heights, width)
+
+
+def samplingError(start, end, numpts, freqs, heights, width, referencePositions, referenceHeights):
+    """
+    Compares the peaks of the spectrum sampled on numpts evenly spaced points
+    with the reference peaks. The sampled peak is the highest sample near each
+    reference peak, its height and position are what findPeaks and the charts
+    see. Returns (relative height error, position error), both the worst over
+    all peaks
+    """
+    xvalues = numpy.linspace(start, end, numpts)
+    spectrum = ir_spectra.broadenOnGrid(xvalues, freqs, heights, width)
+    step = xvalues[1] - xvalues[0]
+
+    heightError = 0.
+    positionError = 0.
+    for position, height in zip(referencePositions, referenceHeights):
+        lo = max(0, int(numpy.floor((position - start) / step)) - 1)
+        hi = min(numpts, lo + 4)
+        best = lo + numpy.argmax(spectrum[lo:hi])
+        heightError = max(heightError, abs(height - spectrum[best]) / height)
+        positionError = max(positionError, abs(position - xvalues[best]))
+
+    return heightError, positionError
+
+
+def chooseNumPoints(start, end, freqs, heights, width, tolerance=0.01, positionTolerance=None,
+                    minRelHeight=0.01, maxPoints=10**6):
+    """
+    Picks the smallest number of evenly spaced points (numpts for
+    numpy.linspace(start, end, numpts)) for which every peak of the broadened
+    spectrum taller than minRelHeight of the tallest is sampled within
+    tolerance of its true height and positionTolerance (default FWHM / 4) of
+    its true position.
+
+    The search starts from the spacing that samples an isolated lorentzian to
+    within tolerance in the worst case and grows the number of points until
+    the sampled peaks match the peaks of the exact spectrum.
+
+    Returns (numpts, report) where report has the chosen step and the
+    estimated height and position errors
+    """
+    freqs = numpy.asarray(freqs, dtype="d")
+    heights = numpy.asarray(heights, dtype="d")
+    if positionTolerance is None:
+        positionTolerance = width / 4.
+
+    spectrumMax = ir_spectra.broadenOnGrid(freqs[(freqs >= start) & (freqs <= end)], freqs, heights, width).max(initial=0.)
+    referencePositions, referenceHeights = _referencePeaks(start, end, freqs, heights, width, minRelHeight * spectrumMax)
+
+    # a lorentzian sampled half a step from its centre is low by 1 - 1 / (1 + (step / FWHM)^2)
+    step = min(width * numpy.sqrt(1. / (1. - tolerance) - 1.), 2. * positionTolerance)
+    numpts = int(numpy.ceil((end - start) / step)) + 1
+    # the worst case is rarely hit, so try coarser grids first
+    numpts = max(3, numpts // 4)
+
+    while True:
+        heightError, positionError = samplingError(start, end, numpts, freqs, heights, width,
+                                                   referencePositions, referenceHeights)
+        if (heightError <= tolerance and positionError <= positionTolerance) or numpts >= maxPoints:
+            break
+        numpts = min(maxPoints, int(numpts * 1.05) + 1)
+
+    report = {
+        "numpts": numpts,
+        "step": (end - start) / (numpts - 1),
+        "heightError": float(heightError),
+        "positionError": float(positionError),
+        "peaks": len(referencePositions),
+    }
+    return numpts, report
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spectral similarity of the molecules in a batch.
+
+Conformers of one molecule often give nearly identical spectra. Every
+spectrum is scaled to unit length on a common grid, so the cosine
+similarity of all pairs is the single matrix product X X^T. It is computed a
+block of rows at a time, keeping only the pairs above the threshold, so the
+full N x N matrix is never held for large batches. Spectra are then
+clustered so that every member of a cluster is at least as similar as the
+threshold to the cluster's representative (leader clustering, in the order
+given), after which each cluster can be replaced by its representative or
+by the Boltzmann weighted mean of its members.
+
+@author: aiden
+"""
+
+import numpy
+
+import spectral_grid
+
+
+# similarity matrix elements computed at once, bounds the memory used by a block of rows
+SIMILARITY_CHUNK_ELEMENTS = 2**22
+
+
+def spectrumMatrix(grids, spectra, start=None, end=None, numpts=None):
+    """
+    Stacks spectra, each on the matching grid in grids, into an (N x points)
+    matrix on one grid. Spectra already sharing a grid are used as they are,
+    otherwise they are resampled onto numpy.linspace(start, end, numpts)
+    (by default spanning every grid with as many points as the longest).
+    Returns (grid, matrix)
+    """
+    grids = [numpy.asarray(grid, dtype="d") for grid in grids]
+    if all(len(grid) == len(grids[0]) and numpy.array_equal(grid, grids[0]) for grid in grids):
+        return grids[0], numpy.array([numpy.asarray(s, dtype="d") for s in spectra]).reshape(len(spectra), -1)
+
+    start = min(grid[0] for grid in grids) if start is None else start
+    end = max(grid[-1] for grid in grids) if end is None else end
+    numpts = max(len(grid) for grid in grids) if numpts is None else numpts
+    matrix = numpy.array([spectral_grid.resampleUniform(grid, s, start, end, numpts)[1]
+                          for grid, s in zip(grids, spectra)])
+    return numpy.linspace(start, end, numpts), matrix
+
+
+def normalizeRows(matrix):
+    """Rows scaled to unit length, rows of zeros are left as zeros"""
+    matrix = numpy.asarray(matrix, dtype="d")
+    norms = numpy.linalg.norm(matrix, axis=1, keepdims=True)
+    return numpy.divide(matrix, norms, out=numpy.zeros_like(matrix), where=norms > 0)
+
+
+def _rowBlocks(n, chunkElements):
+    rows = max(1, chunkElements // max(1, n))
+    for lo in range(0, n, rows):
+        yield lo, min(lo + rows, n)
+
+
+def similarityMatrix(matrix, chunkElements=SIMILARITY_CHUNK_ELEMENTS):
+    """Cosine similarity of every pair of rows of matrix, as an (N x N) array"""
+    unit = normalizeRows(matrix)
+    similarity = numpy.empty((len(unit), len(unit)))
+    for lo, hi in _rowBlocks(len(unit), chunkElements):
+        similarity[lo:hi] = unit[lo:hi] @ unit.T
+    return similarity
+
+
+def similarPairs(matrix, threshold, chunkElements=SIMILARITY_CHUNK_ELEMENTS):
+    """
+    Pairs of rows of matrix with a cosine similarity of at least threshold.
+    Returns (first, second, similarity) arrays with first < second
+    """
+    unit = normalizeRows(matrix)
+    firsts, seconds, similarities = [], [], []
+    for lo, hi in _rowBlocks(len(unit), chunkElements):
+        block = unit[lo:hi] @ unit.T
+        first, second = numpy.nonzero(block >= threshold)
+        upper = second > first + lo
+        firsts.append(first[upper] + lo)
+        seconds.append(second[upper])
+        similarities.append(block[first[upper], second[upper]])
+    if not firsts:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    return numpy.concatenate(firsts), numpy.concatenate(seconds), numpy.concatenate(similarities)
+
+
+def clusterSpectra(matrix, threshold, order=None, chunkElements=SIMILARITY_CHUNK_ELEMENTS):
+    """
+    Clusters the rows of matrix. Going through the rows in order (by
+    default first to last), each row not yet in a cluster becomes the
+    representative of a new one, which takes every other unclustered row
+    with a cosine similarity to it of at least threshold.
+
+    Returns (representative, similarity): for every row the index of the
+    representative of its cluster and its similarity to it
+    """
+    n = len(matrix)
+    first, second, pairSimilarity = similarPairs(matrix, threshold, chunkElements)
+
+    # neighbours of each row in the compressed sparse row layout
+    rows = numpy.concatenate([first, second])
+    cols = numpy.concatenate([second, first])
+    values = numpy.concatenate([pairSimilarity, pairSimilarity])
+    byRow = numpy.argsort(rows, kind="stable")
+    cols, values = cols[byRow], values[byRow]
+    offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=n), out=offsets[1:])
+
+    representative = numpy.full(n, -1, dtype=numpy.int64)
+    similarity = numpy.ones(n)
+    for row in (range(n) if order is None else order):
+        if representative[row] != -1:
+            continue
+        representative[row] = row
+        neighbours = cols[offsets[row]:offsets[row + 1]]
+        free = representative[neighbours] == -1
+        representative[neighbours[free]] = row
+        similarity[neighbours[free]] = values[offsets[row]:offsets[row + 1]][free]
+    return representative, similarity
+
+
+def clusters(representative):
+    """{representative: [members, representative first]} from the result of clusterSpectra, in row order"""
+    members = {}
+    for row, rep in enumerate(representative):
+        members.setdefault(int(rep), [int(rep)])
+        if row != rep:
+            members[int(rep)].append(row)
+    return members
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content addressed on disk cache of broadened spectra.
+
+Entries are keyed by a hash of everything the spectrum depends on (the modes,
+the grid, FWHM, lineshape, scale factors and for Raman the excitation and
+temperature), so changing anything else, such as the Excel offsets or chart
+fonts, reuses the cached spectra. The key also holds CACHE_VERSION, which is
+bumped whenever the broadening code changes what it computes, so old entries
+are never served again and age out. The cache is bounded in size and evicts
+the least recently used entries first, down to EVICT_TO of the limit. Its
+size is tracked as entries are written and the directory is only listed when
+that passes the limit, or every RESCAN_PUTS writes to count entries written
+by other processes.
+
+@author: aiden
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy
+
+
+CACHE_VERSION = 1  # bump when a change to the broadening code changes the spectra it gives
+RESCAN_PUTS = 64   # writes between listings of the directory, to see the entries of other processes
+EVICT_TO = .9      # eviction goes down to this fraction of maxBytes, so a full cache is not listed on every write
+
+
+class SpectrumCache:
+    def __init__(self, directory, maxBytes=512 * 2**20):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = None  # size of the entries as last counted plus those written since, None until counted
+        self._puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(**parts):
+        """
+        Hash of the keyword arguments. numpy arrays are hashed by dtype, shape
+        and contents, everything else by repr
+        """
+        h = hashlib.sha256()
+        h.update(f"version {CACHE_VERSION}".encode())
+        for name in sorted(parts):
+            value = parts[name]
+            h.update(name.encode())
+            if isinstance(value, numpy.ndarray):
+                value = numpy.ascontiguousarray(value)
+                h.update(str(value.dtype).encode())
+                h.update(repr(value.shape).encode())
+                h.update(value.tobytes())
+            else:
+                h.update(repr(value).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """Returns the cached dictionary of arrays for key, or None"""
+        path = self._path(key)
+        try:
+            with numpy.load(path) as cached:
+                data = {name: cached[name] for name in cached.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process sharing the cache since it was read
+        self.hits += 1
+        return data
+
+    def put(self, key, **arrays):
+        """Stores arrays under key, then evicts old entries if over the size limit"""
+        path = self._path(key)
+        # a unique temporary name, other processes (or hosts) may be writing the same entry
+        fd, tmpPath = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            numpy.savez(f, **arrays)
+            size = f.tell()
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmpPath, path)
+
+        self._puts += 1
+        if self._bytes is None or self._puts % RESCAN_PUTS == 0:
+            self.evict()
+        else:
+            self._bytes += size - replaced
+            if self._bytes > self.maxBytes:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within EVICT_TO of maxBytes, if it is over maxBytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        if total <= self.maxBytes:
+            entries = []
+        for _, size, name in entries:
+            if total <= EVICT_TO * self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._bytes = total
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On disk store for the spectra of many molecules on a shared grid.
+
+Every molecule's spectrum is one row of a memory mapped (molecules x points)
+array and the normal modes of all molecules are kept in one structured array,
+so large batches do not need every spectrum held in memory as python lists.
+A store is a directory containing:
+
+    grid.npy      the shared x values
+    spectra.npy   memory mapped spectra, one row per molecule
+    modes.npy     structured array of every molecule's normal modes
+    index.json    dtype, size and the molecule name -> row / mode range index
+
+@author: aiden
+"""
+
+import json
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from mode_table import MODE_DTYPE, ModeTable
+
+
+class SpectrumStore:
+    def __init__(self, directory, grid=None, dtype=None, capacity=64):
+        """
+        Opens the store in directory, creating it if it does not exist. grid
+        (the x values shared by every spectrum) and dtype (float32 or float64,
+        float64 by default) are only needed when creating a store, and must
+        match the store's when given for an existing one. capacity is the
+        number of rows to allocate up front, the spectra file is grown as needed
+        """
+        self.directory = directory
+        self._indexFile = os.path.join(directory, "index.json")
+        self._pendingModes = {}  # modes added since the last flush, {name: array}
+
+        if os.path.exists(self._indexFile):
+            with open(self._indexFile, "r") as f:
+                index = json.load(f)
+            self.dtype = numpy.dtype(index["dtype"])
+            self.molecules = index["molecules"]
+            self.grid = numpy.load(os.path.join(directory, "grid.npy"))
+            if grid is not None and (len(grid) != len(self.grid) or not numpy.allclose(grid, self.grid)):
+                raise ValueError(f"The spectrum store in {directory} uses a different grid")
+            if dtype is not None and numpy.dtype(dtype) != self.dtype:
+                raise ValueError(f"The spectrum store in {directory} holds {self.dtype.name} spectra, not "
+                                 f"{numpy.dtype(dtype).name}")
+            self._spectra = open_memmap(os.path.join(directory, "spectra.npy"), mode="r+")
+            self._modes = numpy.load(os.path.join(directory, "modes.npy"), mmap_mode="r")
+        else:
+            if grid is None:
+                raise ValueError("A grid is needed to create a new spectrum store")
+            os.makedirs(directory, exist_ok=True)
+            self.dtype = numpy.dtype("float64" if dtype is None else dtype)
+            self.molecules = {}  # {name: {"row": row, "modeStart": first, "modeEnd": last + 1}}
+            self.grid = numpy.asarray(grid, dtype="d")
+            numpy.save(os.path.join(directory, "grid.npy"), self.grid)
+            self._spectra = open_memmap(os.path.join(directory, "spectra.npy"), mode="w+",
+                                        dtype=self.dtype, shape=(capacity, len(self.grid)))
+            self._modes = numpy.zeros(0, dtype=MODE_DTYPE)
+            self.flush()
+
+    def __contains__(self, name):
+        return name in self.molecules
+
+    def __len__(self):
+        return len(self.molecules)
+
+    def names(self):
+        """Molecule names in the order they were added"""
+        return sorted(self.molecules, key=lambda name: self.molecules[name]["row"])
+
+    def _grow(self, rows):
+        """Reallocates the spectra file with at least rows rows, copying the existing data"""
+        capacity = max(rows, 2 * len(self._spectra))
+        fileName = os.path.join(self.directory, "spectra.npy")
+        tmpName = fileName + ".tmp"
+        grown = open_memmap(tmpName, mode="w+", dtype=self.dtype, shape=(capacity, len(self.grid)))
+        grown[:len(self._spectra)] = self._spectra
+        grown.flush()
+        del self._spectra, grown
+        os.replace(tmpName, fileName)
+        self._spectra = open_memmap(fileName, mode="r+")
+
+    def addMolecule(self, name, spectrum, modes):
+        """
+        Adds (or replaces) a molecule. spectrum must be on the store's grid and
+        modes is a ModeTable (or a structured array with MODE_DTYPE)
+        """
+        if len(spectrum) != len(self.grid):
+            raise ValueError(f"Spectrum for {name} has {len(spectrum)} points, the store grid has {len(self.grid)}")
+
+        if name in self.molecules:
+            row = self.molecules[name]["row"]
+        else:
+            row = len(self.molecules)
+            if row >= len(self._spectra):
+                self._grow(row + 1)
+            self.molecules[name] = {"row": row, "modeStart": 0, "modeEnd": 0}
+
+        self._spectra[row] = spectrum
+        self._pendingModes[name] = numpy.asarray(modes, dtype=MODE_DTYPE)
+
+    def spectrum(self, name):
+        """Memory mapped view of a molecule's spectrum"""
+        return self._spectra[self.molecules[name]["row"]]
+
+    def spectra(self):
+        """Memory mapped view of every spectrum, rows ordered as names()"""
+        return self._spectra[:len(self.molecules)]
+
+    def modes(self, name):
+        """ModeTable view of a molecule's normal modes"""
+        if name in self._pendingModes:
+            return ModeTable(self._pendingModes[name])
+        entry = self.molecules[name]
+        return ModeTable(self._modes[entry["modeStart"]:entry["modeEnd"]])
+
+    def flush(self):
+        """Writes the spectra, the mode table and the index to disk"""
+        self._spectra.flush()
+
+        if self._pendingModes:
+            blocks = []
+            modeStart = 0
+            for name in self.names():
+                block = self.modes(name).data
+                self.molecules[name]["modeStart"] = modeStart
+                self.molecules[name]["modeEnd"] = modeStart + len(block)
+                modeStart += len(block)
+                blocks.append(block)
+            self._modes = numpy.concatenate(blocks) if blocks else numpy.zeros(0, dtype=MODE_DTYPE)
+            self._pendingModes = {}
+
+        # written to a temporary file first as the old mode table may still be memory mapped
+        modesFile = os.path.join(self.directory, "modes.npy")
+        with open(modesFile + ".tmp", "wb") as f:
+            numpy.save(f, self._modes)
+        os.replace(modesFile + ".tmp", modesFile)
+        with open(self._indexFile + ".tmp", "w") as f:
+            json.dump({"dtype": self.dtype.name, "numpts": len(self.grid), "molecules": self.molecules}, f)
+        os.replace(self._indexFile + ".tmp", self._indexFile)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch runs spread over many processes and hosts through a queue of files.
+
+The molecules of a batch_runner manifest that need computing are written as
+task files to a queue directory on a filesystem every worker can see. Any
+number of workers, on any number of hosts, then claim and compute them:
+
+    python work_queue.py init project.json         # queue the molecules that changed
+    python work_queue.py worker project.json       # on as many hosts as you like
+    python work_queue.py merge project.json        # when the queue is empty, build the workbook
+
+or all of it on one machine with several workers:
+
+    python work_queue.py local project.json --workers 4
+
+The queue directory (project.json.queue unless --queue is given) holds
+
+    tasks/      molecules waiting to be claimed
+    claimed/    <molecule>@<worker>.json, claimed by a worker
+    done/       a record of each finished molecule
+    failed/     molecules whose computation raised, with the error
+    attempts/   one empty file per claim, to give up on molecules that keep
+                killing their worker
+
+A worker claims a task by renaming it into claimed/, which succeeds for
+exactly one worker. While it works it touches its claim file every
+--heartbeat seconds, and a claim untouched for --stale seconds is taken to
+belong to a dead worker and is moved back to tasks/. The .out files are
+written to the manifest's workDir under a temporary name and moved into
+place, and merge records them in the batch_runner state before building the
+workbook, so later batch_runner runs only recompute what changed.
+
+@author: aiden
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from timeit import default_timer as timer
+
+import batch_runner
+import spectrum_cache
+
+
+QUEUE_DIRS = ["tasks", "claimed", "done", "failed", "attempts"]
+
+
+def queueDirectory(manifestFile, queueDir=None):
+    return queueDir if queueDir is not None else manifestFile + ".queue"
+
+
+def queuePaths(queueDir):
+    """{name: directory} of the queue's subdirectories, created if needed"""
+    paths = {name: os.path.join(queueDir, name) for name in QUEUE_DIRS}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def writeJson(fileName, data):
+    """Writes data under a unique temporary name and moves it into place"""
+    fd, tmpFile = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(fileName))
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmpFile, fileName)
+
+
+def readJson(fileName):
+    with open(fileName, "r") as f:
+        return json.load(f)
+
+
+def claimName(fileName):
+    """(molecule, worker) of a claim file name"""
+    molecule, worker = fileName[:-len(".json")].rsplit("@", 1)
+    return molecule, worker
+
+
+def filesystemNow(queueDir, workerId):
+    """
+    The current time as the shared filesystem sees it. Heartbeats are file
+    modification times set by the file server, so they are compared with this
+    rather than the local clock, which may be skewed between hosts
+    """
+    probe = os.path.join(queueDir, f".clock-{workerId}")
+    with open(probe, "w"):
+        pass
+    now = os.stat(probe).st_mtime
+    os.remove(probe)
+    return now
+
+
+def initQueue(manifestFile, queueDir=None, stateFile=None, force=False, reset=False):
+    """
+    Writes a task for every molecule in the manifest whose inputs or
+    parameters changed since the last batch_runner run (all of them with
+    force). Returns the names queued
+    """
+    queueDir = queueDirectory(manifestFile, queueDir)
+    if reset and os.path.exists(queueDir):
+        shutil.rmtree(queueDir)
+    paths = queuePaths(queueDir)
+    if os.listdir(paths["tasks"]) or os.listdir(paths["claimed"]):
+        raise ValueError(f"{queueDir} still has work queued, wait for the workers or use --reset")
+    for name in ["done", "failed", "attempts"]:
+        for fileName in os.listdir(paths[name]):
+            os.remove(os.path.join(paths[name], fileName))
+
+    manifest = batch_runner.loadManifest(manifestFile)
+    if stateFile is None:
+        stateFile = manifestFile + ".state.json"
+    state = batch_runner.loadState(stateFile)
+    os.makedirs(manifest["workDir"], exist_ok=True)
+
+    queued = []
+    for moleculeName, entry in manifest["molecules"].items():
+        parameters = batch_runner.moleculeParameters(manifest, entry)
+        moleculeFingerprint = batch_runner.fingerprint(entry, parameters, state["files"])
+        previous = state["molecules"].get(moleculeName)
+        outputFile = os.path.join(manifest["workDir"], moleculeName + ".out")
+        if (not force and previous is not None and previous["fingerprint"] == moleculeFingerprint
+                and os.path.exists(outputFile)):
+            continue
+        writeJson(os.path.join(paths["tasks"], moleculeName + ".json"),
+                  {"molecule": moleculeName, "fingerprint": moleculeFingerprint})
+        queued.append(moleculeName)
+
+    batch_runner.saveState(stateFile, state)  # keeps the file hashes for merge
+    return queued
+
+
+def claimTask(paths, workerId):
+    """Claims a task, returns the path of the claim file or None if there are no tasks"""
+    for fileName in sorted(os.listdir(paths["tasks"])):
+        if not fileName.endswith(".json"):
+            continue
+        claimFile = os.path.join(paths["claimed"], f"{fileName[:-len('.json')]}@{workerId}.json")
+        try:
+            # rename is atomic, if another worker got there first the task is gone
+            os.rename(os.path.join(paths["tasks"], fileName), claimFile)
+        except FileNotFoundError:
+            continue
+        try:
+            os.utime(claimFile)  # a rename keeps the old modification time, which would look stale
+        except FileNotFoundError:
+            continue  # taken back by a worker that saw the old time
+        return claimFile
+    return None
+
+
+def reclaimStale(queueDir, paths, workerId, staleAfter):
+    """Moves claims not touched for staleAfter seconds back to tasks/, returns the molecules moved"""
+    now = filesystemNow(queueDir, workerId)
+    reclaimed = []
+    for fileName in os.listdir(paths["claimed"]):
+        claimFile = os.path.join(paths["claimed"], fileName)
+        try:
+            if now - os.stat(claimFile).st_mtime < staleAfter:
+                continue
+            molecule, worker = claimName(fileName)
+            if os.path.exists(os.path.join(paths["done"], molecule + ".json")):
+                os.remove(claimFile)  # finished, its worker died before removing the claim
+                continue
+            os.rename(claimFile, os.path.join(paths["tasks"], molecule + ".json"))
+        except FileNotFoundError:
+            continue  # finished or reclaimed by someone else meanwhile
+        print(f"Reclaimed {molecule} from {worker}, no heartbeat for {staleAfter} seconds")
+        reclaimed.append(molecule)
+    return reclaimed
+
+
+class Heartbeat:
+    def __init__(self, claimFile, interval):
+        """Touches claimFile every interval seconds until stopped, noting if the claim is lost"""
+        self.claimFile = claimFile
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.claimFile)
+            except FileNotFoundError:
+                self.lost = True  # reclaimed, another worker will compute the molecule
+                return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return not self.lost and os.path.exists(self.claimFile)
+
+
+def runWorker(manifestFile, queueDir=None, workerId=None, heartbeat=10., staleAfter=60., maxAttempts=3,
+              pollInterval=None):
+    """
+    Claims and computes tasks until the queue is empty and no other worker
+    holds a claim (which might still go stale). Returns the molecules this
+    worker finished
+    """
+    queueDir = queueDirectory(manifestFile, queueDir)
+    paths = queuePaths(queueDir)
+    manifest = batch_runner.loadManifest(manifestFile)
+    workerId = workerId or f"{socket.gethostname()}-{os.getpid()}"
+    pollInterval = heartbeat if pollInterval is None else pollInterval
+    spectrumCache = None
+    if manifest["spectrumCacheDir"] is not None:
+        spectrumCache = spectrum_cache.SpectrumCache(manifest["spectrumCacheDir"])
+
+    finished = []
+    while True:
+        claimFile = claimTask(paths, workerId)
+        if claimFile is None:
+            if reclaimStale(queueDir, paths, workerId, staleAfter):
+                continue
+            if not os.listdir(paths["claimed"]):
+                break
+            time.sleep(pollInterval)  # others are still working, their claims may go stale
+            continue
+
+        moleculeName, _ = claimName(os.path.basename(claimFile))
+        with open(os.path.join(paths["attempts"], f"{moleculeName}@{workerId}-{time.time_ns()}"), "w"):
+            pass
+        attempts = sum(1 for name in os.listdir(paths["attempts"]) if name.rsplit("@", 1)[0] == moleculeName)
+        task = readJson(claimFile)
+        if attempts > maxAttempts:
+            writeJson(os.path.join(paths["failed"], moleculeName + ".json"),
+                      {**task, "error": f"Gave up after {maxAttempts} claims ended without a result"})
+            os.remove(claimFile)
+            continue
+
+        entry = manifest["molecules"].get(moleculeName)
+        print(f"{workerId} processing {moleculeName}")
+        begin = timer()
+        beat = Heartbeat(claimFile, heartbeat)
+        outputFile = os.path.join(manifest["workDir"], moleculeName + ".out")
+        tmpFile = f"{outputFile}.{workerId}.tmp"
+        try:
+            if entry is None:
+                raise ValueError(f"{moleculeName} is not in {manifestFile}, was the queue made from another manifest?")
+            parameters = batch_runner.moleculeParameters(manifest, entry)
+            batch_runner.computeMolecule(manifest, entry, parameters, tmpFile, spectrumCache)
+        except Exception as e:
+            beat.stop()
+            writeJson(os.path.join(paths["failed"], moleculeName + ".json"),
+                      {**task, "worker": workerId, "error": f"{type(e).__name__}: {e}",
+                       "traceback": traceback.format_exc()})
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            os.remove(claimFile)
+            print(f"{workerId} failed {moleculeName}: {e}")
+            continue
+
+        if not beat.stop():
+            os.remove(tmpFile)
+            print(f"{workerId} lost its claim on {moleculeName}, discarding the result")
+            continue
+        os.replace(tmpFile, outputFile)
+        writeJson(os.path.join(paths["done"], moleculeName + ".json"),
+                  {**task, "worker": workerId, "output": outputFile, "seconds": timer() - begin})
+        try:
+            os.remove(claimFile)
+        except FileNotFoundError:
+            pass
+        finished.append(moleculeName)
+
+    return finished
+
+
+def queueStatus(manifestFile, queueDir=None, staleAfter=60.):
+    """Counts of the tasks in each state and the claims that have gone stale"""
+    queueDir = queueDirectory(manifestFile, queueDir)
+    paths = queuePaths(queueDir)
+    status = {name: sorted(fileName[:-len(".json")] for fileName in os.listdir(paths[name])
+                           if fileName.endswith(".json"))
+              for name in ["tasks", "claimed", "done", "failed"]}
+    now = filesystemNow(queueDir, f"status-{os.getpid()}")
+    status["stale"] = []
+    for fileName in os.listdir(paths["claimed"]):
+        try:
+            if now - os.stat(os.path.join(paths["claimed"], fileName)).st_mtime >= staleAfter:
+                status["stale"].append(fileName[:-len(".json")])
+        except FileNotFoundError:
+            pass
+    return status
+
+
+def mergeQueue(manifestFile, queueDir=None, stateFile=None, buildWorkbook=True):
+    """
+    Records the molecules the workers finished in the batch_runner state and
+    builds the workbook. Raises if any molecule is still queued, failed or
+    was computed from inputs that have changed since. Returns the names of
+    the rewritten workbook sheets
+    """
+    queueDir = queueDirectory(manifestFile, queueDir)
+    paths = queuePaths(queueDir)
+    status = queueStatus(manifestFile, queueDir)
+    if status["tasks"] or status["claimed"]:
+        raise ValueError(f"{len(status['tasks'])} molecules are still queued and {len(status['claimed'])} "
+                         f"claimed, wait for the workers to finish")
+
+    manifest = batch_runner.loadManifest(manifestFile)
+    if stateFile is None:
+        stateFile = manifestFile + ".state.json"
+    state = batch_runner.loadState(stateFile)
+
+    missing = []
+    for moleculeName, entry in manifest["molecules"].items():
+        parameters = batch_runner.moleculeParameters(manifest, entry)
+        moleculeFingerprint = batch_runner.fingerprint(entry, parameters, state["files"])
+        outputFile = os.path.join(manifest["workDir"], moleculeName + ".out")
+        doneFile = os.path.join(paths["done"], moleculeName + ".json")
+        if os.path.exists(doneFile) and readJson(doneFile)["fingerprint"] == moleculeFingerprint:
+            state["molecules"][moleculeName] = {"fingerprint": moleculeFingerprint, "output": outputFile}
+        previous = state["molecules"].get(moleculeName)
+        if previous is None or previous["fingerprint"] != moleculeFingerprint or not os.path.exists(outputFile):
+            missing.append(moleculeName)
+
+    if missing:
+        failed = set(status["failed"])
+        raise ValueError(f"No up to date output for {', '.join(missing)}"
+                         + (f" ({', '.join(sorted(failed & set(missing)))} failed, see {paths['failed']})"
+                            if failed & set(missing) else ", run init again"))
+
+    state["molecules"] = {name: state["molecules"][name] for name in manifest["molecules"]}
+    batch_runner.saveState(stateFile, state)
+    if not buildWorkbook:
+        return []
+    print("Writing", manifest["output"])
+    sheets = batch_runner.buildProjectWorkbook(manifest, state)
+    batch_runner.saveState(stateFile, state)
+    return sheets
+
+
+def runLocal(manifestFile, workers, queueDir=None, stateFile=None, force=False, heartbeat=10., staleAfter=60.,
+             maxAttempts=3):
+    """Queues the manifest, runs workers worker processes on this machine and merges the results"""
+    queued = initQueue(manifestFile, queueDir, stateFile, force, reset=True)
+    print(f"Queued {len(queued)} molecules for {workers} workers")
+    command = [sys.executable, os.path.abspath(__file__), "worker", manifestFile, "--heartbeat", str(heartbeat),
+               "--stale", str(staleAfter), "--attempts", str(maxAttempts)]
+    if queueDir is not None:
+        command += ["--queue", queueDir]
+    processes = [subprocess.Popen(command + ["--id", f"{socket.gethostname()}-local{i}"]) for i in range(workers)]
+    for process in processes:
+        process.wait()
+    return mergeQueue(manifestFile, queueDir, stateFile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spreads a batch_runner manifest over workers sharing a filesystem")
+    parser.add_argument("command", choices=["init", "worker", "status", "merge", "local"],
+                        help="init queues the molecules, worker computes them, merge builds the workbook, "
+                             "local does all three with several workers on this machine")
+    parser.add_argument("manifest", help="JSON manifest, see batch_runner.py")
+    parser.add_argument("--queue", help="queue directory, default is the manifest name with .queue appended")
+    parser.add_argument("--state", help="batch_runner state file, default is the manifest name with .state.json "
+                                        "appended")
+    parser.add_argument("--force", action="store_true", help="init: queue every molecule")
+    parser.add_argument("--reset", action="store_true", help="init: discard whatever is in the queue")
+    parser.add_argument("--id", help="worker: name of this worker, default is host-pid")
+    parser.add_argument("--heartbeat", type=float, default=10., help="seconds between heartbeats (default 10)")
+    parser.add_argument("--stale", type=float, default=60.,
+                        help="seconds without a heartbeat before a claim is taken back (default 60)")
+    parser.add_argument("--attempts", type=int, default=3, help="claims of a molecule before giving up (default 3)")
+    parser.add_argument("--workers", type=int, default=2, help="local: number of worker processes (default 2)")
+    parser.add_argument("--no-workbook", action="store_true", help="merge: only record the results")
+    args = parser.parse_args()
+
+    begin = timer()
+    if args.command == "init":
+        queued = initQueue(args.manifest, args.queue, args.state, args.force, args.reset)
+        print(f"Queued {len(queued)} molecules")
+    elif args.command == "worker":
+        finished = runWorker(args.manifest, args.queue, args.id, args.heartbeat, args.stale, args.attempts)
+        print(f"Finished {len(finished)} molecules in {timer() - begin:.2f} seconds")
+    elif args.command == "status":
+        status = queueStatus(args.manifest, args.queue, args.stale)
+        for name in ["tasks", "claimed", "stale", "done", "failed"]:
+            print(f"{name:8s} {len(status[name]):6d}  {' '.join(status[name][:10])}")
+    elif args.command == "merge":
+        sheets = mergeQueue(args.manifest, args.queue, args.state, not args.no_workbook)
+        print(f"Rewrote {len(sheets)} sheets in {timer() - begin:.2f} seconds")
+    else:
+        sheets = runLocal(args.manifest, args.workers, args.queue, args.state, args.force, args.heartbeat,
+                          args.stale, args.attempts)
+        print(f"Rewrote {len(sheets)} sheets in {timer() - begin:.2f} seconds")
@@ -0,0 +1,677 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Excel export of broadened spectra.
+
+Each molecule gets a sheet with its spectrum and normal modes, the config
+sheet holds the offset added to each molecule and the frequency and
+wavelength charts with one series per molecule. An existing workbook can be
+updated in place with updateWorkbook, which only writes the sheets of the
+molecules that changed and copies the other sheets' XML across unparsed,
+using the series (points, peaks and labels) of every sheet saved next to the
+workbook. Large batches can be split across several shard workbooks with
+writeShardedWorkbooks, with an index workbook linking to them.
+
+@author: aiden
+"""
+
+import io
+import json
+import multiprocessing
+import os
+import posixpath
+import re
+import zipfile
+from xml.etree import ElementTree
+
+import gausssum_file
+import instrumentation
+
+
+def readOutputFile(fileName, mmap=False):
+    """
+    Reads a file written by irSpectra (or any GaussSum style spectrum file,
+    see gausssum_file). Returns (freqData, irData, modes) where modes is a
+    ModeTable. With mmap the file is memory mapped
+    """
+    xvalues, spectrum, modes = gausssum_file.readGaussSum(fileName, mmap)
+    return xvalues.tolist(), spectrum.tolist(), modes
+
+
+def assignmentRows(data):
+    """
+    Rows of a molecule's peak assignments table, [(peak freq, mode, label,
+    fraction)], from the "assignments" of its entry of moleculeData (see
+    peak_assignment.assignPeaks). Empty when it has none
+    """
+    modes = data["modes"]
+    rows = []
+    for peak, assignment in zip(data["peaks"], data.get("assignments", ())):
+        for modeRow, fraction in assignment:
+            rows.append((float(data["freqs"][peak]), int(modes.mode[modeRow]), str(modes.label[modeRow]), fraction))
+    return rows
+
+
+def writeMoleculeSheet(sheet, freqData, irData, modes, configRow, assignments=()):
+    """
+    Writes a molecule's spectrum and normal modes to sheet. The adjusted
+    activity adds the offset in config!B{configRow}. assignments, rows as
+    from assignmentRows, are written as the peak assignments table
+    """
+    # Spectrum Data
+    sheet["A1"] = "Spectrum"      # write headers
+    sheet["A2"] = "Freq (cm^-1)"
+    sheet["B2"] = "Wavelength (um)"
+    sheet["C2"] = "IR Act"
+    sheet["D2"] = "IR Act adj"
+
+    dataRow = 3
+    for freq, ir in zip(freqData, irData):
+        sheet["A" + str(dataRow)] = freq
+        sheet["B" + str(dataRow)] = "=10000/A" + str(dataRow)
+        sheet["C" + str(dataRow)] = ir
+        sheet["D" + str(dataRow)] = "=C" + str(dataRow) + " + config!B" + str(configRow)
+
+        dataRow += 1
+
+    # Normal Modes
+    sheet["F1"] = "Normal Modes"      # write headers
+    sheet["F2"] = "Mode"
+    sheet["G2"] = "Label"
+    sheet["H2"] = "Freq (cm^-1)"
+    sheet["I2"] = "IR Act"
+    sheet["J2"] = "Scaling Factor"
+    sheet["K2"] = "Unscaled freq"
+
+    dataRow = 3
+    for mode in modes:
+        sheet["F" + str(dataRow)] = mode.mode
+        sheet["G" + str(dataRow)] = mode.label
+        sheet["H" + str(dataRow)] = mode.freq
+        sheet["I" + str(dataRow)] = mode.act
+        sheet["J" + str(dataRow)] = mode.scale
+        sheet["K" + str(dataRow)] = mode.unscaled
+
+        dataRow += 1
+
+    sheet.merge_cells("A1:D1")
+    sheet.merge_cells("F1:K1")
+
+    # Peak Assignments
+    if assignments:
+        sheet["M1"] = "Peak Assignments"      # write headers
+        sheet["M2"] = "Peak (cm^-1)"
+        sheet["N2"] = "Mode"
+        sheet["O2"] = "Label"
+        sheet["P2"] = "Contribution"
+
+        dataRow = 3
+        for peakFreq, mode, label, fraction in assignments:
+            sheet["M" + str(dataRow)] = peakFreq
+            sheet["N" + str(dataRow)] = mode
+            sheet["O" + str(dataRow)] = label
+            sheet["P" + str(dataRow)] = fraction
+            sheet["P" + str(dataRow)].number_format = "0.0%"
+
+            dataRow += 1
+
+        sheet.merge_cells("M1:P1")
+
+    instrumentation.count("cellsWritten", 4 * len(freqData) + 6 * len(modes) + 12
+                          + (4 * len(assignments) + 5 if assignments else 0))
+
+    # update sizes
+    dims = {}
+    for row in sheet.rows:
+        for cell in row:
+            if cell.value:
+                dims[cell.column_letter] = max((dims.get(cell.column_letter, 0), len(str(cell.value))))
+    for col, value in dims.items():
+        sheet.column_dimensions[col].width = value
+
+
+def makeCharts(freqRange=(0, 4000), wavRange=(2.5, 25), axisFontSize=14, axisTitleFontSize=16):
+    """Empty frequency and wavelength charts, returns (freqChart, wavChart)"""
+    # openpyxl is imported where it is used so reading .out files does not load it
+    from openpyxl.chart import ScatterChart
+    from openpyxl.chart.text import RichText
+    from openpyxl.drawing.text import Paragraph, ParagraphProperties, CharacterProperties
+
+    # label styling
+    axisFont = CharacterProperties(sz=axisFontSize * 100)       # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
+    axisTitleFont = CharacterProperties(sz=axisTitleFontSize * 100)  # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
+    pp = ParagraphProperties(defRPr=axisTitleFont)
+
+    charts = []
+    for title, (low, high) in [("Frequency (cm^-1)", freqRange), ("Wavelength (µm)", wavRange)]:
+        chart = ScatterChart()
+        chart.y_axis.title = "IR Activity"
+        chart.x_axis.title = title
+        chart.x_axis.delete = False
+        chart.y_axis.delete = False
+        chart.x_axis.scaling.max = high
+        chart.x_axis.scaling.min = low
+        # tick marks
+        chart.x_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
+        chart.y_axis.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=axisFont), endParaRPr=axisFont)])
+        # axis titles
+        chart.x_axis.title.tx.rich.p[0].pPr = pp
+        chart.y_axis.title.tx.rich.p[0].pPr = pp
+        charts.append(chart)
+
+    return tuple(charts)
+
+
+def sheetAssignments(sheet):
+    """Reads the peak assignments table back from a sheet written by writeMoleculeSheet, as from assignmentRows"""
+    rows = []
+    for row in sheet.iter_rows(min_row=3, min_col=13, max_col=16, values_only=True):
+        if row[0] is None:
+            break
+        rows.append(row)
+    return rows
+
+
+def peakLabels(freqData, assignments, labelModes=2):
+    """
+    Text added to the chart labels of the peaks, {point index: "12 64%, 13
+    21%"} giving the largest labelModes modes of each peak in assignments
+    (rows as from assignmentRows). Empty when labelModes is 0
+    """
+    index = {freq: i for i, freq in enumerate(freqData)}
+    modes = {}
+    for peakFreq, mode, _, fraction in assignments:
+        if peakFreq in index:
+            modes.setdefault(index[peakFreq], []).append(f"{mode} {fraction:.0%}")
+    return {i: ", ".join(text[:labelModes]) for i, text in modes.items() if labelModes > 0}
+
+
+def addSeries(freqChart, wavChart, sheet, moleculeName, npoints, peaks, labelFontSize=14, labels=None):
+    """
+    Adds a molecule's adjusted spectrum to both charts, labelling the peaks
+    on the wavelength chart. labels, {point index: text}, adds text after
+    the wavelength of those peaks
+    """
+    from openpyxl.chart import Reference, Series
+    from openpyxl.chart.label import DataLabel, DataLabelList
+    from openpyxl.chart.text import RichText
+    from openpyxl.drawing.text import Paragraph, ParagraphProperties, CharacterProperties
+
+    labelFont = CharacterProperties(sz=labelFontSize * 100)     # multiply by 100, see https://stackoverflow.com/questions/47550555/formatting-chart-data-labels-in-openpyxl
+
+    freqXData = Reference(sheet, min_col=1, max_col=1, min_row=3, max_row=2 + npoints)
+    wavXData = Reference(sheet, min_col=2, max_col=2, min_row=3, max_row=2 + npoints)
+
+    yData = Reference(sheet, min_col=4, max_col=4, min_row=3, max_row=2 + npoints)
+
+    freqSeries = Series(yData, freqXData, title_from_data=False, title=moleculeName)
+    wavSeries = Series(yData, wavXData, title_from_data=False, title=moleculeName)
+
+    # add data labels for peaks
+    # openpyxl cannot give a data label its own text, so extra text goes in
+    # as a literal in the label's number format
+    labels = labels or {}
+    dataLabels = []
+    for i in range(len(wavXData)):
+        if i in peaks:
+            numFmt = "[<0.01]0.E+00;0.00"
+            if labels.get(i):
+                text = '" (' + labels[i].replace('"', "") + ')"'
+                numFmt = "[<0.01]0.E+00" + text + ";0.00" + text
+            dataLabels.append(DataLabel(i, showVal=False, showCatName=True, showLeaderLines=True, numFmt=numFmt, dLblPos="t"))
+        else:
+            dataLabels.append(DataLabel(i, showVal=False, showCatName=False, showLeaderLines=True, numFmt="[<0.01]0.E+00;0.00"))
+
+
+    wavSeries.dLbls = DataLabelList(dataLabels)
+    wavSeries.dLbls.txPr = RichText(p=[Paragraph(pPr=ParagraphProperties(defRPr=labelFont), endParaRPr=labelFont)])
+
+    freqChart.series.append(freqSeries)
+    wavChart.series.append(wavSeries)
+
+
+def seriesEntry(data, labelModes=2, assignments=None):
+    """
+    What the charts need of a molecule, {"points", "peaks", "labels"}, from
+    its entry of moleculeData. assignments are its assignmentRows if they
+    are already known
+    """
+    if assignments is None:
+        assignments = assignmentRows(data)
+    return {
+        "points": len(data["freqs"]),
+        "peaks": [int(peak) for peak in data["peaks"]],
+        "labels": peakLabels(data["freqs"], assignments, labelModes),
+    }
+
+
+def moleculeSeries(moleculeData, labelModes=2):
+    """{molecule name: seriesEntry} for moleculeData"""
+    return {moleculeName: seriesEntry(data, labelModes) for moleculeName, data in moleculeData.items()}
+
+
+def seriesFileName(fileName):
+    """The file the chart series of the workbook fileName are kept in"""
+    return fileName + ".series.json"
+
+
+def saveWorkbook(wb, fileName, series):
+    """
+    Saves wb to fileName and its series ({molecule name: seriesEntry}, for
+    every molecule sheet) next to it, so updateWorkbook can rebuild the charts
+    without reading the sheets back
+    """
+    wb.save(filename=fileName)
+    writeSeries(fileName, series)
+
+
+def writeSeries(fileName, series):
+    stat = os.stat(fileName)
+    with open(seriesFileName(fileName) + ".tmp", "w") as f:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "series": series}, f)
+    os.replace(seriesFileName(fileName) + ".tmp", seriesFileName(fileName))
+
+
+def readSeries(fileName):
+    """
+    The series saved with the workbook fileName, {} if there are none or the
+    workbook has been saved by something else since (Excel, say)
+    """
+    try:
+        with open(seriesFileName(fileName), "r") as f:
+            saved = json.load(f)
+        stat = os.stat(fileName)
+    except (OSError, ValueError):
+        return {}
+    if saved["size"] != stat.st_size or saved["mtime_ns"] != stat.st_mtime_ns:
+        return {}
+    return {name: {"points": entry["points"], "peaks": entry["peaks"],
+                   "labels": {int(i): text for i, text in entry["labels"].items()}}
+            for name, entry in saved["series"].items()}
+
+
+class WorkbookBuilder:
+    def __init__(self, dOffset, freqRange=(0, 4000), wavRange=(2.5, 25), axisFontSize=14, axisTitleFontSize=16,
+                 labelFontSize=14, firstOffset=0, labelModes=2):
+        """
+        Builds a workbook one molecule at a time, so sheets can be written as
+        molecules become ready. The first molecule added is offset by
+        firstOffset and each one after it by dOffset more than the one before.
+        The charts are made by finish(). Peaks with assignments are labelled
+        with their largest labelModes modes
+        """
+        from openpyxl import Workbook
+
+        self.dOffset = dOffset
+        self.firstOffset = firstOffset
+        self.chartOptions = (freqRange, wavRange, axisFontSize, axisTitleFontSize)
+        self.labelFontSize = labelFontSize
+        self.labelModes = labelModes
+        self.series = {}  # {molecule name: series, see moleculeSeries} in the order they were added
+        self.wb = Workbook()
+        self.wb.remove(self.wb.active)
+        self.config = self.wb.create_sheet("config")
+
+    def add(self, moleculeName, data):
+        """Writes the config row and sheet of a molecule, data as for buildWorkbook"""
+        configRow = len(self.series) + 1
+        # write to config file with some offset
+        self.config["A" + str(configRow)] = moleculeName + " offset"
+        self.config["B" + str(configRow)] = self.firstOffset + (configRow - 1) * self.dOffset
+        assignments = assignmentRows(data)
+        writeMoleculeSheet(self.wb.create_sheet(moleculeName), data["freqs"], data["irData"], data["modes"], configRow,
+                           assignments)
+        self.series[moleculeName] = seriesEntry(data, self.labelModes, assignments)
+
+    def finish(self):
+        """Adds both charts with a series for every molecule and returns the workbook"""
+        freqChart, wavChart = makeCharts(*self.chartOptions)
+        for moleculeName, series in self.series.items():
+            addSeries(freqChart, wavChart, self.wb[moleculeName], moleculeName, series["points"], series["peaks"],
+                      self.labelFontSize, series["labels"])
+        self.config.add_chart(freqChart)
+        self.config.add_chart(wavChart)
+        return self.wb
+
+
+def buildWorkbook(moleculeData, dOffset, freqRange=(0, 4000), wavRange=(2.5, 25), axisFontSize=14,
+                  axisTitleFontSize=16, labelFontSize=14, firstOffset=0, labelModes=2):
+    """
+    Builds the workbook for moleculeData, {molecule name: {"freqs", "irData",
+    "modes", "peaks"}} in the order the molecules should appear, each
+    optionally with the "assignments" of its peaks. The first molecule is
+    offset by firstOffset and each one after it by dOffset more than the one
+    before. Peaks with assignments are labelled with their largest
+    labelModes modes
+    """
+    builder = WorkbookBuilder(dOffset, freqRange, wavRange, axisFontSize, axisTitleFontSize, labelFontSize,
+                              firstOffset, labelModes)
+    for moleculeName, data in moleculeData.items():
+        builder.add(moleculeName, data)
+    return builder.finish()
+
+
+def sheetSpectrum(sheet):
+    """Reads (freqData, irData) back from a sheet written by writeMoleculeSheet"""
+    freqData = []
+    irData = []
+    for freq, _, ir in sheet.iter_rows(min_row=3, max_col=3, values_only=True):
+        if freq is None:
+            break
+        freqData.append(freq)
+        irData.append(ir)
+    return freqData, irData
+
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIPS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+RELATIONSHIP_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+# the offset formula of every spectrum row, see writeMoleculeSheet
+OFFSET_FORMULA = re.compile(rb"(<f>C\d+ \+ config!B)(\d+)(</f>)")
+# the width of column D, sized to the longest offset formula
+OFFSET_COLUMN = re.compile(rb'(<col width=")(\d+)("[^>]*min="4" max="4")')
+
+
+def sheetParts(archive):
+    """{sheet name: worksheet part} of the xlsx in the open zipfile archive, in workbook order"""
+    targets = {}
+    for rel in ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels")).iter(RELATIONSHIPS_NS + "Relationship"):
+        target = rel.get("Target")
+        targets[rel.get("Id")] = target[1:] if target.startswith("/") else posixpath.normpath("xl/" + target)
+    return {sheet.get("name"): targets[sheet.get(RELATIONSHIP_ID)]
+            for sheet in ElementTree.fromstring(archive.read("xl/workbook.xml")).iter(MAIN_NS + "sheet")}
+
+
+def _partRels(part):
+    directory, name = posixpath.split(part)
+    return posixpath.join(directory, "_rels", name + ".rels")
+
+
+def _moveOffsetRow(xml, configRow):
+    """A kept sheet's XML with its offset formulas pointing at config!B{configRow}"""
+    match = OFFSET_FORMULA.search(xml)
+    if match is None or int(match.group(2)) == configRow:
+        return xml
+    xml = OFFSET_FORMULA.sub(rb"\g<1>%d\g<3>" % configRow, xml)
+    grown = len(str(configRow)) - len(match.group(2))
+    if grown:
+        xml = OFFSET_COLUMN.sub(lambda col: col.group(1) + b"%d" % (int(col.group(2)) + grown) + col.group(3), xml,
+                                count=1)
+    return xml
+
+
+def _copyUpdate(archive, oldParts, names, moleculeData, saved, dOffset, chartOptions, labelFontSize, labelModes):
+    """
+    The updated workbook as bytes. Only the config sheet, the charts and the
+    sheets in moleculeData are written by openpyxl, the XML of every other
+    sheet is copied from archive. Returns (series, bytes)
+    """
+    from openpyxl import Workbook
+    from openpyxl.styles.stylesheet import apply_stylesheet
+
+    wb = Workbook()
+    wb.remove(wb.active)
+    apply_stylesheet(archive, wb)  # so the style indices in the copied sheets still mean the same
+    config = wb.create_sheet("config")
+    freqChart, wavChart = makeCharts(*chartOptions)
+    series = {}
+    for configRow, moleculeName in enumerate(names, start=1):
+        config["A" + str(configRow)] = moleculeName + " offset"
+        config["B" + str(configRow)] = (configRow - 1) * dOffset
+
+        sheet = wb.create_sheet(moleculeName)  # left empty for kept sheets, their XML is copied in below
+        if moleculeName in moleculeData:
+            data = moleculeData[moleculeName]
+            assignments = assignmentRows(data)
+            writeMoleculeSheet(sheet, data["freqs"], data["irData"], data["modes"], configRow, assignments)
+            series[moleculeName] = seriesEntry(data, labelModes, assignments)
+        else:
+            series[moleculeName] = saved[moleculeName]
+        entry = series[moleculeName]
+        addSeries(freqChart, wavChart, sheet, moleculeName, entry["points"], entry["peaks"], labelFontSize,
+                  entry["labels"])
+    config.add_chart(freqChart)
+    config.add_chart(wavChart)
+
+    written = io.BytesIO()
+    wb.save(written)
+    output = io.BytesIO()
+    with zipfile.ZipFile(written) as new, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as out:
+        copied = {part: name for name, part in sheetParts(new).items() if name != "config" and name not in moleculeData}
+        for info in new.infolist():
+            if info.filename in copied:
+                moleculeName = copied[info.filename]
+                out.writestr(info, _moveOffsetRow(archive.read(oldParts[moleculeName]), names.index(moleculeName) + 1))
+            else:
+                out.writestr(info, new.read(info))
+    instrumentation.count("sheetsCopied", len(copied))
+    return series, output.getvalue()
+
+
+def _loadUpdate(fileName, moleculeData, removed, saved, findPeaks, dOffset, chartOptions, labelFontSize, labelModes):
+    """Updates the workbook by loading all of it with openpyxl and saving it again, returns the series"""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fileName)
+    config = wb["config"]
+
+    # config row each kept sheet's formulas point at
+    oldRows = {}
+    for row, (label,) in enumerate(config.iter_rows(min_col=1, max_col=1, values_only=True), start=1):
+        if label is not None and label.endswith(" offset"):
+            oldRows[label[:-len(" offset")]] = row
+
+    for moleculeName in removed:
+        if moleculeName in wb.sheetnames:
+            del wb[moleculeName]
+
+    for moleculeName in moleculeData:
+        if moleculeName in wb.sheetnames:
+            index = wb.sheetnames.index(moleculeName)
+            del wb[moleculeName]
+            wb.create_sheet(moleculeName, index)
+        else:
+            wb.create_sheet(moleculeName)
+
+    names = [name for name in wb.sheetnames if name != "config"]
+    config.delete_rows(1, config.max_row)
+    config._charts = []
+    freqChart, wavChart = makeCharts(*chartOptions)
+    series = {}
+    for configRow, moleculeName in enumerate(names, start=1):
+        config["A" + str(configRow)] = moleculeName + " offset"
+        config["B" + str(configRow)] = (configRow - 1) * dOffset
+
+        sheet = wb[moleculeName]
+        if moleculeName in moleculeData:
+            data = moleculeData[moleculeName]
+            assignments = assignmentRows(data)
+            writeMoleculeSheet(sheet, data["freqs"], data["irData"], data["modes"], configRow, assignments)
+            series[moleculeName] = seriesEntry(data, labelModes, assignments)
+        else:
+            freqData, irData = sheetSpectrum(sheet)
+            if oldRows.get(moleculeName) != configRow:
+                for dataRow in range(3, 3 + len(freqData)):
+                    sheet["D" + str(dataRow)] = "=C" + str(dataRow) + " + config!B" + str(configRow)
+            if moleculeName in saved:
+                series[moleculeName] = saved[moleculeName]
+            else:
+                peaks = findPeaks(moleculeName, freqData, irData) if findPeaks is not None else []
+                series[moleculeName] = {"points": len(freqData), "peaks": [int(peak) for peak in peaks],
+                                        "labels": peakLabels(freqData, sheetAssignments(sheet), labelModes)}
+
+        entry = series[moleculeName]
+        addSeries(freqChart, wavChart, sheet, moleculeName, entry["points"], entry["peaks"], labelFontSize,
+                  entry["labels"])
+
+    config.add_chart(freqChart)
+    config.add_chart(wavChart)
+    wb.save(filename=fileName)
+    return series
+
+
+def updateWorkbook(fileName, moleculeData, removed=(), findPeaks=None, dOffset=100, freqRange=(0, 4000),
+                   wavRange=(2.5, 25), axisFontSize=14, axisTitleFontSize=16, labelFontSize=14, labelModes=2):
+    """
+    Updates the workbook in fileName (building it if it does not exist) and
+    saves it. Molecules in moleculeData (as for buildWorkbook) are added, or
+    replace their sheet where it already exists, and the sheets of the
+    molecules in removed are deleted. Other molecule sheets are kept as they
+    are apart from their offset formulas when their config row moves.
+
+    Charts read back in by openpyxl do not keep all of their formatting, so
+    both charts are rebuilt, from the series saved next to the workbook by
+    saveWorkbook or an earlier update (see readSeries). When every kept sheet
+    has one, only the config sheet, the charts and the sheets in moleculeData
+    are written and the XML of the kept sheets is copied across as it is, so
+    an update costs about as much as writing the sheets that changed.
+    Otherwise (a workbook saved by Excel, say) the whole workbook is loaded
+    with openpyxl, and findPeaks(moleculeName, freqData, irData) gives the
+    peaks to label for kept molecules without a saved series, which are not
+    labelled without it. Their peak assignments are read back from their
+    sheets.
+
+    The config offsets are laid out as buildWorkbook does, so the result
+    matches building the workbook from scratch with the same molecule order.
+    Returns the series of every molecule sheet, which are saved next to the
+    workbook
+    """
+    chartOptions = (freqRange, wavRange, axisFontSize, axisTitleFontSize)
+    if not os.path.exists(fileName):
+        series = moleculeSeries(moleculeData, labelModes)
+        saveWorkbook(buildWorkbook(moleculeData, dOffset, *chartOptions, labelFontSize, labelModes=labelModes),
+                     fileName, series)
+        return series
+
+    saved = readSeries(fileName)
+    updated = None
+    with zipfile.ZipFile(fileName) as archive:
+        oldParts = sheetParts(archive)
+        names = [name for name in oldParts if name != "config" and name not in removed]
+        names += [name for name in moleculeData if name not in oldParts]
+        files = set(archive.namelist())
+        # copied sheets cannot refer to parts of the old workbook, such as a shared string table
+        copyable = "config" in oldParts and "xl/sharedStrings.xml" not in files and all(
+            name in saved and _partRels(oldParts[name]) not in files for name in names if name not in moleculeData)
+        if copyable:
+            series, updated = _copyUpdate(archive, oldParts, names, moleculeData, saved, dOffset, chartOptions,
+                                          labelFontSize, labelModes)
+
+    if updated is not None:
+        with open(fileName + ".tmp", "wb") as f:
+            f.write(updated)
+        os.replace(fileName + ".tmp", fileName)
+    else:
+        series = _loadUpdate(fileName, moleculeData, removed, saved, findPeaks, dOffset, chartOptions,
+                             labelFontSize, labelModes)
+    writeSeries(fileName, series)
+    return series
+
+
+def moleculeCells(data):
+    """Approximate number of cells in a molecule's sheet, used as its size when sharding"""
+    return 4 * len(data["freqs"]) + 6 * len(data["modes"]) + 4 * sum(len(a) for a in data.get("assignments", ()))
+
+
+def shardMolecules(moleculeData, maxMolecules=None, maxCells=None):
+    """
+    Splits the molecule names, in order, into shards of at most maxMolecules
+    molecules and maxCells cells (see moleculeCells). A molecule larger than
+    maxCells gets a shard of its own. Returns a list of lists of names
+    """
+    shards = []
+    cells = 0
+    for moleculeName, data in moleculeData.items():
+        size = moleculeCells(data)
+        if (not shards or (maxMolecules is not None and len(shards[-1]) >= maxMolecules)
+                or (maxCells is not None and cells + size > maxCells and shards[-1])):
+            shards.append([])
+            cells = 0
+        shards[-1].append(moleculeName)
+        cells += size
+    return shards
+
+
+def shardFileName(indexFileName, shard):
+    """File name of shard number shard (from 0), next to the index workbook"""
+    base, ext = os.path.splitext(indexFileName)
+    return f"{base}_{shard + 1:03d}{ext}"
+
+
+def _writeShard(args):
+    fileName, shardData, dOffset, firstOffset, chartOptions, labelModes = args
+    buildWorkbook(shardData, dOffset, *chartOptions, firstOffset=firstOffset, labelModes=labelModes).save(filename=fileName)
+    return fileName
+
+
+def buildIndex(moleculeData, shards, shardFiles, dOffset):
+    """
+    Index workbook with each molecule's offset, peaks and a link to its
+    sheet in the shard it was written to
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    sheet = wb.active
+    sheet.title = "index"
+    sheet.append(["Molecule", "Offset", "Shard", "Peaks (cm^-1)", "Peaks (um)"])
+
+    row = 2
+    for shard, names in enumerate(shards):
+        link = os.path.basename(shardFiles[shard])
+        for moleculeName in names:
+            data = moleculeData[moleculeName]
+            peakFreqs = [data["freqs"][i] for i in data["peaks"]]
+            sheet.append([
+                moleculeName,
+                (row - 2) * dOffset,
+                link,
+                ", ".join(f"{freq:.1f}" for freq in peakFreqs),
+                ", ".join(f"{10000 / freq:.2f}" for freq in peakFreqs),
+            ])
+            cell = sheet["A" + str(row)]
+            cell.hyperlink = f"{link}#'{moleculeName}'!A1"
+            cell.style = "Hyperlink"
+            row += 1
+
+    # update sizes, the peak lists are left to wrap
+    for col in "ABC":
+        sheet.column_dimensions[col].width = max(len(str(cell.value)) for cell in sheet[col])
+    return wb
+
+
+def writeShardedWorkbooks(indexFileName, moleculeData, dOffset, maxMolecules=None, maxCells=None, processes=1,
+                          freqRange=(0, 4000), wavRange=(2.5, 25), axisFontSize=14, axisTitleFontSize=16,
+                          labelFontSize=14, labelModes=2):
+    """
+    Writes moleculeData (as for buildWorkbook) to shard workbooks of at most
+    maxMolecules molecules and maxCells cells each, named after
+    indexFileName, and the index workbook to indexFileName. Each shard has
+    its own config sheet and charts. Offsets carry on from one shard to the
+    next, so every molecule is offset the same as in a single workbook.
+    Shards are written by processes worker processes. Returns the shard file
+    names
+    """
+    shards = shardMolecules(moleculeData, maxMolecules, maxCells)
+    shardFiles = [shardFileName(indexFileName, shard) for shard in range(len(shards))]
+    chartOptions = (freqRange, wavRange, axisFontSize, axisTitleFontSize, labelFontSize)
+
+    jobs = []
+    firstOffset = 0
+    for fileName, names in zip(shardFiles, shards):
+        jobs.append((fileName, {name: moleculeData[name] for name in names}, dOffset, firstOffset, chartOptions,
+                     labelModes))
+        firstOffset += len(names) * dOffset
+
+    # the drivers are scripts without a main guard, which spawned workers
+    # would run again, so workers are only used where they can be forked
+    if processes > 1 and len(jobs) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context("fork").Pool(min(processes, len(jobs))) as pool:
+            pool.map(_writeShard, jobs)
+    else:
+        for job in jobs:
+            _writeShard(job)
+
+    buildIndex(moleculeData, shards, shardFiles, dOffset).save(filename=indexFileName)
+    return shardFiles
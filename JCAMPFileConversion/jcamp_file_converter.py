@@ -6,9 +6,18 @@ Created on Fri Jun 16 21:59:37 2023
 @author: aiden
 """
 
+import os
+import sys
+
+import jcamp_parser
+import preprocessing
 from openpyxl import Workbook
 from openpyxl.chart import ScatterChart, Reference, Series
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "IRSpectra"))
+import gausssum_file
+import instrumentation
+
 
 ##############################################################################################################
 #
@@ -26,6 +35,17 @@ MOLECULE_NAME = "Propene"  # used to name data sheet
 
 THEORETICAL_Y_OFFSET = 0.3  # offset to add to all 
 
+# preprocessing applied to the experimental data before it is written (and so
+# before the max ratio scaling factor is calculated). Each step is a
+# (stage, options) pair, see preprocessing.py for the available stages. The
+# units step uses ##XUNITS/##YUNITS so transmittance files are converted to
+# absorbance. Smoothing and baseline removal can be added with e.g.
+#   ("smooth", {"windowLength": 11, "polyOrder": 3}),
+#   ("baseline", {"lam": 1e5, "p": 0.01}),
+PREPROCESSING_STEPS = [
+    ("units", {"xunits": "1/CM", "yunits": "ABSORBANCE"}),
+]
+
 # headers for data sheet
 X_HEADER = "Wavenumber (cm-1)"
 Y_HEADER = "IR act"
@@ -37,6 +57,8 @@ Y_HEADER3 = "Aid IR act"
 X_AXIS = "Frequency (cm^-1)"
 Y_AXIS = "IR Activity"
 
+INSTRUMENTATION_REPORT = None  # set to a .json file to record the time and memory of each stage
+INSTRUMENTATION_PROFILE = False  # also write a cProfile dump next to the report
 
 
 
@@ -48,58 +70,17 @@ Y_AXIS = "IR Activity"
 #
 ##############################################################################################################
 
-x_data_expr = []
-y_data_expr = []
-
-delta_x = -1
-x_factor = -1
-y_factor = -1
-n_points = -1  # sanity checks to make sure everything was read correctly
-last_x = -1
-first_y = -1
-
-
-with open(JCAMP_FILE, "r") as f:
-    for line in f.readlines():
-        if line.startswith("##"):  # reading a comment or some other meta data. try to find the important stuff
-            if "XFACTOR" in line:
-                x_factor = float(line.split("=")[-1])
-            elif "YFACTOR" in line:
-                y_factor = float(line.split("=")[-1])
-            elif "DELTAX" in line:
-                delta_x = float(line.split("=")[-1])
-            elif "NPOINTS" in line:
-                n_points = int(line.split("=")[-1])
-            elif "LASTX" in line:
-                last_x = float(line.split("=")[-1])
-            elif "FIRSTY" in line:
-                first_y = float(line.split("=")[-1])
-
-        elif line[0].isnumeric():  # make sure reading a number
-            data = [float(i) for i in line.strip().split(" ")]
-            x = data[0]
-            for y in data[1:]:
-                x_data_expr.append(x)
-                y_data_expr.append(y)
-                x += delta_x 
+if INSTRUMENTATION_REPORT is not None:
+    instrumentation.enable(profile=INSTRUMENTATION_PROFILE)
 
-
-# error checking, make sure file was parsed correctly
-
-if any(item == -1 for item in [delta_x, x_factor, y_factor, n_points, last_x, first_y]):
-    raise ValueError("Could not read metadata correctly")
-if n_points != len(x_data_expr):
-    raise ValueError("Did not parse correct number of data points")
-
-x_data_expr = [i * x_factor for i in x_data_expr]
-y_data_expr = [i * y_factor for i in y_data_expr]
-
-if last_x != x_data_expr[-1]:
-    raise ValueError("Last x value does not match expected from file")
-
-tolerance = 0.01  # y value must match within 1% (tolerance due to floating point representation)
-if first_y > y_data_expr[0] * (1 + tolerance) or first_y < y_data_expr[0] * (1 - tolerance):
-    raise ValueError("First y value does not match expected from file")
+with instrumentation.stage("parseJcamp", molecule=MOLECULE_NAME):
+    x_data_expr, y_data_expr, jcamp_metadata = jcamp_parser.parseJcamp(JCAMP_FILE)
+instrumentation.count("jcampPoints", len(x_data_expr), molecule=MOLECULE_NAME)
+with instrumentation.stage("preprocess", molecule=MOLECULE_NAME):
+    x_data_expr, y_data_expr, _ = preprocessing.preprocess(x_data_expr, y_data_expr, jcamp_metadata,
+                                                           PREPROCESSING_STEPS)
+x_data_expr = x_data_expr.tolist()
+y_data_expr = y_data_expr.tolist()
 
 
 
@@ -110,20 +91,16 @@ if first_y > y_data_expr[0] * (1 + tolerance) or first_y < y_data_expr[0] * (1 -
 # 
 ##############################################################################################################
 
-x_data_theor = []
-y_data_theor = []
 max_y_data_theor = 0
 rescaled_y_data_theor = []
 plot_y_data_theor = []
 
-with open(THEORETICAL_DATA_FILE, "r") as f:
-    for line in f.readlines():
-        # define first line as the first one that is numeric, this is brittle and sketchy but seems to 
-        # be a valid assumption.
-        if line[0].isnumeric():
-            data = line.split("\t")
-            x_data_theor.append(float(data[0]))
-            y_data_theor.append(float(data[1]))
+with instrumentation.stage("parseTheoretical", molecule=MOLECULE_NAME):
+    # the data starts at the first line whose first two columns are numbers, see gausssum_file.py
+    x_data_theor, y_data_theor, _ = gausssum_file.readGaussSum(THEORETICAL_DATA_FILE)
+x_data_theor = x_data_theor.tolist()
+y_data_theor = y_data_theor.tolist()
+instrumentation.count("theoreticalPoints", len(x_data_theor), molecule=MOLECULE_NAME)
 
 max_y_data_theor = max(y_data_theor)
 rescaled_y_data_theor = [i * max_y_data_theor for i in y_data_theor]
@@ -303,8 +280,16 @@ for row in sheet.rows:
 for col, value in dims.items():
     sheet.column_dimensions[col].width = value
 
+if instrumentation.enabled():
+    instrumentation.count("cellsWritten", sum(1 for row in sheet.rows for cell in row if cell.value is not None),
+                          molecule=MOLECULE_NAME)
+
+with instrumentation.stage("save"):
+    wb.save(filename=OUTPUT_FILE)
 
-wb.save(filename=OUTPUT_FILE)
+if INSTRUMENTATION_REPORT is not None:
+    instrumentation.printSummary()
+    instrumentation.writeReport(INSTRUMENTATION_REPORT)
 
 
 
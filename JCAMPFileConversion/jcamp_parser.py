@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reads JCAMP-DX (X++(Y..Y)) spectra into numpy arrays.
+
+@author: aiden
+"""
+
+import numpy
+
+
+def parseJcamp(fileName):
+    """
+    Parses a JCAMP file and returns (xvalues, yvalues, metadata). xvalues and
+    yvalues are numpy arrays with XFACTOR and YFACTOR already applied, and
+    metadata is a dictionary of every ##KEY=value header in the file (values
+    are left as stripped strings).
+
+    The same sanity checks as the excel converter are performed, a ValueError
+    is raised if the file could not be read correctly
+    """
+    metadata = {}
+    lineStarts = []
+    lineValues = []
+
+    with open(fileName, "r") as f:
+        for line in f:
+            if line.startswith("##"):
+                key, _, value = line[2:].partition("=")
+                metadata[key.strip().upper()] = value.strip()
+            elif line[:1].isnumeric():
+                data = numpy.array(line.split(), dtype="d")
+                lineStarts.append(data[0])
+                lineValues.append(data[1:])
+
+    try:
+        deltaX = float(metadata["DELTAX"])
+        xFactor = float(metadata["XFACTOR"])
+        yFactor = float(metadata["YFACTOR"])
+        nPoints = int(metadata["NPOINTS"])
+        lastX = float(metadata["LASTX"])
+        firstY = float(metadata["FIRSTY"])
+    except (KeyError, ValueError):
+        raise ValueError("Could not read metadata correctly")
+
+    # each data line starts at its own abscissa and steps by DELTAX
+    counts = numpy.array([len(v) for v in lineValues])
+    steps = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    xvalues = (numpy.repeat(lineStarts, counts) + steps * deltaX) * xFactor
+    yvalues = numpy.concatenate(lineValues) * yFactor if lineValues else numpy.zeros(0)
+
+    if nPoints != len(xvalues):
+        raise ValueError("Did not parse correct number of data points")
+
+    if lastX != xvalues[-1]:
+        raise ValueError("Last x value does not match expected from file")
+
+    tolerance = 0.01  # y value must match within 1% (tolerance due to floating point representation)
+    if firstY > yvalues[0] * (1 + tolerance) or firstY < yvalues[0] * (1 - tolerance):
+        raise ValueError("First y value does not match expected from file")
+
+    return xvalues, yvalues, metadata
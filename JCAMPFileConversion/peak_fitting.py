@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Least-squares decomposition of an experimental spectrum into a sum of
+lorentzians so that it can be compared stick for stick with the (freq, act)
+normal modes written by ir_spectra.irSpectra
+
+@author: aiden
+"""
+
+import numpy
+
+
+def lorentzianSum(xvalues, params):
+    """
+    Evaluates the sum of lorentzians described by params, an array of
+    (position, height, width) rows. Uses the same lineshape as
+    ir_spectra.lorentzian:
+
+    f(x) = height * a / ((peak - x)**2 + a)
+
+    where a is FWHM**2/4
+    """
+    pos, height, width = params[:, 0], params[:, 1], params[:, 2]
+    a = width**2 / 4.
+    d = xvalues[:, None] - pos[None, :]
+    return (height * a / (d**2 + a)).sum(axis=1)
+
+
+def lorentzianJacobian(xvalues, params):
+    """
+    Analytic jacobian of lorentzianSum with respect to every parameter.
+    Returns an array of shape (len(xvalues), 3 * len(params)) with columns
+    ordered the same way as params.ravel()
+    """
+    pos, height, width = params[:, 0], params[:, 1], params[:, 2]
+    a = width**2 / 4.
+    d = xvalues[:, None] - pos[None, :]
+    denom = d**2 + a
+
+    jac = numpy.empty((len(xvalues), len(params), 3))
+    jac[:, :, 0] = 2. * height * a * d / denom**2          # d/d(position)
+    jac[:, :, 1] = a / denom                               # d/d(height)
+    jac[:, :, 2] = height * d**2 * width / (2. * denom**2)  # d/d(width)
+    return jac.reshape(len(xvalues), -1)
+
+
+def findSeedPeaks(xvalues, yvalues, numPeaks, minHeight=0.):
+    """
+    Finds starting guesses for the fit. Takes the numPeaks tallest local
+    maxima above minHeight and estimates each width from where the data first
+    drops below half of the peak height. Returns an array of
+    (position, height, width) rows sorted by position
+    """
+    y = numpy.asarray(yvalues, dtype="d")
+    interior = numpy.arange(1, len(y) - 1)
+    isMax = (y[1:-1] >= y[:-2]) & (y[1:-1] > y[2:]) & (y[1:-1] > minHeight)
+    candidates = interior[isMax]
+    candidates = candidates[numpy.argsort(y[candidates])[::-1][:numPeaks]]
+
+    spacing = numpy.abs(numpy.diff(xvalues)).mean()
+    seeds = numpy.empty((len(candidates), 3))
+    for k, i in enumerate(candidates):
+        below = y < y[i] / 2.
+        left = numpy.flatnonzero(below[:i])
+        right = numpy.flatnonzero(below[i:])
+        lo = left[-1] if len(left) else 0
+        hi = i + right[0] if len(right) else len(y) - 1
+        seeds[k] = (xvalues[i], y[i], max(abs(xvalues[hi] - xvalues[lo]), 2. * spacing))
+
+    return seeds[numpy.argsort(seeds[:, 0])]
+
+
+def fitLorentzians(xvalues, yvalues, numPeaks=None, seeds=None, maxIterations=100, tolerance=1e-6):
+    """
+    Fits a sum of lorentzians to the spectrum with a Levenberg-Marquardt
+    least-squares solver. Either numPeaks (seeds are found with
+    findSeedPeaks) or seeds, an array of (position, height, width) rows, must
+    be given.
+
+    Returns (params, residual) where params is an array of fitted
+    (position, height, width) rows sorted by position and residual is the
+    final root mean square error
+    """
+    x = numpy.asarray(xvalues, dtype="d")
+    y = numpy.asarray(yvalues, dtype="d")
+    if seeds is None:
+        if numPeaks is None:
+            raise ValueError("Either numPeaks or seeds must be given")
+        seeds = findSeedPeaks(x, y, numPeaks)
+
+    params = numpy.array(seeds, dtype="d")
+    minWidth = numpy.abs(numpy.diff(x)).min() / 10.
+    maxWidth = x.max() - x.min()
+    residual = y - lorentzianSum(x, params)
+    cost = residual @ residual
+    damping = 1e-3
+
+    for _ in range(maxIterations):
+        jac = lorentzianJacobian(x, params)
+        jtj = jac.T @ jac
+        gradient = jac.T @ residual
+        diagonal = numpy.diag(jtj).copy()
+        diagonal[diagonal == 0] = 1.
+
+        improved = False
+        while damping < 1e10:
+            try:
+                step = numpy.linalg.solve(jtj + damping * numpy.diag(diagonal), gradient)
+            except numpy.linalg.LinAlgError:
+                damping *= 10.
+                continue
+
+            trial = params + step.reshape(params.shape)
+            trial[:, 0] = numpy.clip(trial[:, 0], x.min(), x.max())
+            trial[:, 1] = numpy.maximum(trial[:, 1], 0.)
+            trial[:, 2] = numpy.clip(trial[:, 2], minWidth, maxWidth)
+            trialResidual = y - lorentzianSum(x, trial)
+            trialCost = trialResidual @ trialResidual
+
+            if trialCost < cost:
+                improved = True
+                converged = cost - trialCost <= tolerance * cost
+                params, residual, cost = trial, trialResidual, trialCost
+                damping = max(damping / 10., 1e-12)
+                break
+            damping *= 10.
+
+        if not improved or converged:
+            break
+
+    params = params[numpy.argsort(params[:, 0])]
+    return params, numpy.sqrt(cost / len(y))
+
+
+def fitJcampFile(fileName, numPeaks):
+    """
+    Parses a JCAMP file and fits numPeaks lorentzians to it. Returns the fitted
+    sticks as (freq, act) arrays in the same form irSpectra uses along with
+    the fitted widths and the root mean square error of the fit
+    """
+    import jcamp_parser
+
+    xvalues, yvalues, _ = jcamp_parser.parseJcamp(fileName)
+    params, residual = fitLorentzians(xvalues, yvalues, numPeaks=numPeaks)
+    return params[:, 0], params[:, 1], params[:, 2], residual
+
+
+if __name__ == "__main__":
+    from timeit import default_timer as timer
+
+    jcampFile = "../test/naphthalene.jdx"
+    numPeaks = 50
+
+    start = timer()
+    freq, act, width, residual = fitJcampFile(jcampFile, numPeaks)
+    end = timer()
+
+    print("Freq (cm-1)\tHeight\tFWHM")
+    for f, a, w in zip(freq, act, width):
+        print(str(f) + "\t" + str(a) + "\t" + str(w))
+    print(f"Fit {len(freq)} bands with rms error {residual} in {end - start} seconds")
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preprocessing stages for experimental spectra parsed with jcamp_parser.
+
+Every stage takes and returns (xvalues, yvalues, units) where units is a
+(xunits, yunits) tuple using the JCAMP ##XUNITS/##YUNITS spelling. Stages
+are chained with preprocess(), which can cache intermediate results so that
+re-running a pipeline with only the last stage changed does not redo the
+earlier ones.
+
+@author: aiden
+"""
+
+import hashlib
+
+import numpy
+
+
+WAVENUMBER = "1/CM"
+MICROMETERS = "MICROMETERS"
+ABSORBANCE = "ABSORBANCE"
+TRANSMITTANCE = "TRANSMITTANCE"
+
+
+def _isTransmittance(yunits):
+    return "TRANS" in yunits.upper() or yunits.strip() == "%T"
+
+
+def _isPercent(yunits, yvalues):
+    # percent transmittance is spelled a few different ways, fall back on the
+    # data when the units do not say
+    return "%" in yunits or "PERCENT" in yunits.upper() or numpy.nanmax(yvalues) > 1.5
+
+
+def _isMicrometers(xunits):
+    return xunits.strip().lower() in ("micrometers", "microns", "um", "µm")
+
+
+def convertUnits(xvalues, yvalues, units, xunits=WAVENUMBER, yunits=ABSORBANCE):
+    """
+    Converts the spectrum to the requested units. x can be 1/CM or
+    MICROMETERS, y can be ABSORBANCE or TRANSMITTANCE (fractional).
+    Transmittance is converted with A = -log10(T), values of T <= 0 are
+    clipped to a small positive number first
+    """
+    currentX, currentY = units
+    x = numpy.asarray(xvalues, dtype="d")
+    y = numpy.asarray(yvalues, dtype="d")
+
+    if _isMicrometers(currentX) != _isMicrometers(xunits):
+        x = 10000. / x  # 1/cm <-> um conversion is its own inverse
+
+    if _isTransmittance(currentY):
+        transmittance = y / 100. if _isPercent(currentY, y) else y
+        if _isTransmittance(yunits):
+            y = transmittance
+        else:
+            y = -numpy.log10(numpy.clip(transmittance, 1e-10, None))
+    elif _isTransmittance(yunits):
+        y = 10.**(-y)
+
+    return x, y, (xunits, yunits)
+
+
+def savitzkyGolayCoefficients(windowLength, polyOrder, deriv=0, delta=1.):
+    """
+    Returns the convolution coefficients of a Savitzky-Golay filter. The
+    window length must be odd and larger than polyOrder
+    """
+    if windowLength % 2 != 1 or windowLength <= polyOrder:
+        raise ValueError("windowLength must be odd and greater than polyOrder")
+
+    half = windowLength // 2
+    vandermonde = numpy.vander(numpy.arange(-half, half + 1, dtype="d"), polyOrder + 1, increasing=True)
+    pinv = numpy.linalg.pinv(vandermonde)  # row k gives the k-th polynomial coefficient
+    factorial = numpy.prod(numpy.arange(1, deriv + 1, dtype="d"))
+    return pinv[deriv] * factorial / delta**deriv
+
+
+def savitzkyGolay(xvalues, yvalues, units, windowLength=11, polyOrder=3, deriv=0):
+    """
+    Smooths (deriv=0) or differentiates the spectrum with a Savitzky-Golay
+    filter. Assumes evenly spaced data, as JCAMP X++(Y..Y) data is. The ends
+    of the spectrum are handled by evaluating the polynomial fitted to the
+    first and last full windows
+    """
+    x = numpy.asarray(xvalues, dtype="d")
+    y = numpy.asarray(yvalues, dtype="d")
+    if len(y) < windowLength:
+        raise ValueError("Spectrum is shorter than the filter window")
+
+    delta = (x[-1] - x[0]) / (len(x) - 1)
+    coeffs = savitzkyGolayCoefficients(windowLength, polyOrder, deriv, delta)
+    filtered = numpy.convolve(y, coeffs[::-1], mode="same")
+
+    # fix the edges with a polynomial fit to each end window
+    half = windowLength // 2
+    positions = numpy.arange(windowLength, dtype="d")
+    for window, target in ((slice(0, windowLength), slice(0, half)),
+                           (slice(len(y) - windowLength, len(y)), slice(len(y) - half, len(y)))):
+        poly = numpy.polynomial.Polynomial.fit(positions, y[window], polyOrder).convert()
+        poly = poly.deriv(deriv) if deriv else poly
+        filtered[target] = poly(positions[target.start - window.start:target.stop - window.start]) / delta**deriv
+
+    yunits = units[1] if deriv == 0 else units[1] + " D" + str(deriv)
+    return x, filtered, (units[0], yunits)
+
+
+def alsBaseline(yvalues, lam=1e5, p=0.01, iterations=10):
+    """
+    Estimates the baseline with asymmetric least squares (Eilers and Boelens,
+    2005). Each iteration solves (W + lam * D'D) z = W y where D is the second
+    difference matrix. The system is pentadiagonal so it is solved as a banded
+    matrix in O(n).
+
+    lam controls smoothness and p the asymmetry (points above the baseline get
+    weight p, points below get 1 - p)
+    """
+    from scipy.linalg import solveh_banded  # scipy is only needed for baseline removal
+
+    y = numpy.asarray(yvalues, dtype="d")
+    n = len(y)
+    if n < 4:
+        return y.copy()
+
+    # upper banded form of D'D for a second difference matrix
+    ab = numpy.zeros((3, n))
+    ab[0, 2:] = 1.
+    ab[1, 1:] = -4.
+    ab[1, 1] = ab[1, -1] = -2.
+    ab[2, :] = 6.
+    ab[2, 0] = ab[2, -1] = 1.
+    ab[2, 1] = ab[2, -2] = 5.
+    ab *= lam
+
+    weights = numpy.ones(n)
+    mainDiagonal = ab[2].copy()
+    for _ in range(iterations):
+        ab[2] = mainDiagonal + weights
+        baseline = solveh_banded(ab, weights * y, check_finite=False)
+        newWeights = numpy.where(y > baseline, p, 1. - p)
+        if numpy.array_equal(newWeights, weights):
+            break
+        weights = newWeights
+
+    return baseline
+
+
+def removeBaseline(xvalues, yvalues, units, lam=1e5, p=0.01, iterations=10):
+    """Subtracts the asymmetric least squares baseline from the spectrum"""
+    y = numpy.asarray(yvalues, dtype="d")
+    return xvalues, y - alsBaseline(y, lam, p, iterations), units
+
+
+STAGES = {
+    "units": convertUnits,
+    "smooth": savitzkyGolay,
+    "baseline": removeBaseline,
+}
+
+
+def _stageKey(previousKey, name, kwargs):
+    h = hashlib.sha1(previousKey.encode())
+    h.update(repr((name, sorted(kwargs.items()))).encode())
+    return h.hexdigest()
+
+
+def preprocess(xvalues, yvalues, metadata, steps, cache=None):
+    """
+    Runs the spectrum through steps, a list of (stage name, kwargs) tuples
+    where stage name is a key of STAGES, e.g.
+
+        [("units", {"yunits": "ABSORBANCE"}), ("baseline", {"lam": 1e6})]
+
+    metadata is the dictionary returned by jcamp_parser.parseJcamp and is used
+    to find the starting units. If cache is a dictionary, the output of every
+    stage is stored in it keyed by the input data and all of the steps up to
+    that point, so pipelines sharing a prefix only compute the prefix once.
+
+    Returns (xvalues, yvalues, units)
+    """
+    x = numpy.asarray(xvalues, dtype="d")
+    y = numpy.asarray(yvalues, dtype="d")
+    units = (metadata.get("XUNITS", WAVENUMBER), metadata.get("YUNITS", ABSORBANCE))
+
+    key = None
+    if cache is not None:
+        h = hashlib.sha1(x.tobytes())
+        h.update(y.tobytes())
+        h.update(repr(units).encode())
+        key = h.hexdigest()
+
+    for name, kwargs in steps:
+        if key is not None:
+            key = _stageKey(key, name, kwargs)
+            if key in cache:
+                x, y, units = cache[key]
+                continue
+
+        x, y, units = STAGES[name](x, y, units, **kwargs)
+        if key is not None:
+            cache[key] = (x, y, units)
+
+    return x, y, units
@@ -6,13 +6,9 @@ Created on Wed Jun 28 17:54:34 2023
 @author: aiden
 """
 import raman_spectra
-from openpyxl import Workbook
-from openpyxl.chart import ScatterChart, Reference, Series
-from openpyxl.chart.label import DataLabel, DataLabelList
-import matplotlib.pyplot as plt
+import spectrum_cache
+import instrumentation
 from timeit import default_timer as timer
-from openpyxl.drawing.text import Paragraph, ParagraphProperties, CharacterProperties
-from openpyxl.chart.text import RichText
 
 import math
 
@@ -41,6 +37,12 @@ def SCALE_FUNCTION(freq):
         scalingFactor = 0.973    
     return scalingFactor
     
+PARSE_CACHE_DIR = "./parse_cache"  # cclib results are saved here so files are only parsed once,
+                                   # set to None to always reparse
+SPECTRUM_CACHE_DIR = "./spectrum_cache"  # broadened spectra are saved here and reused while the modes and
+                                         # broadening settings are unchanged, set to None to always rebroaden
+SPECTRUM_CACHE_MAX_BYTES = 512 * 2**20   # least recently used spectra are removed beyond this size
+
 EXCITATION = 785
 TEMPERATURE = 293.15
 
@@ -88,12 +90,17 @@ INCLUDE_ALL_LOCAL_MAX_RANGES = [
 ##########################
 MPL_PLOT = False  # set true if you would like to view which peaks were chosen
                   # before having to open excel
+INSTRUMENTATION_REPORT = None   # set to a .json file to record the time and memory of each stage per molecule
+INSTRUMENTATION_MEMORY = True   # trace peak memory per stage (slower)
+INSTRUMENTATION_PROFILE = False  # also write a cProfile dump next to the report
 
 
 
 # anything below this line is not to be modified by typical users
 
 start = timer()
+if INSTRUMENTATION_REPORT is not None:
+    instrumentation.enable(INSTRUMENTATION_MEMORY, INSTRUMENTATION_PROFILE)
 workingDir = "./"
 
 
@@ -104,9 +111,21 @@ workingDir = "./"
 #
 ###############################################################################
 
+spectrumCache = None
+if SPECTRUM_CACHE_DIR is not None:
+    spectrumCache = spectrum_cache.SpectrumCache(SPECTRUM_CACHE_DIR, SPECTRUM_CACHE_MAX_BYTES)
+
+moleculeFiles = {}  # the molecules of INPUT_FILES with Raman data
 for moleculeName, inputFile in INPUT_FILES.items():
     outputFile = workingDir + moleculeName + ".out"
-    raman_spectra.ramanSpectra(inputFile, outputFile, START, END, NUM_PTS, FWHM, SCALE_FUNCTION, EXCITATION, TEMPERATURE)
+    # the check parses the file, which is then timed as part of the molecule
+    with instrumentation.stage("gausssum", molecule=moleculeName):
+        if not raman_spectra.hasRamanData(inputFile, PARSE_CACHE_DIR):
+            print("Warning: skipping", moleculeName, "as", inputFile, "has no Raman activities, was it a freq=Raman job?")
+            continue
+        moleculeFiles[moleculeName] = inputFile
+        raman_spectra.ramanSpectra(inputFile, outputFile, START, END, NUM_PTS, FWHM, SCALE_FUNCTION, EXCITATION, TEMPERATURE, PARSE_CACHE_DIR,
+                                   spectrumCache=spectrumCache)
 
 
 ###############################################################################
@@ -185,6 +204,8 @@ def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass,
                 lastPeakIndex = i
                 
     if plot:
+        import matplotlib.pyplot as plt  # only loaded when plotting, it is slow to import
+
         print([dataX[i] for i in peaks])
         fig = plt.figure()
         ax = fig.add_subplot(111)
@@ -203,6 +224,13 @@ def findPeaks(dataX, dataY, max_x, windowSize, nsigma, coalesceWindow, highPass,
 #                         Excel Data Dump
 #
 ###############################################################################
+# openpyxl is slow to import, so it is only imported once the workbook is written
+from openpyxl import Workbook
+from openpyxl.chart import ScatterChart, Reference, Series
+from openpyxl.chart.label import DataLabel, DataLabelList
+from openpyxl.drawing.text import Paragraph, ParagraphProperties, CharacterProperties
+from openpyxl.chart.text import RichText
+
 wb = Workbook()
 wb.remove(wb.active)
 
@@ -211,7 +239,7 @@ wb.create_sheet("config")
 configRow = 1
 currentOffset = 0
 moleculeData = {}  # {molecule name: {dataLabel: [data]}}
-for moleculeName, inputFile in INPUT_FILES.items():
+for moleculeName, inputFile in moleculeFiles.items():
     # read data from file
     freqData = []
     irData = []
@@ -356,7 +384,7 @@ wavChart.x_axis.title.tx.rich.p[0].pPr = pp
 wavChart.y_axis.title.tx.rich.p[0].pPr = pp
 
 
-for moleculeName, inputFile in INPUT_FILES.items():
+for moleculeName, inputFile in moleculeFiles.items():
     sheet = wb[moleculeName]
     npoints = len(moleculeData[moleculeName]["freqs"])
     freqXData = Reference(sheet, min_col=1, max_col=1, min_row=3, max_row=2 + npoints)
@@ -397,11 +425,22 @@ sheet.add_chart(wavChart)
 #
 ###############################################################################
 
-wb.save(filename=OUTPUT_EXCEL_FILE)
+with instrumentation.stage("save"):
+    wb.save(filename=OUTPUT_EXCEL_FILE)
 
 end = timer()
 
+if spectrumCache is not None:
+    stats = spectrumCache.stats()
+    print(f"Spectrum cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries "
+          f"({stats['bytes'] / 2**20:.1f} MB)")
+
 print()
 print()
-print(f"Finished processing {len(INPUT_FILES.keys())} files in {end - start} seconds")
+print(f"Finished processing {len(moleculeFiles)} files in {end - start} seconds")
+
+if INSTRUMENTATION_REPORT is not None:
+    print()
+    instrumentation.printSummary()
+    instrumentation.writeReport(INSTRUMENTATION_REPORT)
 
@@ -11,9 +11,15 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
 # General Public License for more details.
 
-import math
+import os
+import sys
 import numpy
-from cclib.parser import ccopen
+
+# the cclib parsing (and its cache) is shared with the IR spectra scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "IRSpectra"))
+import ir_spectra
+import ensemble
+import instrumentation
 
 
 def broadenSpectrum(start, end, numpts, peaks, width, formula):
@@ -28,7 +34,6 @@ def broadenSpectrum(start, end, numpts, peaks, width, formula):
     """
     spectrum = numpy.zeros(numpts,"d")
     xvalues = numpy.linspace(start, end, numpts)
-    print(xvalues, start)
     for i in range(numpts):
         x = xvalues[i]
         for pos, height in peaks:
@@ -51,52 +56,175 @@ def lorentzian(x, peak, height, width):
     
 def activity_to_intensity(activity, frequency, excitation, temperature):
     """Convert Raman acitivity to Raman intensity according to
-    Krishnakumar et al, J. Mol. Struct., 2004, 702, 9."""
+    Krishnakumar et al, J. Mol. Struct., 2004, 702, 9.
+
+    activity and frequency can be scalars or numpy arrays"""
 
     excitecm = 1 / (1e-7 * excitation)
     f = 1e-13
     above = f * (excitecm - frequency)**4 * activity
     exponential = -6.626068e-34 * 299792458 * frequency / (1.3806503e-23 * temperature)
-    below = frequency * (1 - math.exp(exponential))
+    below = frequency * (1 - numpy.exp(exponential))
     return above / below
 
 
+def streamFile(inputFileName):
+    """
+    Reads a tab separated (mode, freq, activity) file such as vasp_raman.dat
+    one line at a time, yielding a (mode, freq, act) tuple for every data
+    line. The header line and any lines without three columns are skipped
+    """
+    with open(inputFileName, "r") as f:
+        next(f, None)  # header
+        for line in f:
+            numbers = line.split("\t")
+            if len(numbers) == 3:
+                yield int(numbers[0]), float(numbers[1]), float(numbers[2])
+
+
 def parseFile(inputFileName):
     mode = []
     freq = []
     act = []
-    with open(inputFileName, "r") as f:
-        for line in f.readlines()[1:]:
-            numbers = line.split("\t")
-            if len(numbers) == 3:
-                mode.append(int(numbers[0]))
-                freq.append(float(numbers[1]))
-                act.append(float(numbers[2]))
+    for m, f, a in streamFile(inputFileName):
+        mode.append(m)
+        freq.append(f)
+        act.append(a)
 
     return mode, freq, act
 
-def ramanSpectra(inputFileName, outputFileName, start, end, numpts, FWHM, scaleFunction, excitation, temperature):
+
+def loadFile(inputFileName):
+    """
+    Loads a tab separated (mode, freq, activity) file in one go and returns
+    (mode, freq, act) numpy arrays. As in streamFile, the header line and any
+    lines without three columns are skipped
+    """
+    with open(inputFileName, "r") as f:
+        next(f, None)  # header
+        lines = [line for line in f if line.count("\t") == 2]
+    if not lines:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0)
+    data = numpy.loadtxt(lines, delimiter="\t", ndmin=2)
+    return data[:, 0].astype(int), data[:, 1], data[:, 2]
+
+
+def parseLog(inputFileName, cacheDir=None):
+    """
+    Reads the Raman frequencies and activities (vibfreqs and vibramans) from
+    a Gaussian freq=Raman or ORCA output using the same cached cclib parse as
+    the IR spectra. Returns (mode, freq, act) numpy arrays
+    """
+    ccData = ir_spectra.parseLog(inputFileName, cacheDir)
+    if "vibramans" not in ccData:
+        raise ValueError(f"No Raman activities found in {inputFileName}, was it a freq=Raman job?")
+
+    freq = ccData["vibfreqs"].copy()
+    return numpy.arange(1, len(freq) + 1), freq, ccData["vibramans"].copy()
+
+
+# extensions read as tab separated text, everything else is handed to cclib
+TEXT_EXTENSIONS = [".dat", ".txt", ".tsv"]
+
+
+def hasRamanData(inputFileName, cacheDir=None):
+    """False for a quantum chemistry output without Raman activities (not a freq=Raman job), True otherwise"""
+    if os.path.splitext(inputFileName)[1].lower() in TEXT_EXTENSIONS:
+        return True
+    return "vibramans" in ir_spectra.parseLog(inputFileName, cacheDir)
+
+
+def loadRamanData(inputFileName, cacheDir=None):
+    """
+    Returns (mode, freq, act) for either a tab separated activity file or a
+    quantum chemistry output file, chosen based on the file extension
+    """
+    if os.path.splitext(inputFileName)[1].lower() in TEXT_EXTENSIONS:
+        return loadFile(inputFileName)
+    return parseLog(inputFileName, cacheDir)
+
+
+def ramanChannelSpectra(freq, act, start, end, numpts, FWHM, conditions):
+    """
+    Broadens the activity and the intensity for every (excitation,
+    temperature) pair in conditions from a single kernel evaluation.
+    freq should already be scaled.
+
+    Returns (xvalues, activitySpectrum, intensities, intensitySpectra) where
+    intensities and intensitySpectra have one row per condition
+    """
+    freq = numpy.asarray(freq, dtype="d")
+    act = numpy.asarray(act, dtype="d")
+    intensities = numpy.array([activity_to_intensity(act, freq, excitation, temperature)
+                               for excitation, temperature in conditions]).reshape(-1, len(freq))
+
+    xvalues, spectra = ir_spectra.broadenChannels(start, end, numpts, freq, numpy.vstack([act, intensities]), FWHM)
+    spectra[spectra < 1e-20] = 0.
+    return xvalues, spectra[0], intensities, spectra[1:]
+
+
+def ramanEnsembleSpectra(inputFiles, start, end, numpts, FWHM, scaleFunction, excitation, temperature, cacheDir=None):
+    """
+    Boltzmann weighted Raman spectrum of the conformers in inputFiles
+    (Gaussian freq=Raman or ORCA outputs), weighted at temperature. The sticks
+    of every conformer are broadened together in one pass.
+
+    Returns (xvalues, activitySpectrum, intensitySpectrum, weights)
+    """
+    freq, act, owner, _, _, _, ccDatas = ensemble.concatenateSticks(inputFiles, scaleFunction, "vibramans", cacheDir)
+    weights = ensemble.boltzmannWeights(ensemble.conformerEnergies(ccDatas), temperature)
+
+    xvalues, activity_spectrum, _, intensity_spectrum = ramanChannelSpectra(
+        freq, act * weights[owner], start, end, numpts, FWHM, [(excitation, temperature)])
+    return xvalues, activity_spectrum, intensity_spectrum[0], weights
+
+
+def ramanSpectra(inputFileName, outputFileName, start, end, numpts, FWHM, scaleFunction, excitation, temperature, cacheDir=None,
+                 spectrumCache=None):
+    """
+    Scales and broadens the raman activities in inputFileName and writes the
+    activity and intensity spectra to outputFileName. spectrumCache is an
+    optional spectrum_cache.SpectrumCache to reuse earlier spectra from
+    """
     print("Parsing file")
 
-    mode, freq, act = parseFile(inputFileName)
+    # not "parse", parseLog times its own cclib parse under that name
+    with instrumentation.stage("load"):
+        mode, freq, act = loadRamanData(inputFileName, cacheDir)
+    instrumentation.count("modes", len(freq))
+    freq = numpy.asarray(freq, dtype="d")
     unscaledFreq = freq.copy()
-    scale = []
-    
-    for i in range(len(freq)):
-        scalingFactor = scaleFunction(freq[i])
-        freq[i] *= scalingFactor
-        scale.append(scalingFactor)
-        
-    intensity = [activity_to_intensity(a, f, excitation, temperature) for f, a in zip(freq, act)]
-    
-    print("Broadening spectrum")
-    xvalues, activity_spectrum = broadenSpectrum(start, end, numpts, list(zip(freq, act)), FWHM, lorentzian)
-    xvalues, intensity_spectrum = broadenSpectrum(start, end, numpts, list(zip(freq, intensity)), FWHM, lorentzian)
-        
-    
+    scale = numpy.array([scaleFunction(f) for f in unscaledFreq])
+    freq = freq * scale
+
+    cached = None
+    if spectrumCache is not None:
+        key = spectrumCache.key(lineshape="lorentzian", freq=freq, act=numpy.asarray(act, dtype="d"), scale=scale,
+                                start=start, end=end, numpts=numpts, FWHM=FWHM,
+                                excitation=excitation, temperature=temperature)
+        cached = spectrumCache.get(key)
+
+    if cached is not None:
+        print("Using cached spectrum")
+        instrumentation.count("spectrumCacheHits")
+        xvalues, activity_spectrum = cached["xvalues"], cached["activity"]
+        intensity, intensity_spectrum = cached["intensity"], cached["intensitySpectrum"]
+    else:
+        print("Broadening spectrum")
+        with instrumentation.stage("broaden"):
+            xvalues, activity_spectrum, intensity, intensity_spectrum = ramanChannelSpectra(
+                freq, act, start, end, numpts, FWHM, [(excitation, temperature)])
+        if spectrumCache is not None:
+            instrumentation.count("spectrumCacheMisses")
+            spectrumCache.put(key, xvalues=xvalues, activity=activity_spectrum, intensity=intensity,
+                              intensitySpectrum=intensity_spectrum)
+    intensity = intensity[0]
+    intensity_spectrum = intensity_spectrum[0]
     
+    instrumentation.count("gridPoints", numpts)
+
     print("Writing scaled spectrum to", outputFileName) 
-    with open(outputFileName, "w") as outputFile:
+    with instrumentation.stage("writeSpectrum"), open(outputFileName, "w") as outputFile:
         outputFile.write("\t".join(["Spectrum Freq", "Spectrum Activity", "Spectrum Intensity", 
             "Mode", "Unscaled Freq", "Scale", "Scaled Freq", "Activity", "Intensity"]))
         outputFile.write("\n")
@@ -104,24 +232,17 @@ def ramanSpectra(inputFileName, outputFileName, start, end, numpts, FWHM, scaleF
         i = 0
         while i < max(numpts, len(freq)):
             if i < numpts:  # write the spectrum data
-                if activity_spectrum[i] < 1e-20:
-                    activity_spectrum[i] = 0.
-                if intensity_spectrum[i] < 1e-20:
-                    intensity_spectrum[i] = 0.
-                print(intensity_spectrum[i])
                 outputFile.write(str(xvalues[i]) + "\t" + str(activity_spectrum[i]) + "\t" + str(intensity_spectrum[i]))
             else:
                 outputFile.write("\t\t")
                 
             
             if i < len(freq):
-                print(mode[i])
                 outputFile.write("\t" + str(mode[i]) + "\t" + str(unscaledFreq[i]) + "\t" + str(scale[i]) + "\t"
                     + str(freq[i]) + "\t" + str(act[i]) + "\t" + str(intensity[i]))
 
             outputFile.write("\n")
             i += 1
-    print(intensity)
     return xvalues, activity_spectrum, intensity_spectrum
 
 